@@ -6,7 +6,9 @@ class BaseApp(object):
     def __init__(self, settings, key_bindings):
         self.debug_level = 0
 
-    def handle_input(self, input_image, input_label, input_filename, panes):
+    def handle_input(self, input_image, input_label, input_filename, panes, input_key = None):
+        '''Handle a new input frame. input_key identifies static input images in live_vis.static_input_cache, and
+        is None for camera frames'''
         pass
         
     def handle_key(self, key, panes):
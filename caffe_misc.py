@@ -87,55 +87,189 @@ class RegionComputer(object):
 
     @staticmethod
     def convert_region_dag(settings, from_layer, to_layer, region):
+        '''
+        converts a region (ii_start, ii_end, jj_start, jj_end) of from_layer to the region of to_layer which can
+        influence it, by walking the parents of from_layer, and merging the regions of all paths
+        the walk is done once per layer and compiled into an AffineRegionMap, see get_region_map
+        '''
 
-        step_region = None
+        return RegionComputer.get_region_map(settings, from_layer, to_layer).convert(region)
 
-        layer_def = settings._layer_name_to_record[from_layer] if from_layer in settings._layer_name_to_record else None
 
-        # do single step to convert according to from_layer
-        if not layer_def:
-            # fallback to doing nothing
-            step_region = region
+    @staticmethod
+    def get_region_map(settings, from_layer, to_layer = 'input'):
+        '''returns the AffineRegionMap from from_layer to to_layer, the maps to each to_layer are compiled on first use'''
 
-        else:
+        if not hasattr(settings, '_region_maps'):
+            settings._region_maps = dict()
 
-            if layer_def.type in ['Convolution', 'Pooling']:
-                step_region = RegionComputer.region_converter(region, layer_def.filter, layer_def.stride, layer_def.pad)
+        if to_layer not in settings._region_maps:
+            settings._region_maps[to_layer] = RegionComputer.compile_region_maps(settings, to_layer)
+        region_maps = settings._region_maps[to_layer]
 
-            else:
-                # fallback to doing nothing
-                step_region = region
+        if from_layer not in region_maps:
+            # not a layer of the network, the region is kept as is
+            return AffineRegionMap.identity()
 
-        if from_layer == to_layer:
-            return step_region
+        return region_maps[from_layer]
 
-        # handle the rest
-        total_region = None
 
-        if layer_def is not None:
-            for parent_layer in layer_def.parents:
+    @staticmethod
+    def compile_region_maps(settings, to_layer = 'input'):
+        '''
+        compiles the AffineRegionMap from every layer of the network to to_layer
+        each layer is compiled once, from the maps of its parents, so layers shared by many paths are not walked again
+        :return: dictionary of layer name to AffineRegionMap
+        '''
 
-                # skip inplace layers
-                if len(parent_layer.tops) == 1 and len(parent_layer.bottoms) == 1 and parent_layer.tops[0] == parent_layer.bottoms[0]:
+        layer_name_to_record = settings._layer_name_to_record
+        region_maps = dict()
+
+        def compile_layer(layer_name):
+            # iterative post order walk, so long chains of layers do not hit the recursion limit
+            stack = [layer_name]
+            while stack:
+                current_name = stack[-1]
+                layer_def = layer_name_to_record[current_name]
+
+                parent_names = []
+                if current_name != to_layer:
+                    for parent_layer in layer_def.parents:
+                        # skip inplace layers
+                        if len(parent_layer.tops) == 1 and len(parent_layer.bottoms) == 1 and parent_layer.tops[0] == parent_layer.bottoms[0]:
+                            continue
+                        parent_names.append(parent_layer.name)
+
+                missing_parent_names = [name for name in parent_names if name not in region_maps]
+                if missing_parent_names:
+                    stack.extend(missing_parent_names)
                     continue
 
-                # calculate convert_region_dag on each one
-                current_region = RegionComputer.convert_region_dag(settings, parent_layer.name, to_layer, step_region)
+                stack.pop()
+                if current_name in region_maps:
+                    continue
+
+                if layer_def.type in ['Convolution', 'Pooling']:
+                    step_map = AffineRegionMap.step(layer_def.filter, layer_def.stride, layer_def.pad)
+                else:
+                    step_map = AffineRegionMap.identity()
 
-                # aggregate results
-                if total_region is None:
-                    total_region = current_region
+                if parent_names:
+                    region_maps[current_name] = AffineRegionMap.merge([region_maps[name].compose(step_map) for name in parent_names])
                 else:
-                    total_region = RegionComputer.merge_regions(total_region, current_region)
+                    region_maps[current_name] = step_map
+
+        # layers are listed in the prototxt order, in which parents come before their children
+        for layer_def in settings._network_def.layer:
+            if layer_def.name in layer_name_to_record:
+                compile_layer(layer_def.name)
+        for layer_name in layer_name_to_record:
+            compile_layer(layer_name)
+
+        return region_maps
+
+
+class AffineRegionMap(object):
+    '''
+    region of a lower layer which can influence a region of a higher layer, compiled from the conv and pool layers
+    between them. each path between the layers maps a region with a single affine map on each axis:
+        start -> scale * start + start_offset
+        end -> scale * end + end_offset
+    and the regions of all paths are merged by taking the minimal start and maximal end. paths with the same scale
+    are merged when compiling, so the map holds a few (scale, start_offset, end_offset) rows per axis, usually one
+    '''
+
+    def __init__(self, ii_terms, jj_terms):
+        '''
+        :param ii_terms: dictionary of scale to (start_offset, end_offset) of the ii axis
+        :param jj_terms: dictionary of scale to (start_offset, end_offset) of the jj axis
+        '''
+
+        self.ii_terms = ii_terms
+        self.jj_terms = jj_terms
+
+        # arrays of shape (n_terms, 3) of scale, start_offset, end_offset, for converting arrays of locations
+        self._ii_array = np.array([(scale,) + offsets for scale, offsets in sorted(ii_terms.items())], dtype=np.int64)
+        self._jj_array = np.array([(scale,) + offsets for scale, offsets in sorted(jj_terms.items())], dtype=np.int64)
+
+    @staticmethod
+    def identity():
+        return AffineRegionMap({1: (0, 0)}, {1: (0, 0)})
+
+    @staticmethod
+    def step(filter_width, stride, pad):
+        '''map of a single conv or pool layer, as RegionComputer.region_converter'''
+
+        return AffineRegionMap({stride[0]: (-pad[0], -pad[0] + filter_width[0] - 1)},
+                               {stride[1]: (-pad[1], -pad[1] + filter_width[1] - 1)})
+
+    @staticmethod
+    def _merge_terms(terms_list):
+        merged_terms = dict()
+        for terms in terms_list:
+            for scale, (start_offset, end_offset) in terms.iteritems():
+                if scale in merged_terms:
+                    merged_start_offset, merged_end_offset = merged_terms[scale]
+                    merged_terms[scale] = (min(merged_start_offset, start_offset), max(merged_end_offset, end_offset))
+                else:
+                    merged_terms[scale] = (start_offset, end_offset)
+        return merged_terms
+
+    @staticmethod
+    def merge(region_maps):
+        '''map of the merged regions of several paths, as RegionComputer.merge_regions'''
+
+        return AffineRegionMap(AffineRegionMap._merge_terms([region_map.ii_terms for region_map in region_maps]),
+                               AffineRegionMap._merge_terms([region_map.jj_terms for region_map in region_maps]))
+
+    @staticmethod
+    def _compose_terms(outer_terms, inner_terms):
+        return AffineRegionMap._merge_terms([{outer_scale * inner_scale: (outer_scale * inner_start_offset + outer_start_offset,
+                                                                          outer_scale * inner_end_offset + outer_end_offset)}
+                                             for outer_scale, (outer_start_offset, outer_end_offset) in outer_terms.iteritems()
+                                             for inner_scale, (inner_start_offset, inner_end_offset) in inner_terms.iteritems()])
+
+    def compose(self, inner_map):
+        '''map which applies inner_map first, and then this map'''
+
+        return AffineRegionMap(AffineRegionMap._compose_terms(self.ii_terms, inner_map.ii_terms),
+                               AffineRegionMap._compose_terms(self.jj_terms, inner_map.jj_terms))
+
+    def convert(self, region):
+        '''
+        :param region: (ii_start, ii_end, jj_start, jj_end) in the higher layer
+        :return: (ii_start, ii_end, jj_start, jj_end) in the lower layer
+        '''
+
+        ii_start, ii_end, jj_start, jj_end = region
+        return (min([scale * ii_start + start_offset for scale, (start_offset, end_offset) in self.ii_terms.iteritems()]),
+                max([scale * ii_end + end_offset for scale, (start_offset, end_offset) in self.ii_terms.iteritems()]),
+                min([scale * jj_start + start_offset for scale, (start_offset, end_offset) in self.jj_terms.iteritems()]),
+                max([scale * jj_end + end_offset for scale, (start_offset, end_offset) in self.jj_terms.iteritems()]))
+
+    def convert_units(self, ii, jj):
+        '''
+        converts the regions of single units, (ii, ii + 1, jj, jj + 1), for arrays of locations at once
+        :param ii: array of rows in the higher layer
+        :param jj: array of columns in the higher layer
+        :return: arrays ii_start, ii_end, jj_start, jj_end in the lower layer, with the shape of ii and jj
+        '''
+
+        ii = np.asarray(ii, dtype=np.int64)
+        jj = np.asarray(jj, dtype=np.int64)
+        ii_terms, jj_terms = self._ii_array[:, :, np.newaxis], self._jj_array[:, :, np.newaxis]
+        flat_ii, flat_jj = ii.reshape(1, -1), jj.reshape(1, -1)
 
-        if total_region is None:
-            return step_region
+        ii_start = (ii_terms[:, 0] * flat_ii + ii_terms[:, 1]).min(axis=0)
+        ii_end = (ii_terms[:, 0] * (flat_ii + 1) + ii_terms[:, 2]).max(axis=0)
+        jj_start = (jj_terms[:, 0] * flat_jj + jj_terms[:, 1]).min(axis=0)
+        jj_end = (jj_terms[:, 0] * (flat_jj + 1) + jj_terms[:, 2]).max(axis=0)
 
-        return total_region
+        return ii_start.reshape(ii.shape), ii_end.reshape(ii.shape), jj_start.reshape(jj.shape), jj_end.reshape(jj.shape)
 
 
-def save_caffe_image(img, filename, autoscale = True, autoscale_center = None):
-    '''Takes an image in caffe format (01) or (c01, BGR) and saves it to a file'''
+def caffe_image_to_rgb(img, autoscale = True, autoscale_center = None):
+    '''Takes an image in caffe format (01) or (c01, BGR) and returns it as an (01c, RGB) image, scaled as save_caffe_image does'''
     if len(img.shape) == 2:
         # upsample grayscale 01 -> 01c
         img = np.tile(img[:,:,np.newaxis], (1,1,3))
@@ -147,7 +281,19 @@ def save_caffe_image(img, filename, autoscale = True, autoscale_center = None):
         img = img.copy()
         img -= img.min()
         img *= 1.0 / (img.max() + 1e-10)
-    skimage.io.imsave(filename, img)
+    return img
+
+
+def save_caffe_image(img, filename, autoscale = True, autoscale_center = None, png_compression = None):
+    '''
+    Takes an image in caffe format (01) or (c01, BGR) and saves it to a file
+    png_compression is the PNG compression level (0-9) of .png files, None keeps the default of the image library
+    '''
+    img = caffe_image_to_rgb(img, autoscale, autoscale_center)
+    if png_compression is not None and filename.lower().endswith('.png'):
+        skimage.io.imsave(filename, img, compress_level = png_compression)
+    else:
+        skimage.io.imsave(filename, img)
 
 
 def layer_name_to_top_name(net, layer_name):
@@ -158,6 +304,74 @@ def layer_name_to_top_name(net, layer_name):
     else:
         return None
 
+class OneHotBackward(object):
+    '''
+    runs a single backward or deconv pass from chosen units of a layer, for many samples of the batch at once
+    the targets are scattered into a zeroed top diff buffer, which is kept per top and reused between calls
+    '''
+
+    def __init__(self, net):
+        self.net = net
+        self._diff_buffers = dict()
+
+    def get_diff_buffer(self, top_name):
+        '''returns the zeroed diff buffer of the top, allocated again only when the net was reshaped'''
+
+        top_diff = self.net.blobs[top_name].diff
+        if top_name not in self._diff_buffers or self._diff_buffers[top_name].shape != top_diff.shape:
+            self._diff_buffers[top_name] = np.zeros_like(top_diff)
+        return self._diff_buffers[top_name]
+
+    def run(self, layer_name, batch_indices, channels, ii = None, jj = None, values = 1.0, deconv_type = None,
+            zero_higher = False):
+        '''
+        sets the top diff of the layer at the targets to values, and runs one backward pass, or one deconv pass if
+        deconv_type is given, for the whole batch
+        :param layer_name: layer to start from
+        :param batch_indices: array of batch indices of the targets
+        :param channels: array of channels of the targets
+        :param ii: array of rows of the targets, None sets the whole map of the channel. ignored for non spatial layers
+        :param jj: array of columns of the targets, None sets the whole map of the channel. ignored for non spatial layers
+        :param values: values to set, scalar or one per target (a whole map per target when ii and jj are None)
+        :param deconv_type: None for backward, otherwise type of deconv, e.g. 'Guided Backprop'
+        :param zero_higher: zero the diffs of the layers above the starting layer
+        :return: the input gradients of all the samples, net.blobs['data'].diff
+        '''
+
+        diffs = self.get_diff_buffer(layer_name_to_top_name(self.net, layer_name))
+
+        if len(diffs.shape) == 4 and ii is not None and jj is not None:
+            targets = (batch_indices, channels, ii, jj)
+        else:
+            targets = (batch_indices, channels)
+
+        diffs[targets] = values
+        try:
+            if deconv_type is None:
+                self.net.backward_from_layer(layer_name, diffs, zero_higher = zero_higher)
+            else:
+                self.net.deconv_from_layer(layer_name, diffs, zero_higher = zero_higher, deconv_type = deconv_type)
+        finally:
+            # leave the buffer zeroed for the next call
+            diffs[targets] = 0
+
+        return self.net.blobs['data'].diff
+
+
+# one backward engine for each net, see get_one_hot_backward
+_one_hot_backward_by_net = dict()
+
+
+def get_one_hot_backward(net):
+    '''returns the OneHotBackward engine of the net, so all the users of a net share its diff buffers'''
+
+    engine = _one_hot_backward_by_net.get(id(net))
+    if engine is None or engine.net is not net:
+        engine = OneHotBackward(net)
+        _one_hot_backward_by_net[id(net)] = engine
+    return engine
+
+
 def get_max_data_extent(net, settings, layer_name, is_spatial):
     '''Gets the maximum size of the data layer that can influence a unit on layer.'''
 
@@ -220,6 +434,50 @@ def compute_data_layer_focus_area(is_spatial, ii, jj, settings, layer_name, size
     return [out_ii_start, out_ii_end, out_jj_start, out_jj_end, data_ii_start, data_ii_end, data_jj_start, data_jj_end]
 
 
+def compute_data_layer_focus_areas(is_spatial, ii, jj, settings, layer_name, size_ii, size_jj, data_size_ii, data_size_jj):
+    '''
+    compute_data_layer_focus_area for arrays of locations at once
+    :param ii: array of rows of units in the layer
+    :param jj: array of columns of units in the layer
+    :return: list of arrays out_ii_start, out_ii_end, out_jj_start, out_jj_end, data_ii_start, data_ii_end,
+             data_jj_start, data_jj_end, with the shape of ii and jj
+    '''
+
+    ii = np.asarray(ii, dtype=np.int64)
+    jj = np.asarray(jj, dtype=np.int64)
+
+    if is_spatial:
+
+        # Compute the focus area of the data layer
+        data_ii_start, data_ii_end, data_jj_start, data_jj_end = \
+            RegionComputer.get_region_map(settings, layer_name, 'input').convert_units(ii, jj)
+
+        # safe guard edges
+        data_ii_start = np.maximum(data_ii_start, 0)
+        data_jj_start = np.maximum(data_jj_start, 0)
+        data_ii_end = np.minimum(data_ii_end, data_size_ii)
+        data_jj_end = np.minimum(data_jj_end, data_size_jj)
+
+        touching_imin = (data_ii_start == 0)
+        touching_jmin = (data_jj_start == 0)
+
+        # Compute how much of the data slice falls outside the actual data [0,max] range
+        ii_outside = size_ii - (data_ii_end - data_ii_start)  # possibly 0
+        jj_outside = size_jj - (data_jj_end - data_jj_start)  # possibly 0
+
+        out_ii_start = np.where(touching_imin, ii_outside, 0)
+        out_ii_end = np.where(touching_imin, size_ii, size_ii - ii_outside)
+        out_jj_start = np.where(touching_jmin, jj_outside, 0)
+        out_jj_end = np.where(touching_jmin, size_jj, size_jj - jj_outside)
+
+    else:
+        zeros = np.zeros(ii.shape, dtype=np.int64)
+        data_ii_start, out_ii_start, data_jj_start, out_jj_start = zeros, zeros, zeros, zeros
+        data_ii_end, out_ii_end, data_jj_end, out_jj_end = zeros + size_ii, zeros + size_ii, zeros + size_jj, zeros + size_jj
+
+    return [out_ii_start, out_ii_end, out_jj_start, out_jj_end, data_ii_start, data_ii_end, data_jj_start, data_jj_end]
+
+
 def extract_patch_from_image(data, net, selected_input_index, settings,
                              data_ii_end, data_ii_start, data_jj_end, data_jj_start,
                              out_ii_end, out_ii_start, out_jj_end, out_jj_start, size_ii, size_jj):
@@ -12,25 +12,28 @@ import cv2
 import numpy as np
 import StringIO
 
-from find_maxes.find_max_acts import load_max_tracker_from_file
+from find_maxes.max_tracker_store import load_max_tracker_results
+from find_maxes.patch_atlas import load_patch_atlas
 import find_maxes.max_tracker
 sys.modules['max_tracker'] = find_maxes.max_tracker
+sys.modules['activation_stats'] = find_maxes.activation_stats
+sys.modules['seen_inputs'] = find_maxes.seen_inputs
 
 from misc import WithTimer, mkdir_p
 from numpy_cache import FIFOLimitedArrayCache
 from app_base import BaseApp
 from image_misc import norm01, norm01c, tile_images_normalize, ensure_float01, tile_images_make_tiles, \
     ensure_uint255_and_resize_to_fit, resize_without_fit, ensure_uint255, \
-    caffe_load_image, ensure_uint255_and_resize_without_fit, array_histogram, fig2data
+    caffe_load_image, ensure_uint255_and_resize_without_fit, array_histogram, fig2data, rasterize_histogram
 from image_misc import FormattedString, cv2_typeset_text, to_255
-from caffe_proc_thread import CaffeProcThread
+from caffe_proc_thread import CaffeProcThread, CaffeBackProcThread
 from caffevis_app_state import CaffeVisAppState, SiameseViewMode, PatternMode, BackpropMode, BackpropViewOption, \
     ColorMapOption, InputOverlayOption
 from caffevis_helper import get_pretty_layer_name, read_label_file, load_sprite_image, load_square_sprite_image, \
-    set_mean, get_image_from_files
+    set_mean, get_image_from_files, get_image_from_patch_atlas
 from caffe_misc import layer_name_to_top_name, save_caffe_image
 from siamese_helper import SiameseHelper
-from settings_misc import load_network, get_receptive_field
+from settings_misc import load_network, load_shared_network, get_receptive_field
 
 
 class CaffeVisApp(BaseApp):
@@ -51,6 +54,20 @@ class CaffeVisApp(BaseApp):
         self.net.blobs[self.net.inputs[0]].reshape(*current_input_shape)
         self.net.reshape()
 
+        # second instance of the net, sharing its weights, for running backward on a separate thread
+        self.back_net = None
+        if settings.caffevis_separate_back_net:
+            self.back_net = load_shared_network(settings, self.net)
+            self.back_net.blobs[self.back_net.inputs[0]].reshape(*current_input_shape)
+            self.back_net.reshape()
+
+        # another instance, for precomputing the activations of the static files next to the current one
+        self.prefetch_net = None
+        if settings.caffevis_static_prefetch_count > 0:
+            self.prefetch_net = load_shared_network(settings, self.net)
+            self.prefetch_net.blobs[self.prefetch_net.inputs[0]].reshape(*current_input_shape)
+            self.prefetch_net.reshape()
+
         self._net_channel_swap = settings._calculated_channel_swap
 
         if self._net_channel_swap is None:
@@ -62,6 +79,8 @@ class CaffeVisApp(BaseApp):
         if self.settings.caffevis_labels:
             self.labels = read_label_file(self.settings.caffevis_labels)
         self.proc_thread = None
+        self.back_proc_thread = None
+        self.prefetch_thread = None
         self.jpgvis_thread = None
         self.handled_frames = 0
         if settings.caffevis_jpg_cache_size < 10*1024**2:
@@ -73,6 +92,7 @@ class CaffeVisApp(BaseApp):
 
     def start(self, live_vis):
         from jpg_vis_loading_thread import JPGVisLoadingThread
+        from static_prefetch_thread import StaticPrefetchThread
 
         self.live_vis = live_vis
         self.state = CaffeVisAppState(self.net, self.settings, self.bindings, live_vis)
@@ -82,28 +102,54 @@ class CaffeVisApp(BaseApp):
         if self.proc_thread is None or not self.proc_thread.is_alive():
             # Start thread if it's not already running
             self.proc_thread = CaffeProcThread(self.settings, self.net, self.state,
-                                               self.settings.caffevis_frame_wait_sleep,
                                                self.settings.caffevis_pause_after_keys,
                                                self.settings.caffevis_heartbeat_required,
-                                               self.settings.caffevis_mode_gpu)
+                                               self.settings.caffevis_mode_gpu,
+                                               self.back_net is not None,
+                                               live_vis.static_input_cache)
             self.proc_thread.start()
 
+        if self.back_net is not None and (self.back_proc_thread is None or not self.back_proc_thread.is_alive()):
+            # Start thread if it's not already running
+            self.back_proc_thread = CaffeBackProcThread(self.settings, self.back_net, self.state,
+                                                        self.settings.caffevis_pause_after_keys,
+                                                        self.settings.caffevis_heartbeat_required,
+                                                        self.settings.caffevis_mode_gpu,
+                                                        live_vis.static_input_cache)
+            self.back_proc_thread.start()
+
+        if self.prefetch_net is not None and live_vis.static_input_cache is not None and \
+                (self.prefetch_thread is None or not self.prefetch_thread.is_alive()):
+            # Start thread if it's not already running
+            self.prefetch_thread = StaticPrefetchThread(self.settings, self.prefetch_net, self.state,
+                                                        live_vis.input_updater, live_vis.static_input_cache,
+                                                        self.settings.caffevis_static_prefetch_count,
+                                                        self.settings.caffevis_pause_after_keys,
+                                                        self.settings.caffevis_heartbeat_required,
+                                                        self.settings.caffevis_mode_gpu)
+            self.prefetch_thread.start()
+
         if self.jpgvis_thread is None or not self.jpgvis_thread.is_alive():
             # Start thread if it's not already running
             self.jpgvis_thread = JPGVisLoadingThread(self.settings, self.state, self.img_cache,
-                                                     self.settings.caffevis_jpg_load_sleep,
                                                      self.settings.caffevis_heartbeat_required)
             self.jpgvis_thread.start()
                 
 
     def get_heartbeats(self):
-        return [self.proc_thread.heartbeat, self.jpgvis_thread.heartbeat]
+        heartbeats = [self.proc_thread.heartbeat, self.jpgvis_thread.heartbeat]
+        if self.back_proc_thread is not None:
+            heartbeats.append(self.back_proc_thread.heartbeat)
+        if self.prefetch_thread is not None:
+            heartbeats.append(self.prefetch_thread.heartbeat)
+        return heartbeats
             
     def quit(self):
         print 'CaffeVisApp: trying to quit'
 
         with self.state.lock:
             self.state.quit = True
+            self.state.notify_state_changed()
 
         if self.proc_thread != None:
             for ii in range(3):
@@ -113,13 +159,22 @@ class CaffeVisApp(BaseApp):
             if self.proc_thread.is_alive():
                 raise Exception('CaffeVisApp: Could not join proc_thread; giving up.')
             self.proc_thread = None
+
+        if self.back_proc_thread != None:
+            for ii in range(3):
+                self.back_proc_thread.join(1)
+                if not self.back_proc_thread.is_alive():
+                    break
+            if self.back_proc_thread.is_alive():
+                raise Exception('CaffeVisApp: Could not join back_proc_thread; giving up.')
+            self.back_proc_thread = None
                 
         print 'CaffeVisApp: quitting.'
         
     def _can_skip_all(self, panes):
         return ('caffevis_layers' not in panes.keys())
         
-    def handle_input(self, input_image, input_label, input_filename, panes):
+    def handle_input(self, input_image, input_label, input_filename, panes, input_key = None):
         if self.debug_level > 1:
             print 'handle_input: frame number', self.handled_frames, 'is', 'None' if input_image is None else 'Available'
         self.handled_frames += 1
@@ -130,12 +185,14 @@ class CaffeVisApp(BaseApp):
             if self.debug_level > 1:
                 print 'CaffeVisApp.handle_input: pushed frame'
             self.state.next_frame = input_image
+            self.state.next_frame_key = input_key
             self.state.next_label = input_label
             self.state.next_filename = input_filename
             if self.debug_level > 1:
                 print 'CaffeVisApp.handle_input: caffe_net_state is:', self.state.caffe_net_state
 
             self.state.last_frame = input_image
+            self.state.notify_state_changed()
     
     def redraw_needed(self):
         return self.state.redraw_needed()
@@ -152,6 +209,10 @@ class CaffeVisApp(BaseApp):
             # print 'CaffeProcThread.draw: caffe_net_state is:', self.state.caffe_net_state
             if do_draw:
                 self.state.caffe_net_state = 'draw'
+                # Diffs are drawn from the latest snapshot published by the backward thread, when it runs separately
+                self.back_net_to_draw = self.net if self.state.back_net_snapshot is None else self.state.back_net_snapshot
+                # Activations of layers forward has not reached yet are shown as stale until the net is extended to them
+                self.forward_stale_to_draw = self.state.is_forward_stale()
 
         if do_draw:
             if self.debug_level > 1:
@@ -180,6 +241,7 @@ class CaffeVisApp(BaseApp):
             with self.state.lock:
                 self.state.drawing_stale = False
                 self.state.caffe_net_state = 'free'
+                self.state.notify_state_changed()
         return do_draw
 
     def _draw_prob_labels_pane(self, pane):
@@ -188,6 +250,9 @@ class CaffeVisApp(BaseApp):
         if not self.labels or not self.state.show_label_predictions or not self.settings.caffevis_prob_layer:
             return
 
+        if self.forward_stale_to_draw:
+            return
+
         #pane.data[:] = to_255(self.settings.window_background)
         defaults = {'face':  getattr(cv2, self.settings.caffevis_class_face),
                     'fsize': self.settings.caffevis_class_fsize,
@@ -446,7 +511,7 @@ class CaffeVisApp(BaseApp):
 
             if self.state.layers_show_back:
 
-                layer_dat_3D_0, layer_dat_3D_1 = self.state.get_siamese_selected_diff_blobs(self.net)
+                layer_dat_3D_0, layer_dat_3D_1 = self.state.get_siamese_selected_diff_blobs(self.back_net_to_draw)
             else:
                 layer_dat_3D_0, layer_dat_3D_1 = self.state.get_siamese_selected_data_blobs(self.net)
 
@@ -470,7 +535,7 @@ class CaffeVisApp(BaseApp):
 
         else:
             if self.state.layers_show_back:
-                layer_dat_3D = self.state.get_single_selected_diff_blob(self.net)
+                layer_dat_3D = self.state.get_single_selected_diff_blob(self.back_net_to_draw)
             else:
                 layer_dat_3D = self.state.get_single_selected_data_blob(self.net)
 
@@ -515,7 +580,7 @@ class CaffeVisApp(BaseApp):
                 elif self.settings.caffevis_outputs_dir_folder_format == 'max_tracker_output':
                     display_2D, display_3D, display_3D_highres, is_layer_summary_loaded = self.load_pattern_images_optimizer_format(
                         default_layer_name, layer_dat_3D, n_tiles, pane, tile_cols, tile_rows,
-                        self.state.pattern_first_only, file_search_pattern='maxim*.png')
+                        self.state.pattern_first_only, file_search_pattern='maxim*.png', patch_kind='maxim')
 
             elif self.state.pattern_mode == PatternMode.WEIGHTS_HISTOGRAM:
                 display_2D, display_3D, display_3D_highres, is_layer_summary_loaded = self.load_weights_histograms(
@@ -563,6 +628,8 @@ class CaffeVisApp(BaseApp):
                                                                     boost_indiv = self.state.layer_boost_indiv,
                                                                     boost_gamma = self.state.layer_boost_gamma,
                                                                     neg_pos_colors = ((1,0,0), (0,1,0)))
+            elif self.forward_stale_to_draw:
+                layer_dat_3D_normalized = np.tile(self.settings.stale_background, layer_dat_3D.shape + (1,))
             else:
                 layer_dat_3D_normalized = tile_images_normalize(layer_dat_3D,
                                                                 boost_indiv = self.state.layer_boost_indiv,
@@ -649,12 +716,12 @@ class CaffeVisApp(BaseApp):
             if self.state.show_maximal_score:
                 if self.state.siamese_view_mode_has_two_images():
                     if self.state.layers_show_back:
-                        blob1, blob2 = self.state.get_siamese_selected_diff_blobs(self.net)
+                        blob1, blob2 = self.state.get_siamese_selected_diff_blobs(self.back_net_to_draw)
 
                         if len(blob1.shape) == 1:
                             value1, value2 = blob1[self.state.selected_unit], blob2[self.state.selected_unit]
                             text_to_display += 'grad: ' + str(value1) + " " + str(value2)
-                    else:
+                    elif not self.forward_stale_to_draw:
                         blob1, blob2 = self.state.get_siamese_selected_data_blobs(self.net)
 
                         if len(blob1.shape) == 1:
@@ -663,12 +730,12 @@ class CaffeVisApp(BaseApp):
 
                 else:
                     if self.state.layers_show_back:
-                        blob = self.state.get_single_selected_diff_blob(self.net)
+                        blob = self.state.get_single_selected_diff_blob(self.back_net_to_draw)
 
                         if len(blob.shape) == 1:
                             value = blob[self.state.selected_unit]
                             text_to_display += 'grad: ' + str(value)
-                    else:
+                    elif not self.forward_stale_to_draw:
                         blob = self.state.get_single_selected_data_blob(self.net)
 
                         if len(blob.shape) == 1:
@@ -707,7 +774,8 @@ class CaffeVisApp(BaseApp):
         return display_2D, display_3D, display_3D_highres, is_layer_summary_loaded
 
     def load_pattern_images_optimizer_format(self, default_layer_name, layer_dat_3D, n_tiles, pane,
-                                            tile_cols, tile_rows, first_only, file_search_pattern, show_layer_summary = False, file_summary_pattern = ""):
+                                            tile_cols, tile_rows, first_only, file_search_pattern, show_layer_summary = False, file_summary_pattern = "",
+                                            patch_kind = None):
         is_layer_summary_loaded = False
         display_2D = None
         display_3D_highres = None
@@ -719,7 +787,7 @@ class CaffeVisApp(BaseApp):
             # get number of units
             units_num = layer_dat_3D.shape[0]
 
-            pattern_image_key = (self.settings.caffevis_outputs_dir, load_layer, "unit_%04d", units_num, file_search_pattern, first_only, show_layer_summary, file_summary_pattern)
+            pattern_image_key = (self.settings.caffevis_outputs_dir, load_layer, "unit_%04d", units_num, file_search_pattern, first_only, show_layer_summary, file_summary_pattern, patch_kind)
 
             # Get highres version
             display_3D_highres = self.img_cache.get(pattern_image_key, None)
@@ -746,7 +814,7 @@ class CaffeVisApp(BaseApp):
                             else:
                                 with WithTimer('CaffeVisApp:load_image_per_unit', quiet=self.debug_level < 1):
                                     # load all images
-                                    display_3D_highres = self.load_image_per_unit(display_3D_highres, load_layer, units_num, first_only, resize_shape, file_search_pattern)
+                                    display_3D_highres = self.load_image_per_unit(display_3D_highres, load_layer, units_num, first_only, resize_shape, file_search_pattern, patch_kind)
 
                 except IOError:
                     # File does not exist, so just display disabled.
@@ -764,10 +832,17 @@ class CaffeVisApp(BaseApp):
         display_3D = self.downsample_display_3d(display_3D_highres, layer_dat_3D, pane, tile_cols, tile_rows)
         return display_2D, display_3D, display_3D_highres, is_layer_summary_loaded
 
-    def load_image_per_unit(self, display_3D_highres, load_layer, units_num, first_only, resize_shape, file_search_pattern):
+    def load_image_per_unit(self, display_3D_highres, load_layer, units_num, first_only, resize_shape, file_search_pattern, patch_kind = None):
+
+        # patches packed by crop_max_patches into a patch atlas are read from memory mapped arrays, without per unit files
+        patch_atlas = None
+        if patch_kind is not None:
+            patch_atlas = load_patch_atlas(self.settings.caffevis_outputs_dir, load_layer)
+            if patch_atlas is not None and not patch_atlas.has_kind(patch_kind):
+                patch_atlas = None
 
         # limit loading
-        if units_num > 1000:
+        if units_num > 1000 and patch_atlas is None:
             print "WARNING: load_image_per_unit was asked to load %d units, aborted to avoid hang" % (units_num)
             return None
 
@@ -780,7 +855,10 @@ class CaffeVisApp(BaseApp):
                 if unit_id % 10 == 0:
                     print "loading %s images for layer %s channel %d out of %d" % (file_search_pattern, load_layer, unit_id, units_num)
 
-                unit_first_image = get_image_from_files(self.settings, unit_folder_path, False, resize_shape, first_only)
+                if patch_atlas is not None:
+                    unit_first_image = get_image_from_patch_atlas(self.settings, patch_atlas, patch_kind, unit_id, False, resize_shape, first_only)
+                else:
+                    unit_first_image = get_image_from_files(self.settings, unit_folder_path, False, resize_shape, first_only)
 
                 # handle first generation of results container
                 if display_3D_highres is None:
@@ -843,17 +921,49 @@ class CaffeVisApp(BaseApp):
                 cache_layer_weights_histogram_image_path = os.path.join(folder_path, 'layer_weights_histogram.png')
                 cache_details_weights_histogram_image_path = os.path.join(folder_path, 'details_weights_histogram.png')
 
+            use_matplotlib = (self.settings.caffevis_histograms_renderer == 'matplotlib')
+            unit_shape = (self.settings.caffevis_histograms_unit_size, self.settings.caffevis_histograms_unit_size)
+
             # plotting objects needed for
             # 1. calculating size of results array
             # 2. generating weights histogram for selected unit
             # 3. generating weights histograms for all units
 
-            import matplotlib.pyplot as plt
+            if use_matplotlib:
+                import matplotlib.pyplot as plt
+
+                fig = plt.figure(figsize=(10, 10), facecolor='white', tight_layout=False)
+                ax = fig.add_subplot(111)
+
+            def draw_histogram(hist, bin_edges, title, xlabel, ylabel, out_shape = None, out = None):
+                '''
+                draws a histogram with the selected renderer
+                :param out_shape: shape of the image, None keeps the figure size of matplotlib, or the unit size of the rasterizer
+                :param out: preallocated image to draw into, or None
+                '''
+
+                if not use_matplotlib:
+                    return rasterize_histogram(hist, bin_edges, out_shape if out_shape is not None else unit_shape,
+                                               title, xlabel, ylabel, out = out)
+
+                width = 0.7 * (bin_edges[1] - bin_edges[0])
+                center = (bin_edges[:-1] + bin_edges[1:]) / 2
+                ax.bar(center, hist, align='center', width=width, color='g')
+
+                fig.suptitle(title)
+                ax.xaxis.label.set_text(xlabel)
+                ax.yaxis.label.set_text(ylabel)
+
+                figure_buffer = fig2data(fig)
+                ax.cla()
 
-            fig = plt.figure(figsize=(10, 10), facecolor='white', tight_layout=False)
-            ax = fig.add_subplot(111)
+                if out_shape is not None:
+                    figure_buffer = ensure_uint255_and_resize_without_fit(figure_buffer, out_shape)
+                if out is not None:
+                    out[:] = figure_buffer
+                return figure_buffer
 
-            def calculate_weights_histogram_for_specific_unit(channel_idx, fig, ax, do_print):
+            def calculate_weights_histogram_for_specific_unit(channel_idx, do_print):
 
                 if do_print and channel_idx % 10 == 0:
                     print "calculating weights histogram for layer %s channel %d out of %d" % (layer_name, channel_idx, n_channels)
@@ -865,28 +975,18 @@ class CaffeVisApp(BaseApp):
                 # create histogram
                 hist, bin_edges = np.histogram(weights, bins=50)
 
-                # generate histogram image file
-                width = 0.7 * (bin_edges[1] - bin_edges[0])
-                center = (bin_edges[:-1] + bin_edges[1:]) / 2
-
-                ax.bar(center, hist, align='center', width=width, color='g')
-
-                fig.suptitle('weights for unit %d, bias is %f' % (channel_idx, bias))
-                ax.xaxis.label.set_text('weight value')
-                ax.yaxis.label.set_text('count')
-
-                figure_buffer = fig2data(fig)
-
-                display_3D_highres[channel_idx, :, ::] = figure_buffer
-
-                ax.cla()
+                # generate histogram image
+                draw_histogram(hist, bin_edges, 'weights for unit %d, bias is %f' % (channel_idx, bias), 'weight value', 'count',
+                               out = display_3D_highres[channel_idx])
 
 
             try:
 
                 # handle generation of results container
-                figure_buffer = fig2data(fig)
-                first_shape = figure_buffer.shape
+                if use_matplotlib:
+                    first_shape = fig2data(fig).shape
+                else:
+                    first_shape = unit_shape + (3,)
                 display_3D_highres = np.zeros((n_channels, first_shape[0], first_shape[1], first_shape[2]), dtype=np.uint8)
 
                 # try load from cache
@@ -912,7 +1012,7 @@ class CaffeVisApp(BaseApp):
                         display_2D = caffe_load_image(cache_details_weights_histogram_image_path, color=True, as_uint=False)
 
                         # calculate weights histogram for selected unit
-                        calculate_weights_histogram_for_specific_unit(self.state.selected_unit, fig, ax, do_print=False)
+                        calculate_weights_histogram_for_specific_unit(self.state.selected_unit, do_print=False)
 
                         display_3D = self.downsample_display_3d(display_3D_highres, layer_dat_3D, pane, tile_cols, tile_rows)
 
@@ -948,34 +1048,14 @@ class CaffeVisApp(BaseApp):
                         # generate weights histogram for layer
                         weights = net.params[layer_name][0].data.flatten()
                         hist, bin_edges = np.histogram(weights, bins=50)
-
-                        width = 0.7 * (bin_edges[1] - bin_edges[0])
-                        center = (bin_edges[:-1] + bin_edges[1:]) / 2
-                        ax.bar(center, hist, align='center', width=width, color='g')
-
-                        fig.suptitle('weights for layer %s' % layer_name)
-                        ax.xaxis.label.set_text('weight value')
-                        ax.yaxis.label.set_text('count')
-
-                        figure_buffer = fig2data(fig)
-                        display_3D_highres_summary_weights = ensure_uint255_and_resize_without_fit(figure_buffer, half_pane_shape)
-
-                        ax.cla()
+                        display_3D_highres_summary_weights = draw_histogram(hist, bin_edges, 'weights for layer %s' % layer_name,
+                                                                            'weight value', 'count', out_shape=half_pane_shape)
 
                         # generate bias histogram for layer
                         bias = net.params[layer_name][1].data.flatten()
                         hist, bin_edges = np.histogram(bias, bins=50)
-
-                        width = 0.7 * (bin_edges[1] - bin_edges[0])
-                        center = (bin_edges[:-1] + bin_edges[1:]) / 2
-                        ax.bar(center, hist, align='center', width=width, color='g')
-
-                        fig.suptitle('bias for layer %s' % layer_name)
-                        ax.xaxis.label.set_text('bias value')
-                        ax.yaxis.label.set_text('count')
-
-                        figure_buffer = fig2data(fig)
-                        display_3D_highres_summary_bias = ensure_uint255_and_resize_without_fit(figure_buffer, half_pane_shape)
+                        display_3D_highres_summary_bias = draw_histogram(hist, bin_edges, 'bias for layer %s' % layer_name,
+                                                                         'bias value', 'count', out_shape=half_pane_shape)
 
                         display_3D_highres_summary = np.concatenate((display_3D_highres_summary_weights, display_3D_highres_summary_bias), axis=1)
                         display_3D_highres_summary = np.expand_dims(display_3D_highres_summary, 0)
@@ -994,7 +1074,7 @@ class CaffeVisApp(BaseApp):
 
                         # for each channel
                         for channel_idx in xrange(n_channels):
-                            calculate_weights_histogram_for_specific_unit(channel_idx, fig, ax, do_print=True)
+                            calculate_weights_histogram_for_specific_unit(channel_idx, do_print=True)
 
                         display_3D = self.downsample_display_3d(display_3D_highres, layer_dat_3D, pane, tile_cols, tile_rows)
 
@@ -1023,8 +1103,9 @@ class CaffeVisApp(BaseApp):
                 self.img_cache.set(pattern_image_key_3d, display_3D_highres)
                 self.img_cache.set(pattern_image_key_2d, display_2D)
 
-            fig.clf()
-            plt.close(fig)
+            if use_matplotlib:
+                fig.clf()
+                plt.close(fig)
 
         else:
             # here we can safely assume that display_2D is not None, so we only need to check if show_layer_summary was requested
@@ -1161,19 +1242,18 @@ class CaffeVisApp(BaseApp):
 
         if display_3D_highres is None:
             try:
-                # load pickle file
-                net_max_tracker = load_max_tracker_from_file(maximum_activation_histogram_data_file)
+                # load columnar store, only the arrays of this layer are read. falls back to the pickle file
+                net_max_tracker = load_max_tracker_results(maximum_activation_histogram_data_file)
 
                 if not net_max_tracker.max_trackers.has_key(default_layer_name):
                     return display_2D, empty_display_3D, empty_display_3D, is_layer_summary_loaded
 
-                # check if
-                if not hasattr(net_max_tracker.max_trackers[default_layer_name], 'channel_to_histogram'):
-                    print "ERROR: file %s is missing the field channel_to_histogram, try rerun find_max_acts to generate it" % (maximum_activation_histogram_data_file)
+                # check if histograms are available
+                channel_to_histogram = net_max_tracker.max_trackers[default_layer_name].get_channel_histograms()
+                if channel_to_histogram is None:
+                    print "ERROR: file %s is missing histogram data, try rerun find_max_acts to generate it" % (maximum_activation_histogram_data_file)
                     return display_2D, empty_display_3D, empty_display_3D, is_layer_summary_loaded
 
-                channel_to_histogram = net_max_tracker.max_trackers[default_layer_name].channel_to_histogram
-
                 def channel_to_histogram_values(channel_idx):
 
                     # get channel data
@@ -1183,6 +1263,12 @@ class CaffeVisApp(BaseApp):
 
                 display_3D_highres_list = [display_3D_highres, display_3D_highres]
 
+                if self.settings.caffevis_histograms_renderer != 'matplotlib':
+                    unit_shape = (self.settings.caffevis_histograms_unit_size, self.settings.caffevis_histograms_unit_size)
+                    channel_images, layer_image = find_maxes.max_tracker.rasterize_max_histograms(default_layer_name, channel_to_histogram,
+                                                                                                  unit_shape, pane_shape)
+                    display_3D_highres_list = [channel_images, np.expand_dims(layer_image, 0)]
+
                 def process_channel_figure(channel_idx, fig):
                     figure_buffer = fig2data(fig)
 
@@ -1202,8 +1288,9 @@ class CaffeVisApp(BaseApp):
                     display_3D_highres_list[1] = np.expand_dims(display_3D_highres_list[1], 0)
                     pass
 
-                n_channels = len(channel_to_histogram)
-                find_maxes.max_tracker.prepare_max_histogram(default_layer_name, n_channels, channel_to_histogram_values, process_channel_figure, process_layer_figure)
+                if self.settings.caffevis_histograms_renderer == 'matplotlib':
+                    n_channels = len(channel_to_histogram)
+                    find_maxes.max_tracker.prepare_max_histogram(default_layer_name, n_channels, channel_to_histogram_values, process_channel_figure, process_layer_figure)
 
                 pattern_image_key_layer = (maximum_activation_histogram_data_file, default_layer_name, "max histograms",True)
                 pattern_image_key_details = (maximum_activation_histogram_data_file, default_layer_name, "max histograms",False)
@@ -1376,7 +1463,7 @@ class CaffeVisApp(BaseApp):
                 # if selection is frozen we use the currently selected layer as target for visualization
                 if self.state.backprop_selection_frozen:
                     if self.state.siamese_view_mode_has_two_images():
-                        grad_blob1, grad_blob2 = self.state.get_siamese_selected_diff_blobs(self.net)
+                        grad_blob1, grad_blob2 = self.state.get_siamese_selected_diff_blobs(self.back_net_to_draw)
 
                         if len(grad_blob1.shape) == 1:
                             no_spatial_info = True
@@ -1388,7 +1475,7 @@ class CaffeVisApp(BaseApp):
                         has_pair_inputs = True
 
                     else:
-                        grad_blob = self.state.get_single_selected_diff_blob(self.net)
+                        grad_blob = self.state.get_single_selected_diff_blob(self.back_net_to_draw)
                         if len(grad_blob.shape) == 1:
                             no_spatial_info = True
                         if len(grad_blob.shape) == 3:
@@ -1396,7 +1483,7 @@ class CaffeVisApp(BaseApp):
 
                 # if selection is not frozen we use the input layer as target for visualization
                 if (not self.state.backprop_selection_frozen) or no_spatial_info:
-                    grad_blob = self.net.blobs['data'].diff
+                    grad_blob = self.back_net_to_draw.blobs['data'].diff
 
                     grad_blob = grad_blob[0]  # bc01 -> c01
                     grad_blob = grad_blob.transpose((1, 2, 0))  # c01 -> 01c
@@ -1492,7 +1579,8 @@ class CaffeVisApp(BaseApp):
 
             elif back_view_option == BackpropViewOption.HISTOGRAM:
                 def do_histogram(grad_blob, resize_shape, input_image):
-                    return array_histogram(grad_blob, half_pane_shape, BackpropMode.to_string(back_mode)+' histogram', 'values', 'count')
+                    return array_histogram(grad_blob, half_pane_shape, BackpropMode.to_string(back_mode)+' histogram', 'values', 'count',
+                                           use_matplotlib=(self.settings.caffevis_histograms_renderer == 'matplotlib'))
 
                 half_pane_shape = (pane.data.shape[0],pane.data.shape[1]/2,3)
                 grad_img = run_processing_once_or_twice(pane.data.shape, do_histogram)
@@ -1530,6 +1618,7 @@ class CaffeVisApp(BaseApp):
                 # If img_resize is None, loading has not yet been attempted, so show stale image and request load by JPGVisLoadingThread
                 with self.state.lock:
                     self.state.jpgvis_to_load_key = img_key
+                    self.state.notify_state_changed()
                 pane.data[:] = to_255(self.settings.stale_background)
             elif img_resize.nbytes == 0:
                 # This is the sentinal value when the image is not
@@ -1548,6 +1637,8 @@ class CaffeVisApp(BaseApp):
 
     def handle_mouse_left_click(self, x, y, flags, param, panes):
         self.state.handle_mouse_left_click(x, y, flags, param, panes, self.header_boxes, self.buttons_boxes)
+        with self.state.lock:
+            self.state.notify_state_changed()
 
     def get_back_what_to_disp(self):
         '''Whether to show back diff information or stale or disabled indicator'''
@@ -1561,6 +1652,10 @@ class CaffeVisApp(BaseApp):
     def set_debug(self, level):
         self.debug_level = level
         self.proc_thread.debug_level = level
+        if self.back_proc_thread is not None:
+            self.back_proc_thread.debug_level = level
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.debug_level = level
         self.jpgvis_thread.debug_level = level
 
     def draw_help(self, help_pane, locy):
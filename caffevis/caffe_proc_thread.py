@@ -4,14 +4,167 @@ import numpy as np
 
 from codependent_thread import CodependentThread
 from misc import WithTimer
-from caffevis_helper import net_preproc_forward
+from caffevis_helper import net_preproc_forward, get_forward_end_idx, get_forward_blob_names, NetDiffsSnapshot, \
+    NetBlobsSnapshot
 from image_misc import resize_without_fit
 from caffevis_app_state import BackpropMode
+from siamese_helper import SiameseHelper
+
+
+def set_caffe_mode(mode_gpu, thread_name):
+    import caffe
+    # Set the mode to CPU or GPU. Note: in the latest Caffe
+    # versions, there is one Caffe object *per thread*, so the
+    # mode must be set per thread! Here we set the mode for the
+    # calling thread; it is also set in the main thread.
+    if mode_gpu:
+        caffe.set_mode_gpu()
+        print 'CaffeVisApp mode (in %s): GPU' % thread_name
+    else:
+        caffe.set_mode_cpu()
+        print 'CaffeVisApp mode (in %s): CPU' % thread_name
+
+
+def get_net_input(settings, state, frame, input_dims):
+    '''Resizes an input frame, or converts a pair of frames for siamese networks, to the input size of the net'''
+
+    if settings.is_siamese and ((type(frame), len(frame)) == (tuple, 2)):
+        return state.convert_image_pair_to_network_input_format(settings, frame, input_dims)
+    else:
+        return resize_without_fit(frame, input_dims)
+
+
+def run_back_pass(state, net, back_mode, backprop_layer_def, backprop_unit, debug_level):
+    '''Runs backward or deconv on net, from the given backprop unit, according to back_mode'''
+
+    if back_mode == BackpropMode.GRAD:
+        with WithTimer('CaffeProcThread:backward', quiet = debug_level < 1):
+            state.backward_from_layer(net, backprop_layer_def, backprop_unit)
+
+    elif back_mode == BackpropMode.DECONV_ZF:
+        with WithTimer('CaffeProcThread:deconv', quiet = debug_level < 1):
+            state.deconv_from_layer(net, backprop_layer_def, backprop_unit, 'Zeiler & Fergus')
+
+    elif back_mode == BackpropMode.DECONV_GB:
+        with WithTimer('CaffeProcThread:deconv', quiet = debug_level < 1):
+            state.deconv_from_layer(net, backprop_layer_def, backprop_unit, 'Guided Backprop')
+
+
+class CachedNetRunner(object):
+    '''Runs forward and backward on the net of a thread. The activations and diffs of static input images are
+    kept in the static input cache, and restored into the net instead of running forward or backward again when the
+    same image is seen again.
+
+    With settings.caffevis_truncate_forward, forward runs only up to the deepest of the layers it is given, and is
+    extended to deeper layers on the same frame when they are needed.'''
+
+    def __init__(self, settings, net, thread_name, static_input_cache = None):
+        self.settings = settings
+        self.net = net
+        self.input_dims = self.net.blobs['data'].data.shape[2:4]    # e.g. (227,227)
+        self.thread_name = thread_name
+        self.cache = static_input_cache
+        self.layer_names = list(self.net._layer_names)
+
+        # Frame whose activations are in the net, the index of the last layer they were computed up to, and up to
+        # which layer forward actually ran on it, -1 for none. Activations restored from the cache lack the internals
+        # of the layers which backward needs, e.g. the max pooling switches.
+        self.im_small = None
+        self.frame_key = None
+        self.end_idx = -1
+        self.forwarded_end_idx = -1
+
+    def _get_end_idx(self, layer_names):
+        if not self.settings.caffevis_truncate_forward or layer_names is None:
+            return len(self.layer_names) - 1
+        # forward runs at least the first layer, so the input blobs are set
+        return max(0, get_forward_end_idx(self.net, layer_names))
+
+    def _restore(self, key):
+        '''Restores the blobs cached under key into the net, returns the snapshot, or None if they were not cached'''
+        if self.cache is None or key is None:
+            return None
+        snapshot = self.cache.get(key)
+        if snapshot is not None:
+            snapshot.restore(self.net)
+        return snapshot
+
+    def _save(self, key, field):
+        if self.cache is None or key is None:
+            return
+        if field == 'data':
+            snapshot = NetBlobsSnapshot(self.net, field, get_forward_blob_names(self.net, self.end_idx), self.end_idx)
+        else:
+            snapshot = NetBlobsSnapshot(self.net, field)
+        self.cache.set(key, snapshot)
+
+    def _forward(self, end_idx, debug_level):
+        '''Runs forward on the frame from the first layer up to the layer at end_idx'''
+        with WithTimer('%s:forward' % self.thread_name, quiet = debug_level < 1):
+            net_preproc_forward(self.settings, self.net, self.im_small, self.input_dims, self.layer_names[end_idx])
+        self.end_idx = end_idx
+        self.forwarded_end_idx = end_idx
+
+    def _extend(self, end_idx, debug_level):
+        '''Runs forward on the frame from the layer after the last computed one up to the layer at end_idx'''
+        if self.end_idx < 0:
+            self._forward(end_idx, debug_level)
+            return
+        with WithTimer('%s:forward extend' % self.thread_name, quiet = debug_level < 1):
+            self.net.forward(start = self.layer_names[self.end_idx + 1], end = self.layer_names[end_idx])
+        if self.forwarded_end_idx == self.end_idx:
+            self.forwarded_end_idx = end_idx
+        self.end_idx = end_idx
+
+    def forward(self, im_small, frame_key, layer_names, debug_level):
+        ''':param frame_key: key of static input images in the cache, None for cam frames
+        :param layer_names: layers whose activations are needed, None for the whole net'''
+        self.im_small = im_small
+        self.frame_key = frame_key
+        self.end_idx = -1
+        self.forwarded_end_idx = -1
+
+        data_key = None if frame_key is None else ('data', frame_key)
+        snapshot = self._restore(data_key)
+        if snapshot is not None:
+            self.end_idx = len(self.layer_names) - 1 if snapshot.end_idx is None else snapshot.end_idx
+
+        end_idx = self._get_end_idx(layer_names)
+        if end_idx > self.end_idx:
+            self._extend(end_idx, debug_level)
+            self._save(data_key, 'data')
+
+    def needs_extend(self, layer_names):
+        '''Whether forward on the last frame has to be extended to compute the given layers'''
+        return self.im_small is not None and self._get_end_idx(layer_names) > self.end_idx
+
+    def extend(self, layer_names, debug_level):
+        '''Extends forward on the last frame, if needed to compute the given layers'''
+        if not self.needs_extend(layer_names):
+            return
+        self._extend(self._get_end_idx(layer_names), debug_level)
+        self._save(None if self.frame_key is None else ('data', self.frame_key), 'data')
+
+    def back(self, state, back_mode, backprop_layer_def, backprop_unit, siamese_view_mode, debug_level):
+        '''Runs backward or deconv from the given backprop unit on the last forwarded frame'''
+        back_key = None
+        if self.frame_key is not None:
+            back_key = ('diff', self.frame_key, back_mode, str(backprop_layer_def['name/s']), backprop_unit, siamese_view_mode)
+        if self._restore(back_key) is not None:
+            return
+
+        back_end_idx = self._get_end_idx(SiameseHelper.get_layer_names(backprop_layer_def))
+        if self.forwarded_end_idx < back_end_idx and self.im_small is not None:
+            self._forward(max(self.end_idx, back_end_idx), debug_level)
+        run_back_pass(state, self.net, back_mode, backprop_layer_def, backprop_unit, debug_level)
+        self._save(back_key, 'diff')
+
 
 class CaffeProcThread(CodependentThread):
     '''Runs Caffe in separate thread.'''
 
-    def __init__(self, settings, net, state, loop_sleep, pause_after_keys, heartbeat_required, mode_gpu):
+    def __init__(self, settings, net, state, pause_after_keys, heartbeat_required, mode_gpu, separate_back = False,
+                 static_input_cache = None):
         CodependentThread.__init__(self, heartbeat_required)
         self.daemon = True
         self.net = net
@@ -21,29 +174,20 @@ class CaffeProcThread(CodependentThread):
         self.last_process_elapsed = None
         self.frames_processed_fwd = 0
         self.frames_processed_back = 0
-        self.loop_sleep = loop_sleep
         self.pause_after_keys = pause_after_keys
         self.debug_level = 0
         self.mode_gpu = mode_gpu      # Needed so the mode can be set again in the spawned thread, because there is a separate Caffe object per thread.
         self.settings = settings
+        self.separate_back = separate_back    # True when backward runs on CaffeBackProcThread, which gets the forwarded frames
+        self.net_runner = CachedNetRunner(settings, net, 'CaffeProcThread', static_input_cache)
 
 
     def run(self):
         print 'CaffeProcThread.run called'
         frame = None
 
-        import caffe
-        # Set the mode to CPU or GPU. Note: in the latest Caffe
-        # versions, there is one Caffe object *per thread*, so the
-        # mode must be set per thread! Here we set the mode for the
-        # CaffeProcThread thread; it is also set in the main thread.
-        if self.mode_gpu:
-            caffe.set_mode_gpu()
-            print 'CaffeVisApp mode (in CaffeProcThread): GPU'
-        else:
-            caffe.set_mode_cpu()
-            print 'CaffeVisApp mode (in CaffeProcThread): CPU'
-        
+        set_caffe_mode(self.mode_gpu, 'CaffeProcThread')
+
         while not self.is_timed_out():
             with self.state.lock:
                 if self.state.quit:
@@ -60,21 +204,34 @@ class CaffeProcThread(CodependentThread):
 
                 frame = None
                 run_fwd = False
+                run_extend = False
                 run_back = False
                 if self.state.caffe_net_state == 'free' and time.time() - self.state.last_key_at > self.pause_after_keys:
                     frame = self.state.next_frame
+                    frame_key = self.state.next_frame_key
                     self.state.next_frame = None
+                    layer_names = self.state.get_forward_layer_names()
                     back_enabled = self.state.back_enabled
                     back_mode = self.state.back_mode
                     back_stale = self.state.back_stale
                     backprop_layer_def = self.state.get_current_backprop_layer_definition()
                     backprop_unit = self.state.backprop_unit
+                    siamese_view_mode = self.state.siamese_view_mode
 
                     # Forward should be run for every new frame
                     run_fwd = (frame is not None)
+                    # Forward should be extended if a deeper layer is shown than it was run to on the current frame
+                    run_extend = not run_fwd and self.net_runner.needs_extend(layer_names)
                     # Backward should be run if back_enabled and (there was a new frame OR back is stale (new backprop layer/unit selected))
-                    run_back = (back_enabled and (run_fwd or back_stale))
-                    self.state.caffe_net_state = 'proc' if (run_fwd or run_back) else 'free'
+                    run_back = (back_enabled and (run_fwd or back_stale)) and not self.separate_back
+                    self.state.caffe_net_state = 'proc' if (run_fwd or run_extend or run_back) else 'free'
+
+                if not (run_fwd or run_extend or run_back):
+                    # Nothing to do: wait until a new frame, a new backprop unit or the end of drawing
+                    # changes the state, or until the pause after the last key is over
+                    pause_left = self.pause_after_keys - (time.time() - self.state.last_key_at)
+                    self.state.state_changed.wait(pause_left if pause_left > 0 else None)
+                    continue
 
             #print 'run_fwd,run_back =', run_fwd, run_back
             
@@ -82,42 +239,36 @@ class CaffeProcThread(CodependentThread):
                 #print 'TIMING:, processing frame'
                 self.frames_processed_fwd += 1
 
-                if self.settings.is_siamese and ((type(frame), len(frame)) == (tuple, 2)):
-                    im_small = self.state.convert_image_pair_to_network_input_format(self.settings, frame, self.input_dims)
+                im_small = get_net_input(self.settings, self.state, frame, self.input_dims)
+                self.net_runner.forward(im_small, frame_key, layer_names, self.debug_level)
 
-                else:
-                    im_small = resize_without_fit(frame, self.input_dims)
+                if self.separate_back:
+                    # Hand the frame to the backward thread, replacing any frame it has not taken yet
+                    with self.state.lock:
+                        self.state.back_next_frame = im_small
+                        self.state.back_next_frame_key = frame_key
+                        self.state.notify_state_changed()
 
-                with WithTimer('CaffeProcThread:forward', quiet = self.debug_level < 1):
-                    net_preproc_forward(self.settings, self.net, im_small, self.input_dims)
+            if run_extend:
+                self.net_runner.extend(layer_names, self.debug_level)
 
             if run_back:
-
-                if back_mode == BackpropMode.GRAD:
-                    with WithTimer('CaffeProcThread:backward', quiet = self.debug_level < 1):
-                        self.state.backward_from_layer(self.net, backprop_layer_def, backprop_unit)
-
-                elif back_mode == BackpropMode.DECONV_ZF:
-                    with WithTimer('CaffeProcThread:deconv', quiet = self.debug_level < 1):
-                        self.state.deconv_from_layer(self.net, backprop_layer_def, backprop_unit, 'Zeiler & Fergus')
-
-                elif back_mode == BackpropMode.DECONV_GB:
-                    with WithTimer('CaffeProcThread:deconv', quiet=self.debug_level < 1):
-                        self.state.deconv_from_layer(self.net, backprop_layer_def, backprop_unit, 'Guided Backprop')
+                self.frames_processed_back += 1
+                self.net_runner.back(self.state, back_mode, backprop_layer_def, backprop_unit, siamese_view_mode, self.debug_level)
 
                 with self.state.lock:
                     self.state.back_stale = False
 
-            if run_fwd or run_back:
+            if run_fwd or run_extend or run_back:
                 with self.state.lock:
                     self.state.caffe_net_state = 'free'
+                    self.state.forward_end_idx = self.net_runner.end_idx
                     self.state.drawing_stale = True
+                self.state.wake_main_loop()
                 now = time.time()
                 if self.last_process_finished_at:
                     self.last_process_elapsed = now - self.last_process_finished_at
                 self.last_process_finished_at = now
-            else:
-                time.sleep(self.loop_sleep)
         
         print 'CaffeProcThread.run: finished'
         print 'CaffeProcThread.run: processed %d frames fwd, %d frames back' % (self.frames_processed_fwd, self.frames_processed_back)
@@ -132,3 +283,80 @@ class CaffeProcThread(CodependentThread):
             return 1.0 / (self.last_process_elapsed + 1e-6)
         else:
             return 0.0
+
+
+class CaffeBackProcThread(CodependentThread):
+    '''Runs Caffe backward or deconv in separate thread, on its own net which shares the weights of the net of
+    CaffeProcThread, so backward never delays the forward pass of the next frame. Each frame handed over by
+    CaffeProcThread is forwarded again on this net before backward, and the resulting diffs are published in
+    state.back_net_snapshot for drawing.'''
+
+    def __init__(self, settings, net, state, pause_after_keys, heartbeat_required, mode_gpu, static_input_cache = None):
+        CodependentThread.__init__(self, heartbeat_required)
+        self.daemon = True
+        self.net = net
+        self.input_dims = self.net.blobs['data'].data.shape[2:4]    # e.g. (227,227)
+        self.state = state
+        self.frames_processed_back = 0
+        self.pause_after_keys = pause_after_keys
+        self.debug_level = 0
+        self.mode_gpu = mode_gpu
+        self.settings = settings
+        self.net_runner = CachedNetRunner(settings, net, 'CaffeBackProcThread', static_input_cache)
+
+    def run(self):
+        print 'CaffeBackProcThread.run called'
+
+        set_caffe_mode(self.mode_gpu, 'CaffeBackProcThread')
+
+        # Latest frame taken from CaffeProcThread, and whether it still needs to be forwarded on this net
+        im_small = None
+        frame_key = None
+        run_fwd = False
+
+        while not self.is_timed_out():
+            with self.state.lock:
+                if self.state.quit:
+                    break
+
+                do_back = False
+                if time.time() - self.state.last_key_at > self.pause_after_keys:
+                    if self.state.back_next_frame is not None:
+                        im_small = self.state.back_next_frame
+                        frame_key = self.state.back_next_frame_key
+                        self.state.back_next_frame = None
+                        run_fwd = True
+                    back_enabled = self.state.back_enabled
+                    back_mode = self.state.back_mode
+                    back_stale = self.state.back_stale
+                    backprop_layer_def = self.state.get_current_backprop_layer_definition()
+                    backprop_unit = self.state.backprop_unit
+                    siamese_view_mode = self.state.siamese_view_mode
+
+                    # Backward should be run on the latest frame if back_enabled and (the frame is new OR back is stale)
+                    do_back = back_enabled and im_small is not None and (run_fwd or back_stale)
+
+                if not do_back:
+                    # Nothing to do: wait until a new frame or a new backprop unit changes the state, or until the
+                    # pause after the last key is over
+                    pause_left = self.pause_after_keys - (time.time() - self.state.last_key_at)
+                    self.state.state_changed.wait(pause_left if pause_left > 0 else None)
+                    continue
+
+            if run_fwd:
+                # Only the layers up to the backprop layer are needed on this net
+                self.net_runner.forward(im_small, frame_key, SiameseHelper.get_layer_names(backprop_layer_def), self.debug_level)
+                run_fwd = False
+
+            self.frames_processed_back += 1
+            self.net_runner.back(self.state, back_mode, backprop_layer_def, backprop_unit, siamese_view_mode, self.debug_level)
+            back_net_snapshot = NetDiffsSnapshot(self.net)
+
+            with self.state.lock:
+                self.state.back_net_snapshot = back_net_snapshot
+                self.state.back_stale = False
+                self.state.drawing_stale = True
+            self.state.wake_main_loop()
+
+        print 'CaffeBackProcThread.run: finished'
+        print 'CaffeBackProcThread.run: processed %d frames back' % self.frames_processed_back
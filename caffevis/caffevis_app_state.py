@@ -1,9 +1,11 @@
 import os
 import time
-from threading import Lock
+from threading import Lock, Condition
 from siamese_helper import SiameseViewMode, SiameseHelper
 from caffe_misc import layer_name_to_top_name
 from image_misc import get_tiles_height_width_ratio, gray_to_colormap
+from network_metadata_cache import get_network_metadata
+from caffevis_helper import get_forward_end_idx
 
 class PatternMode:
     OFF = 0
@@ -100,6 +102,7 @@ class CaffeVisAppState(object):
 
     def __init__(self, net, settings, bindings, live_vis):
         self.lock = Lock()  # State is accessed in multiple threads
+        self.state_changed = Condition(self.lock)  # CaffeProcThread and JPGVisLoadingThread wait on it for work
         self.settings = settings
         self.bindings = bindings
         self.net = net
@@ -117,6 +120,11 @@ class CaffeVisAppState(object):
         self.extra_msg = ''
         self.back_stale = True       # back becomes stale whenever the last back diffs were not computed using the current backprop unit and method (bprop or deconv)
         self.next_frame = None
+        self.next_frame_key = None    # key of next_frame in the static input cache, None for cam frames
+        self.back_next_frame = None   # latest forwarded frame, for the backward thread when backward runs separately
+        self.back_next_frame_key = None
+        self.back_net_snapshot = None # diffs published by the backward thread when backward runs separately
+        self.forward_end_idx = -1     # index of the last layer forward has run to on the current frame, published by CaffeProcThread
         self.next_label = None
         self.next_filename = None
         self.last_frame = None
@@ -129,7 +137,14 @@ class CaffeVisAppState(object):
     def _populate_net_blob_info(self, net):
         '''For each blob, save the number of filters and precompute
         tile arrangement (needed by CaffeVisAppState to handle keyboard navigation).
+        the blob info depends only on the network and the aspect ratio, and is kept in the network metadata cache
         '''
+        network_metadata = get_network_metadata(self.settings)
+        net_blob_info_by_aspect_ratio = network_metadata.get('net_blob_info', dict())
+        if self.settings.caffevis_layers_aspect_ratio in net_blob_info_by_aspect_ratio:
+            self.net_blob_info = net_blob_info_by_aspect_ratio[self.settings.caffevis_layers_aspect_ratio]
+            return
+
         self.net_blob_info = {}
         for key in net.blobs.keys():
             self.net_blob_info[key] = {}
@@ -148,6 +163,10 @@ class CaffeVisAppState(object):
             self.net_blob_info[key]['tile_rows'] = self.net_blob_info[key]['tiles_rc'][0]
             self.net_blob_info[key]['tile_cols'] = self.net_blob_info[key]['tiles_rc'][1]
 
+        net_blob_info_by_aspect_ratio[self.settings.caffevis_layers_aspect_ratio] = self.net_blob_info
+        network_metadata.set('net_blob_info', net_blob_info_by_aspect_ratio)
+        network_metadata.save()
+
     def get_headers(self):
 
         headers = list()
@@ -297,6 +316,7 @@ class CaffeVisAppState(object):
             self._ensure_valid_selected()
 
             self.drawing_stale = key_handled   # Request redraw any time we handled the key
+            self.notify_state_changed()
 
         return (None if key_handled else key)
 
@@ -472,12 +492,47 @@ class CaffeVisAppState(object):
         with self.lock:
             return self.drawing_stale
 
+    def notify_state_changed(self):
+        '''Wakes the threads waiting for work, e.g. after a new frame, a new backprop unit or a jpg to load was set.
+        Must be called with the lock held.'''
+        self.state_changed.notify_all()
+
+    def wake_main_loop(self):
+        '''Wakes the main loop of LiveVis, e.g. after another thread made the drawing stale'''
+        self.live_vis.wake_main_loop()
+
     def get_current_layer_definition(self):
         return self.settings.layers_list[self.layer_idx]
 
     def get_current_backprop_layer_definition(self):
         return self.settings.layers_list[self.backprop_layer_idx]
 
+    def get_forward_layer_names(self):
+        '''Returns the names of the layers whose activations are drawn or backpropagated from, which forward has to
+        compute. Must be called with the lock held.'''
+
+        layer_defs = [self.get_current_layer_definition()]
+        if self.back_enabled:
+            layer_defs.append(self.get_current_backprop_layer_definition())
+
+        layer_names = []
+        for layer_def in layer_defs:
+            layer_names.extend(SiameseHelper.get_layer_names(layer_def))
+
+        # class predictions are drawn in the aux pane while the cursor is on the layers
+        if self.show_label_predictions and self.cursor_area == 'top' and self.settings.caffevis_labels and self.settings.caffevis_prob_layer:
+            layer_names.append(self.settings.caffevis_prob_layer)
+
+        return layer_names
+
+    def is_forward_stale(self):
+        '''Whether forward has not yet run to the layers returned by get_forward_layer_names, so their blobs still hold
+        activations of a previous frame. Must be called with the lock held.'''
+
+        if not self.settings.caffevis_truncate_forward:
+            return False
+        return max(0, get_forward_end_idx(self.net, self.get_forward_layer_names())) > self.forward_end_idx
+
     def get_single_selected_data_blob(self, net, layer_def = None):
 
         # if no layer specified, get current layer
@@ -9,7 +9,8 @@ from image_misc import get_tiles_height_width, caffe_load_image, ensure_uint255_
     cv2_typeset_text, to_255
 
 
-def net_preproc_forward(settings, net, img, data_hw):
+def net_preproc_forward(settings, net, img, data_hw, end = None):
+    ''':param end: name of the last layer to run, None to run the whole net'''
 
     if settings.is_siamese and img.shape[2] == 6:
         appropriate_shape = data_hw + (6,)
@@ -23,11 +24,79 @@ def net_preproc_forward(settings, net, img, data_hw):
 
     data_blob = net.transformer.preprocess('data', img)                # e.g. (3, 227, 227), mean subtracted and scaled to [0,255]
     data_blob = data_blob[np.newaxis,:,:,:]                   # e.g. (1, 3, 227, 227)
-    output = net.forward(data=data_blob)
+    output = net.forward(data=data_blob, end=end)
 
     return output
 
 
+def get_forward_end_idx(net, layer_names):
+    '''Returns the index in net._layer_names of the last layer forward must run, so the blobs of all the given layers
+    are computed, including the in-place layers which follow them, e.g. relu. Net inputs need no layer, -1 is returned
+    when no layer is needed. Names which are not layers of the net require the whole net.'''
+
+    all_layer_names = list(net._layer_names)
+    end_idx = -1
+    for layer_name in layer_names:
+        if layer_name in net.inputs:
+            continue
+        if layer_name not in all_layer_names:
+            return len(all_layer_names) - 1
+        end_idx = max(end_idx, all_layer_names.index(layer_name))
+
+    while end_idx + 1 < len(all_layer_names):
+        next_layer_name = all_layer_names[end_idx + 1]
+        if not (len(net.top_names[next_layer_name]) == 1 and len(net.bottom_names[next_layer_name]) == 1 and
+                net.top_names[next_layer_name][0] == net.bottom_names[next_layer_name][0]):
+            break
+        end_idx += 1
+
+    return end_idx
+
+
+def get_forward_blob_names(net, end_idx):
+    '''Returns the names of the blobs computed by forward up to the layer at end_idx, along with the net inputs'''
+
+    blob_names = list(net.inputs)
+    for layer_name in list(net._layer_names)[:end_idx + 1]:
+        blob_names.extend([top_name for top_name in net.top_names[layer_name] if top_name not in blob_names])
+    return blob_names
+
+
+class BlobDiffSnapshot(object):
+    '''Copy of the diff of a single blob'''
+
+    def __init__(self, diff):
+        self.diff = diff
+
+
+class NetDiffsSnapshot(object):
+    '''Copy of the diffs of all the blobs of a net, which can be drawn while the net computes the next ones. Provides
+    the blobs and top_names of the net, so it can be used instead of the net to look up diff blobs.'''
+
+    def __init__(self, net):
+        self.top_names = net.top_names
+        self.blobs = dict([(blob_name, BlobDiffSnapshot(blob.diff.copy())) for blob_name, blob in net.blobs.iteritems()])
+
+
+class NetBlobsSnapshot(object):
+    '''Copy of the data or the diffs of the blobs of a net, which can be cached and restored into the net later'''
+
+    def __init__(self, net, field, blob_names = None, end_idx = None):
+        ''':param field: 'data' or 'diff'
+        :param blob_names: names of the blobs to copy, None for all of them
+        :param end_idx: index of the last layer forward ran when the blobs were computed, None for the whole net'''
+        self.field = field
+        self.end_idx = end_idx
+        if blob_names is None:
+            blob_names = net.blobs.keys()
+        self.arrays = dict([(blob_name, getattr(net.blobs[blob_name], field).copy()) for blob_name in blob_names])
+        self.nbytes = sum([array.nbytes for array in self.arrays.itervalues()])
+
+    def restore(self, net):
+        for blob_name, array in self.arrays.iteritems():
+            getattr(net.blobs[blob_name], self.field)[...] = array
+
+
 def get_pretty_layer_name(settings, layer_name):
     has_old_settings = hasattr(settings, 'caffevis_layer_pretty_names')
     has_new_settings = hasattr(settings, 'caffevis_layer_pretty_name_fn')
@@ -194,17 +263,67 @@ def set_mean(caffevis_data_mean, generate_channelwise_mean, net):
     return data_mean
 
 
+def build_unit_mega_image(settings, unit_images, should_crop_to_corner, resize_shape, first_only, captions = [], values = []):
+    '''tiles the images of a unit, e.g. its max patches, into a single image of resize_shape'''
+
+    mega_image = np.zeros((resize_shape[0], resize_shape[1], 3), dtype=np.uint8)
+
+    if settings.caffevis_clear_negative_activations:
+        # clear images with 0 value
+        if values:
+            for i in range(len(values)):
+                if values[i] < float_info.epsilon:
+                    unit_images[i] *= 0
+
+    if should_crop_to_corner:
+        unit_images = [crop_to_corner(img, 2) for img in unit_images]
+
+    num_images = len(unit_images)
+    images_per_axis = int(np.math.ceil(np.math.sqrt(num_images)))
+    padding_pixel = 1
+
+    if first_only:
+        single_resized_image_shape = (resize_shape[0] - 2*padding_pixel, resize_shape[1] - 2*padding_pixel)
+    else:
+        single_resized_image_shape = ((resize_shape[0] / images_per_axis) - 2*padding_pixel, (resize_shape[1] / images_per_axis) - 2*padding_pixel)
+    unit_images = [ensure_uint255_and_resize_without_fit(unit_image, single_resized_image_shape) for unit_image in unit_images]
+
+    # build mega image
+
+    should_add_caption = (len(captions) == num_images)
+    defaults = {'face': settings.caffevis_score_face,
+                'fsize': settings.caffevis_score_fsize,
+                'clr': to_255(settings.caffevis_score_clr),
+                'thick': settings.caffevis_score_thick}
+
+    for i in range(num_images):
+
+        # add caption if we have exactly one for each image
+        if should_add_caption:
+            loc = settings.caffevis_score_loc[::-1]   # Reverse to OpenCV c,r order
+            fs = FormattedString(captions[i], defaults)
+            cv2_typeset_text(unit_images[i], [[fs]], loc)
+
+        cell_row = i / images_per_axis
+        cell_col = i % images_per_axis
+        mega_image_height_start = 1 + cell_row * (single_resized_image_shape[0] + 2 * padding_pixel)
+        mega_image_height_end = mega_image_height_start + single_resized_image_shape[0]
+        mega_image_width_start = 1 + cell_col * (single_resized_image_shape[1] + 2 * padding_pixel)
+        mega_image_width_end = mega_image_width_start + single_resized_image_shape[1]
+        mega_image[mega_image_height_start:mega_image_height_end, mega_image_width_start:mega_image_width_end,:] = unit_images[i]
+
+    return mega_image
+
+
 def get_image_from_files(settings, unit_folder_path, should_crop_to_corner, resize_shape, first_only, captions = [], values = []):
     try:
 
         # list unit images
         unit_images_path = sorted(glob.glob(unit_folder_path))
 
-        mega_image = np.zeros((resize_shape[0], resize_shape[1], 3), dtype=np.uint8)
-
         # if no images
         if not unit_images_path:
-            return mega_image
+            return np.zeros((resize_shape[0], resize_shape[1], 3), dtype=np.uint8)
 
         if first_only:
             unit_images_path = [unit_images_path[0]]
@@ -213,56 +332,38 @@ def get_image_from_files(settings, unit_folder_path, should_crop_to_corner, resi
         unit_images = [caffe_load_image(unit_image_path, color=True, as_uint=True) for unit_image_path in
                        unit_images_path]
 
-        if settings.caffevis_clear_negative_activations:
-            # clear images with 0 value
-            if values:
-                for i in range(len(values)):
-                    if values[i] < float_info.epsilon:
-                        unit_images[i] *= 0
+        return build_unit_mega_image(settings, unit_images, should_crop_to_corner, resize_shape, first_only, captions, values)
 
-        if should_crop_to_corner:
-            unit_images = [crop_to_corner(img, 2) for img in unit_images]
+    except:
+        print '\nAttempted to load files from %s but failed. ' % unit_folder_path
+        # set black image as place holder
+        return np.zeros((resize_shape[0], resize_shape[1], 3), dtype=np.uint8)
+        pass
 
-        num_images = len(unit_images)
-        images_per_axis = int(np.math.ceil(np.math.sqrt(num_images)))
-        padding_pixel = 1
+    return
 
-        if first_only:
-            single_resized_image_shape = (resize_shape[0] - 2*padding_pixel, resize_shape[1] - 2*padding_pixel)
-        else:
-            single_resized_image_shape = ((resize_shape[0] / images_per_axis) - 2*padding_pixel, (resize_shape[1] / images_per_axis) - 2*padding_pixel)
-        unit_images = [ensure_uint255_and_resize_without_fit(unit_image, single_resized_image_shape) for unit_image in unit_images]
 
-        # build mega image
+def get_image_from_patch_atlas(settings, patch_atlas, kind, unit_idx, should_crop_to_corner, resize_shape, first_only, captions = [], values = []):
+    '''same as get_image_from_files, for the patches of a unit in a patch atlas, which are read from memory mapped arrays'''
 
-        should_add_caption = (len(captions) == num_images)
-        defaults = {'face': settings.caffevis_score_face,
-                    'fsize': settings.caffevis_score_fsize,
-                    'clr': to_255(settings.caffevis_score_clr),
-                    'thick': settings.caffevis_score_thick}
+    try:
 
-        for i in range(num_images):
+        # if no patches of this kind
+        if not patch_atlas.has_kind(kind):
+            return np.zeros((resize_shape[0], resize_shape[1], 3), dtype=np.uint8)
 
-            # add caption if we have exactly one for each image
-            if should_add_caption:
-                loc = settings.caffevis_score_loc[::-1]   # Reverse to OpenCV c,r order
-                fs = FormattedString(captions[i], defaults)
-                cv2_typeset_text(unit_images[i], [[fs]], loc)
+        unit_images = patch_atlas.get_patches(kind, unit_idx)
 
-            cell_row = i / images_per_axis
-            cell_col = i % images_per_axis
-            mega_image_height_start = 1 + cell_row * (single_resized_image_shape[0] + 2 * padding_pixel)
-            mega_image_height_end = mega_image_height_start + single_resized_image_shape[0]
-            mega_image_width_start = 1 + cell_col * (single_resized_image_shape[1] + 2 * padding_pixel)
-            mega_image_width_end = mega_image_width_start + single_resized_image_shape[1]
-            mega_image[mega_image_height_start:mega_image_height_end, mega_image_width_start:mega_image_width_end,:] = unit_images[i]
+        # if no images
+        if not unit_images:
+            return np.zeros((resize_shape[0], resize_shape[1], 3), dtype=np.uint8)
 
-        return mega_image
+        if first_only:
+            unit_images = unit_images[0:1]
+
+        return build_unit_mega_image(settings, unit_images, should_crop_to_corner, resize_shape, first_only, captions, values)
 
     except:
-        print '\nAttempted to load files from %s but failed. ' % unit_folder_path
+        print '\nAttempted to load %s patches of unit %d from %s but failed. ' % (kind, unit_idx, patch_atlas.dirname)
         # set black image as place holder
         return np.zeros((resize_shape[0], resize_shape[1], 3), dtype=np.uint8)
-        pass
-
-    return
\ No newline at end of file
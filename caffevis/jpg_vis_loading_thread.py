@@ -1,5 +1,4 @@
 import os
-import time
 
 import cv2
 import numpy as np
@@ -9,7 +8,8 @@ import math
 from codependent_thread import CodependentThread
 from image_misc import caffe_load_image, ensure_uint255_and_resize_to_fit, \
     ensure_uint255_and_resize_without_fit
-from caffevis_helper import crop_to_corner, get_image_from_files
+from caffevis_helper import crop_to_corner, get_image_from_files, get_image_from_patch_atlas
+from find_maxes.patch_atlas import load_patch_atlas
 
 import caffe
 
@@ -18,13 +18,12 @@ class JPGVisLoadingThread(CodependentThread):
     thread and inserts them into the cache.
     '''
 
-    def __init__(self, settings, state, cache, loop_sleep, heartbeat_required):
+    def __init__(self, settings, state, cache, heartbeat_required):
         CodependentThread.__init__(self, heartbeat_required)
         self.daemon = True
         self.settings = settings
         self.state = state
         self.cache = cache
-        self.loop_sleep = loop_sleep
         self.debug_level = 0
 
 
@@ -50,6 +49,10 @@ class JPGVisLoadingThread(CodependentThread):
 
     def get_score_values_for_max_input_images(self, state_layer_name, state_selected_unit):
 
+        patch_atlas = load_patch_atlas(self.settings.caffevis_outputs_dir, state_layer_name)
+        if patch_atlas is not None and patch_atlas.has_kind('info'):
+            return patch_atlas.get_values('info', state_selected_unit)
+
         try:
 
             info_file_path = os.path.join(self.settings.caffevis_outputs_dir, state_layer_name,
@@ -73,7 +76,15 @@ class JPGVisLoadingThread(CodependentThread):
             pass
 
     def load_image_into_pane_max_tracker_format(self, state_layer_name, state_selected_unit, resize_shape, images,
-                                                file_search_pattern, image_index_to_set, should_crop_to_corner=False, first_only = False, captions = [], values = []):
+                                                file_search_pattern, image_index_to_set, should_crop_to_corner=False, first_only = False, captions = [], values = [],
+                                                patch_kind = None):
+
+        # patches packed by crop_max_patches into a patch atlas are preferred over loose files
+        if patch_kind is not None:
+            patch_atlas = load_patch_atlas(self.settings.caffevis_outputs_dir, state_layer_name)
+            if patch_atlas is not None:
+                images[image_index_to_set] = get_image_from_patch_atlas(self.settings, patch_atlas, patch_kind, state_selected_unit, should_crop_to_corner, resize_shape, first_only, captions, values)
+                return
 
         unit_folder_path = os.path.join(self.settings.caffevis_outputs_dir, state_layer_name,
                                         "unit_%04d" % (state_selected_unit),
@@ -87,6 +98,10 @@ class JPGVisLoadingThread(CodependentThread):
         
         while not self.is_timed_out():
             with self.state.lock:
+                # Wait until a jpg is requested by the draw thread
+                while self.state.jpgvis_to_load_key is None and not self.state.quit:
+                    self.state.state_changed.wait()
+
                 if self.state.quit:
                     break
 
@@ -98,10 +113,6 @@ class JPGVisLoadingThread(CodependentThread):
 
                 jpgvis_to_load_key = self.state.jpgvis_to_load_key
 
-            if jpgvis_to_load_key is None:
-                time.sleep(self.loop_sleep)
-                continue
-
             state_layer_name, state_selected_unit, data_shape, show_maximal_score = jpgvis_to_load_key
 
             # Load three images:
@@ -153,7 +164,8 @@ class JPGVisLoadingThread(CodependentThread):
                     captions = []
                 self.load_image_into_pane_max_tracker_format(state_layer_name, state_selected_unit, resize_shape, images,
                                                              file_search_pattern='maxim*.png',
-                                                             image_index_to_set=1, captions=captions, values=values)
+                                                             image_index_to_set=1, captions=captions, values=values,
+                                                             patch_kind='maxim')
 
 
             if self.settings.caffevis_outputs_dir_folder_format == 'original_combined_single_image':
@@ -170,7 +182,8 @@ class JPGVisLoadingThread(CodependentThread):
 
                 self.load_image_into_pane_max_tracker_format(state_layer_name, state_selected_unit, resize_shape, images,
                                                              file_search_pattern='deconv*.png',
-                                                             image_index_to_set=2, values=values)
+                                                             image_index_to_set=2, values=values,
+                                                             patch_kind='deconv')
 
             # Prune images that were not found:
             images = [im for im in images if im is not None]
@@ -191,5 +204,6 @@ class JPGVisLoadingThread(CodependentThread):
             with self.state.lock:
                 self.state.jpgvis_to_load_key = None
                 self.state.drawing_stale = True
+            self.state.wake_main_loop()
 
         print 'JPGVisLoadingThread.run: finished'
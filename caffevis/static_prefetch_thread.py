@@ -0,0 +1,149 @@
+import time
+
+from codependent_thread import CodependentThread
+from input_fetcher import get_static_frame_key, load_static_frame
+from caffe_proc_thread import set_caffe_mode, get_net_input, CachedNetRunner
+
+
+class StaticPrefetchThread(CodependentThread):
+    '''Precomputes in the background the decoded images and the
+    activations of the static files around the current one, first in
+    the direction the user is paging, and inserts them into the static
+    input cache, so stepping to them needs no decode or forward pass.
+
+    Runs on its own net, which shares the weights of the net of
+    CaffeProcThread, and only while the app is idle: it gives way
+    when a key is pressed, a frame is waiting or being processed or
+    drawn, and starts over when the position in the files changes.
+
+    The prefetched files take at most WINDOW_CACHE_SHARE of the
+    cache, the rest is left for the current file and the recently
+    viewed ones, and each file is prefetched at most once for each
+    position, so a file which was evicted anyway is not computed
+    again and again.
+    '''
+
+    WINDOW_CACHE_SHARE = 0.5
+
+    def __init__(self, settings, net, state, input_updater, static_input_cache, n_ahead, pause_after_keys,
+                 heartbeat_required, mode_gpu):
+        CodependentThread.__init__(self, heartbeat_required)
+        self.daemon = True
+        self.settings = settings
+        self.state = state
+        self.input_updater = input_updater
+        self.cache = static_input_cache
+        self.n_ahead = n_ahead
+        self.pause_after_keys = pause_after_keys
+        self.mode_gpu = mode_gpu
+        self.input_dims = net.blobs['data'].data.shape[2:4]    # e.g. (227,227)
+        self.net_runner = CachedNetRunner(settings, net, 'StaticPrefetchThread', static_input_cache)
+        self.failed_keys = set()
+        self.frames_prefetched = 0
+
+        # largest size in the cache of the frame and activations of a file, None until the first file is prefetched
+        self.bytes_per_file = None
+
+        # files prefetched since the position in the files last changed
+        self.prefetched_position = None
+        self.prefetched_keys = set()
+        self.debug_level = 0
+
+    def _is_app_idle(self):
+        '''Whether the app has nothing else to do. Must be called with the state lock held.'''
+        return (self.state.caffe_net_state == 'free' and self.state.next_frame is None and
+                time.time() - self.state.last_key_at > self.pause_after_keys)
+
+    def _wait_until_app_idle(self):
+        '''Waits until the app is idle, returns False if it quits meanwhile'''
+        with self.state.lock:
+            while not self.state.quit and not self._is_app_idle():
+                pause_left = self.pause_after_keys - (time.time() - self.state.last_key_at)
+                self.state.state_changed.wait(pause_left if pause_left > 0 else None)
+            return not self.state.quit
+
+    def _get_max_window_files(self):
+        '''Returns how many files around the current one fit in the share of the cache of the prefetched files'''
+
+        if self.bytes_per_file is None:
+            return 1
+        return int(self.cache.get_max_size() * self.WINDOW_CACHE_SHARE / self.bytes_per_file)
+
+    def _get_next_to_prefetch(self, position):
+        '''Returns the filename and key of the nearest file to the current one, looking first in the direction
+        of paging, whose activations are not cached yet, or None if all of the files which fit in the cache are'''
+
+        if position != self.prefetched_position:
+            self.prefetched_position = position
+            self.prefetched_keys = set()
+
+        static_file_mode, static_file_idx, direction, stretch_mode = position
+        available_files = self.input_updater.available_files
+        if not static_file_mode or static_file_idx is None or len(available_files) == 0:
+            return None
+
+        window_files = 0
+        max_window_files = self._get_max_window_files()
+        for sign in (direction, -direction):
+            for distance in range(1, self.n_ahead + 1):
+                if window_files >= max_window_files:
+                    return None
+                window_files += 1
+
+                filename = available_files[(static_file_idx + sign * distance) % len(available_files)]
+                frame_key = get_static_frame_key(self.settings, filename, stretch_mode)
+                if frame_key not in self.failed_keys and frame_key not in self.prefetched_keys and \
+                        not self.cache.has(('data', frame_key)):
+                    return filename, frame_key
+
+        return None
+
+    def run(self):
+        print 'StaticPrefetchThread.run called'
+
+        set_caffe_mode(self.mode_gpu, 'StaticPrefetchThread')
+
+        while not self.is_timed_out():
+            if not self._wait_until_app_idle():
+                break
+
+            position = self.input_updater.get_static_position()
+            next_to_prefetch = self._get_next_to_prefetch(position)
+            if next_to_prefetch is None:
+                # Everything around the current file is cached, wait until the next frame or key
+                with self.state.lock:
+                    if not self.state.quit and self.input_updater.get_static_position() == position:
+                        self.state.state_changed.wait()
+                continue
+
+            filename, frame_key = next_to_prefetch
+            frame = None
+            if self.cache.has(('frame', frame_key)):
+                frame = self.cache.get(('frame', frame_key))
+            if frame is None:
+                try:
+                    frame = load_static_frame(self.settings, filename, position[3])
+                except Exception:
+                    print 'StaticPrefetchThread: failed loading %s' % str(filename)
+                    self.failed_keys.add(frame_key)
+                    continue
+                self.cache.set(('frame', frame_key), frame)
+
+            # The user may have moved on while the file was loading
+            if not self._wait_until_app_idle():
+                break
+            if self.input_updater.get_static_position() != position:
+                continue
+            with self.state.lock:
+                layer_names = self.state.get_forward_layer_names()
+
+            self.net_runner.forward(get_net_input(self.settings, self.state, frame, self.input_dims), frame_key, layer_names,
+                                    self.debug_level)
+            self.frames_prefetched += 1
+            self.prefetched_keys.add(frame_key)
+            file_bytes = self.cache.get_nbytes(('frame', frame_key)) + self.cache.get_nbytes(('data', frame_key))
+            if file_bytes > 0 and (self.bytes_per_file is None or file_bytes > self.bytes_per_file):
+                self.bytes_per_file = file_bytes
+
+        print 'StaticPrefetchThread.run: finished'
+        print 'StaticPrefetchThread.run: prefetched %d frames' % self.frames_prefetched
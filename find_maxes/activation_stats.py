@@ -0,0 +1,375 @@
+#! /usr/bin/env python
+
+import numpy as np
+
+
+class ChannelHistogramSketch(object):
+    '''
+    constant memory streaming histogram of values, kept separately for each channel
+
+    each channel holds n_bins fine bins of equal width on a grid anchored at zero: fine bin b of a channel covers
+    [(offset + b) * width, (offset + b + 1) * width), where the width is a power of two and the offset an integer of
+    the channel. the bins of a channel are placed over the range of its values, and are first sized by the range of the
+    first BLOCK_SIZE inputs, which are buffered. when a value falls outside the covered range, the bins are moved and
+    their width doubles as needed, so every old bin falls in a single new bin and the counts stay exact. coarse
+    histograms over the actual [min, max] range of each channel are derived from the fine bins on request, assuming
+    the values of each fine bin are spread uniformly over it
+    '''
+
+    # smallest bin width exponent, used for channels which only had zero values so far
+    MIN_WIDTH_EXPONENT = -40
+
+    BLOCK_SIZE = 256
+
+    def __init__(self, n_channels, n_bins = 1024):
+        assert n_bins % 2 == 0, 'n_bins must be even'
+
+        self.n_channels = n_channels
+        self.n_bins = n_bins
+
+        # fine bin counts, and log2 of the bin width and grid offset for each channel, set when the channel is binned
+        # for the first time
+        self.counts = np.zeros((n_channels, n_bins), dtype=np.int32)
+        self.width_exponents = np.zeros(n_channels, dtype=np.int32)
+        self.offsets = np.zeros(n_channels, dtype=np.int64)
+        self.initialized = np.zeros(n_channels, dtype=bool)
+
+        # exact statistics of the values seen, including the buffered ones
+        self.n_values = np.zeros(n_channels, dtype=np.int64)
+        self.min_vals = np.full(n_channels, np.inf, dtype=np.float64)
+        self.max_vals = np.full(n_channels, -np.inf, dtype=np.float64)
+
+        # inputs which are not binned yet
+        self._pending = None
+        self._n_pending = 0
+
+    def __getstate__(self):
+        self._flush()
+        state = self.__dict__.copy()
+        state['_pending'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # sketches saved before the bins were placed per channel had them symmetric around zero
+        if 'offsets' not in state:
+            self.offsets = np.full(self.n_channels, -(self.n_bins / 2), dtype=np.int64)
+            self._pending = None
+            self._n_pending = 0
+
+    def _fit_bins(self, lows, highs, min_exponents, n_used_bins):
+        '''
+        returns the smallest bin width exponents, not below min_exponents, for which [lows, highs] spans at most
+        n_used_bins bins, and the offsets which center the range in the bins
+        '''
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exponents = np.floor(np.log2((highs - lows) / n_used_bins))
+        exponents[~np.isfinite(exponents)] = self.MIN_WIDTH_EXPONENT
+        exponents = np.maximum(exponents, min_exponents).astype(np.int32)
+
+        # the estimate may be one too small, since the range need not start on a bin edge
+        while True:
+            first_bins = np.floor(np.ldexp(lows, -exponents)).astype(np.int64)
+            spans = np.floor(np.ldexp(highs, -exponents)).astype(np.int64) - first_bins + 1
+            too_wide = spans > n_used_bins
+            if not too_wide.any():
+                break
+            exponents[too_wide] += 1
+
+        return exponents, first_bins - (self.n_bins - spans) / 2
+
+    def _rebin(self, counts, old_exponents, old_offsets, new_exponents, new_offsets):
+        '''returns the given fine bin counts moved from the old bins to the new, at least as wide, bins'''
+
+        factors = 2 ** (new_exponents - old_exponents).astype(np.int64)
+
+        # old bin b is grid bin offset + b, which falls in new grid bin floor((offset + b) / factor)
+        grid_bins = old_offsets[:, np.newaxis] + np.arange(self.n_bins, dtype=np.int64)[np.newaxis, :]
+        new_indexes = np.floor_divide(grid_bins, factors[:, np.newaxis]) - new_offsets[:, np.newaxis]
+        new_indexes = new_indexes.clip(0, self.n_bins - 1)
+
+        n_rows = counts.shape[0]
+        flat_indexes = (np.arange(n_rows)[:, np.newaxis] * self.n_bins + new_indexes).ravel()
+        rebinned = np.bincount(flat_indexes, weights=counts.ravel(), minlength=n_rows * self.n_bins)
+        return rebinned.reshape((n_rows, self.n_bins)).astype(counts.dtype)
+
+    def _move(self, channels, new_exponents, new_offsets):
+        '''moves the bins of the given channels, merging the counts of old bins'''
+
+        self.counts[channels] = self._rebin(self.counts[channels], self.width_exponents[channels],
+                                            self.offsets[channels], new_exponents, new_offsets)
+        self.width_exponents[channels] = new_exponents
+        self.offsets[channels] = new_offsets
+
+    def _ensure_range(self):
+        '''makes sure the bins of each channel cover the values seen'''
+
+        # the bins of a channel cover its first values twice, so they are not moved again for a while
+        new_channels = np.flatnonzero(~self.initialized & (self.n_values > 0))
+        if len(new_channels) > 0:
+            lows, highs = self.min_vals[new_channels], self.max_vals[new_channels]
+
+            # a constant channel gets bins fine relative to its value
+            constant = (lows == highs)
+            magnitudes = np.abs(lows[constant])
+            lows[constant] -= magnitudes
+            highs[constant] += magnitudes
+
+            exponents, offsets = self._fit_bins(lows, highs, self.MIN_WIDTH_EXPONENT, self.n_bins / 2)
+            self.width_exponents[new_channels] = exponents
+            self.offsets[new_channels] = offsets
+            self.initialized[new_channels] = True
+
+        lows = np.ldexp(self.offsets.astype(np.float64), self.width_exponents)
+        highs = np.ldexp((self.offsets + self.n_bins).astype(np.float64), self.width_exponents)
+        outside = np.flatnonzero(self.initialized & ((self.min_vals < lows) | (self.max_vals >= highs)))
+        if len(outside) > 0:
+            exponents, offsets = self._fit_bins(self.min_vals[outside], self.max_vals[outside],
+                                                self.width_exponents[outside], self.n_bins)
+            self._move(outside, exponents, offsets)
+
+    def _flush(self):
+        '''bins the buffered inputs'''
+
+        if self._n_pending == 0:
+            return
+
+        values = self._pending[:self._n_pending]
+        self._n_pending = 0
+        self._ensure_range()
+
+        # bin all valid values of all channels at once
+        valid = ~np.isnan(values)
+        rows, channels = np.nonzero(valid)
+        bin_indexes = np.floor(np.ldexp(values[valid], -self.width_exponents[channels])).astype(np.int64)
+        bin_indexes = (bin_indexes - self.offsets[channels]).clip(0, self.n_bins - 1)
+        flat_indexes = channels * self.n_bins + bin_indexes
+
+        # count only the touched bins. the values of a single input are in distinct channels, so their bins are
+        # distinct and can be incremented by fancy indexing. counts is C contiguous, so the reshaped array is a view
+        flat_counts = self.counts.reshape(-1)
+        row_starts = np.searchsorted(rows, np.arange(values.shape[0] + 1))
+        for row in range(values.shape[0]):
+            flat_counts[flat_indexes[row_starts[row]:row_starts[row + 1]]] += 1
+
+    def update(self, values):
+        '''
+        adds values to the sketch
+        :param values: array of shape (n_inputs, n_channels), NaN values are ignored
+        :return: none
+        '''
+
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+
+        self.n_values += valid.sum(0)
+        self.min_vals = np.fmin(self.min_vals, np.where(valid, values, np.inf).min(0))
+        self.max_vals = np.fmax(self.max_vals, np.where(valid, values, -np.inf).max(0))
+
+        if self._pending is None:
+            self._pending = np.zeros((self.BLOCK_SIZE, self.n_channels), dtype=np.float64)
+
+        while values.shape[0] > 0:
+            n_added = min(values.shape[0], self.BLOCK_SIZE - self._n_pending)
+            self._pending[self._n_pending:self._n_pending + n_added] = values[:n_added]
+            self._n_pending += n_added
+            values = values[n_added:]
+            if self._n_pending == self.BLOCK_SIZE:
+                self._flush()
+
+    def merge(self, other):
+        '''adds the values of another sketch with the same number of channels and bins'''
+
+        assert (self.n_channels, self.n_bins) == (other.n_channels, other.n_bins), 'cannot merge sketches of different shapes'
+
+        self._flush()
+        other._flush()
+
+        # bins of the channels only the other sketch has seen are taken as they are
+        taken = other.initialized & ~self.initialized
+        self.width_exponents[taken] = other.width_exponents[taken]
+        self.offsets[taken] = other.offsets[taken]
+        self.initialized |= taken
+
+        self.n_values += other.n_values
+        self.min_vals = np.fmin(self.min_vals, other.min_vals)
+        self.max_vals = np.fmax(self.max_vals, other.max_vals)
+
+        # move both sketches to bins which cover the values of both, and are at least as wide as the bins of each
+        both = np.flatnonzero(self.initialized & other.initialized & ~taken)
+        exponents, offsets = self._fit_bins(self.min_vals[both], self.max_vals[both],
+                                            np.maximum(self.width_exponents[both], other.width_exponents[both]),
+                                            self.n_bins)
+        self._move(both, exponents, offsets)
+
+        other_counts = other.counts.copy()
+        other_counts[both] = self._rebin(other_counts[both], other.width_exponents[both], other.offsets[both],
+                                         exponents, offsets)
+        self.counts += other_counts
+
+    def get_histograms(self, n_bins = 50):
+        '''
+        derives coarse histograms, with n_bins equal bins between the min and max value of each channel, as
+        np.histogram does. the count of each fine bin is split between the coarse bins it overlaps, in proportion to
+        the overlap of its part inside [min, max]
+        :return: hists of shape (n_channels, n_bins) and bin_edges of shape (n_channels, n_bins + 1)
+        '''
+
+        self._flush()
+
+        # same range as np.histogram, including its handling of empty and constant inputs
+        lows = np.where(self.n_values > 0, self.min_vals, 0.0)
+        highs = np.where(self.n_values > 0, self.max_vals, 1.0)
+        constant = (lows == highs)
+        lows = np.where(constant, lows - 0.5, lows)
+        highs = np.where(constant, highs + 0.5, highs)
+
+        steps = np.linspace(0, 1, n_bins + 1)
+        bin_edges = lows[:, np.newaxis] + (highs - lows)[:, np.newaxis] * steps[np.newaxis, :]
+
+        hists = np.zeros((self.n_channels, n_bins), dtype=np.float64)
+        for channel_idx in np.flatnonzero(self.n_values > 0):
+            counts = self.counts[channel_idx]
+            if constant[channel_idx]:
+                # np.histogram puts all the values of a constant channel in the middle bin
+                hists[channel_idx, n_bins / 2] = counts.sum()
+                continue
+
+            # cumulative counts of the values, linear inside each fine bin, at the edges of the fine bins clipped to
+            # [min, max], interpolated at the coarse edges
+            fine_bins = np.flatnonzero(counts)
+            fine_lows = np.ldexp((self.offsets[channel_idx] + fine_bins).astype(np.float64), self.width_exponents[channel_idx])
+            fine_highs = np.ldexp((self.offsets[channel_idx] + fine_bins + 1).astype(np.float64), self.width_exponents[channel_idx])
+            cumulative = np.cumsum(counts[fine_bins])
+            xs = np.vstack((fine_lows, fine_highs)).clip(self.min_vals[channel_idx], self.max_vals[channel_idx]).T.ravel()
+            ys = np.vstack((cumulative - counts[fine_bins], cumulative)).T.ravel()
+            cumulative_at_edges = np.interp(bin_edges[channel_idx], xs, ys)
+
+            # values equal to max may be in a fine bin which starts at max, and is empty after clipping. rounding the
+            # cumulative counts keeps the total of the histogram exact
+            cumulative_at_edges[0] = 0
+            cumulative_at_edges[-1] = cumulative[-1]
+            hists[channel_idx] = np.diff(np.round(cumulative_at_edges))
+
+        return hists.astype(np.int64), bin_edges
+
+
+class CoMomentAccumulator(object):
+    '''
+    streaming accumulator of the first and second co-moments of values of several channels, used to compute the exact
+    correlation matrix of the channels over all inputs with O(n_channels^2) memory
+
+    values are shifted by the first input seen, which keeps the float64 sums accurate for channels with a large mean.
+    incoming inputs are buffered and added in blocks of BLOCK_SIZE, since a single product of the whole block costs
+    about as much as the rank-1 product of a single input
+    '''
+
+    BLOCK_SIZE = 256
+
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+        self.count = 0
+        self.shift = None
+        self.sums = np.zeros(n_channels, dtype=np.float64)
+        self.outer_sums = np.zeros((n_channels, n_channels), dtype=np.float64)
+        self._pending = None
+        self._n_pending = 0
+
+    def __getstate__(self):
+        self._flush()
+        state = self.__dict__.copy()
+        state['_pending'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # accumulators saved before inputs were buffered
+        if '_pending' not in state:
+            self._pending = None
+            self._n_pending = 0
+
+    def _flush(self):
+        '''adds the buffered inputs to the sums'''
+
+        if self._n_pending == 0:
+            return
+
+        shifted = self._pending[:self._n_pending] - self.shift
+        self.sums += shifted.sum(0)
+        self.outer_sums += np.dot(shifted.T, shifted)
+        self.count += self._n_pending
+        self._n_pending = 0
+
+    def update(self, values):
+        '''
+        adds values to the accumulator
+        :param values: array of shape (n_inputs, n_channels), inputs which contain NaN values are ignored
+        :return: none
+        '''
+
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values).any(1)]
+        if values.shape[0] == 0:
+            return
+
+        if self.shift is None:
+            self.shift = values[0].copy()
+
+        if self._pending is None:
+            self._pending = np.zeros((self.BLOCK_SIZE, self.n_channels), dtype=np.float64)
+
+        while values.shape[0] > 0:
+            n_added = min(values.shape[0], self.BLOCK_SIZE - self._n_pending)
+            self._pending[self._n_pending:self._n_pending + n_added] = values[:n_added]
+            self._n_pending += n_added
+            values = values[n_added:]
+            if self._n_pending == self.BLOCK_SIZE:
+                self._flush()
+
+    def merge(self, other):
+        '''adds the values of another accumulator with the same number of channels'''
+
+        assert self.n_channels == other.n_channels, 'cannot merge accumulators of different sizes'
+
+        self._flush()
+        other._flush()
+
+        if other.count == 0:
+            return
+
+        if self.count == 0:
+            self.shift = other.shift.copy()
+            self.sums = other.sums.copy()
+            self.outer_sums = other.outer_sums.copy()
+            self.count = other.count
+            return
+
+        # move the other sums to our shift, x - our_shift = (x - other_shift) + delta
+        delta = other.shift - self.shift
+        self.sums += other.sums + other.count * delta
+        self.outer_sums += other.outer_sums + np.outer(other.sums, delta) + np.outer(delta, other.sums) + \
+                           other.count * np.outer(delta, delta)
+        self.count += other.count
+
+    def get_correlation(self):
+        '''
+        returns the correlation matrix of the channels, as np.corrcoef would on all the values
+        entries of channels with no variance are NaN
+        '''
+
+        self._flush()
+
+        if self.count == 0:
+            return np.full((self.n_channels, self.n_channels), np.nan)
+
+        means = self.sums / self.count
+        covariance = self.outer_sums / self.count - np.outer(means, means)
+        stddevs = np.sqrt(np.maximum(np.diag(covariance), 0))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = covariance / np.outer(stddevs, stddevs)
+
+        return np.clip(correlation, -1, 1)
@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+
+# this import must comes first to make sure we use the non-display backend
+import matplotlib
+matplotlib.use('Agg')
+
+# add parent folder to search path, to enable import of core modules like settings
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import argparse
+
+import settings
+
+from jby_misc import WithTimer
+from find_max_acts import load_max_tracker_from_file
+from max_tracker_store import save_max_tracker_store, get_store_dirname
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Converts a pickled NetMaxTracker, including ones saved by older versions, into a columnar store of per layer arrays.')
+    parser.add_argument('--infile', type = str, default = os.path.join(settings.caffevis_outputs_dir, 'find_max_acts_output.pickled'), help = 'pickled NetMaxTracker to convert')
+    parser.add_argument('--outdir', type = str, default = None, help = 'store directory, default is infile without its extension')
+
+    args = parser.parse_args()
+
+    outdir = args.outdir if args.outdir else get_store_dirname(args.infile)
+
+    with WithTimer('Loading %s' % args.infile):
+        net_max_tracker = load_max_tracker_from_file(args.infile)
+
+    with WithTimer('Saving columnar store %s' % outdir):
+        save_max_tracker_store(outdir, net_max_tracker)
+
+
+if __name__ == '__main__':
+    main()
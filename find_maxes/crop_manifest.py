@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+
+import hashlib
+import os
+
+import numpy as np
+
+from misc import mkdir_p
+
+# append only log of the outputs of crop_max_patches which are complete, one per layer, in outdir/layer. the first line
+# is a header with the number of top images and a digest of the max tracker the outputs were produced for, e.g.
+# "# num_top 9 tracker 3f2a...". every other line holds a channel and an output kind, e.g. "37 deconv" or "37 min_info",
+# and is only appended once all the files of that channel and kind were written. crop_max_patches decides what to skip
+# from the log, without probing the files. a log whose header doesn't match the current run is ignored, and replaced
+# by a new one
+
+CROP_MANIFEST_FILENAME = 'crop_manifest.log'
+
+
+def get_crop_manifest_filename(outdir, layer_name):
+    return os.path.join(outdir, layer_name, CROP_MANIFEST_FILENAME)
+
+
+def get_crop_manifest_header(num_top, max_tracker):
+    '''returns the header of the manifest of outputs of the num_top top images of each channel of max_tracker'''
+
+    hash_object = hashlib.sha1()
+    for locs in [max_tracker.max_locs, getattr(max_tracker, 'min_locs', None)]:
+        if locs is not None:
+            locs = np.ascontiguousarray(locs)
+            hash_object.update('%s %s\n' % (locs.dtype.str, locs.shape))
+            hash_object.update(locs.tobytes())
+
+    return '# num_top %d tracker %s' % (num_top, hash_object.hexdigest())
+
+
+class CropManifest(object):
+    '''
+    completed (channel, kind) outputs of a single layer, read from the log and appended to it
+
+    outputs which are still being produced are counted down with expect() and output_queued(), once all the outputs of
+    a channel and kind are queued, take_queued() returns the entry, which should be committed once the writes are done
+    '''
+
+    def __init__(self, filename, header):
+        ''':param header: header of the current run, from get_crop_manifest_header()'''
+        self.filename = filename
+        self.header = header
+        self.completed = set()
+        self.remaining = dict()
+        self.queued = []
+
+        # whether a log of the current run existed when it was opened, otherwise complete channels can only be found by
+        # probing the files, and the first commit starts a new log
+        self.exists = os.path.isfile(filename) and self._read()
+        self._started = self.exists
+
+    def _read(self):
+        '''reads the completed entries of the log, returns False if it was written for another run'''
+
+        with open(self.filename, 'rb') as manifest_file:
+            contents = manifest_file.read()
+
+        # the last line may be partial if a run was killed while appending, drop it so new entries start on a new line
+        complete_length = contents.rfind('\n') + 1
+        lines = contents[:complete_length].splitlines()
+
+        # e.g. a larger num_top needs outputs the old log doesn't cover
+        if not lines or lines[0] != self.header:
+            return False
+
+        if complete_length < len(contents):
+            with open(self.filename, 'r+b') as manifest_file:
+                manifest_file.truncate(complete_length)
+
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) == 2:
+                self.completed.add((int(fields[0]), fields[1]))
+
+        return True
+
+    def is_complete(self, channel_idx, kinds):
+        return all([(channel_idx, kind) in self.completed for kind in kinds])
+
+    def expect(self, channel_idx, kind, n_outputs):
+        '''starts counting the outputs of a channel and kind which are about to be produced'''
+
+        self.remaining[(channel_idx, kind)] = n_outputs
+        if n_outputs == 0:
+            self.output_queued(channel_idx, kind, 0)
+
+    def output_queued(self, channel_idx, kind, n_outputs = 1):
+        '''counts down queued outputs of a channel and kind'''
+
+        self.remaining[(channel_idx, kind)] -= n_outputs
+        if self.remaining[(channel_idx, kind)] == 0:
+            del self.remaining[(channel_idx, kind)]
+            self.queued.append((channel_idx, kind))
+
+    def take_queued(self):
+        '''returns the (channel, kind) entries whose outputs were all queued since the last call'''
+
+        queued = self.queued
+        self.queued = []
+        return queued
+
+    def commit(self, entries):
+        '''appends completed (channel, kind) entries to the log, and syncs it to disk'''
+
+        entries = [entry for entry in entries if entry not in self.completed]
+        if not entries:
+            return
+
+        mkdir_p(os.path.dirname(self.filename))
+        with open(self.filename, 'ab' if self._started else 'wb') as manifest_file:
+            if not self._started:
+                manifest_file.write(self.header + '\n')
+            manifest_file.write(''.join(['%d %s\n' % entry for entry in entries]))
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+        self._started = True
+        self.completed.update(entries)
@@ -19,8 +19,8 @@ from caffevis.caffevis_helper import set_mean
 from siamese_helper import SiameseHelper
 
 from jby_misc import WithTimer
-from max_tracker import output_max_patches
-from find_max_acts import load_max_tracker_from_file
+from max_tracker import output_max_patches_of_layers, MaxTrackerCropLayerJob
+from max_tracker_store import load_max_tracker_results
 from settings_misc import load_network
 
 
@@ -37,17 +37,19 @@ def main():
     parser.add_argument('--idx-begin',    type = int, default = None, help = 'Start at this unit (default: all units).')
     parser.add_argument('--idx-end',      type = int, default = None, help = 'End at this unit (default: all units).')
     
-    parser.add_argument('--nmt_pkl',      type = str, default = os.path.join(settings.caffevis_outputs_dir, 'find_max_acts_output.pickled'), help = 'Which pickled NetMaxTracker to load.')
+    parser.add_argument('--nmt_pkl',      type = str, default = os.path.join(settings.caffevis_outputs_dir, 'find_max_acts_output.pickled'), help = 'Which pickled NetMaxTracker to load, or its columnar store directory. The store saved next to the pickle is preferred.')
     parser.add_argument('--net_prototxt', type = str, default = settings.caffevis_deploy_prototxt, help = 'network prototxt to load')
     parser.add_argument('--net_weights',  type = str, default = settings.caffevis_network_weights, help = 'network weights to load')
     parser.add_argument('--datadir',      type = str, default = settings.static_files_dir, help = 'directory to look for files in')
     parser.add_argument('--filelist',     type = str, default = settings.static_files_input_file, help = 'List of image files to consider, one per line. Must be the same filelist used to produce the NetMaxTracker!')
     parser.add_argument('--outdir',       type = str, default = settings.caffevis_outputs_dir, help = 'Which output directory to use. Files are output into outdir/layer/unit_%%04d/{maxes,deconv,backprop}_%%03d.png')
     parser.add_argument('--search-min',    action='store_true', default=False, help='Should we also search for minimal activations?')
+    parser.add_argument('--patches-format', type = str, default = settings.max_tracker_patches_format, choices = ['files', 'atlas'], help = 'Output a png file per patch, or pack the patches of each layer into outdir/layer/patch_atlas')
     args = parser.parse_args()
 
     settings.caffevis_deploy_prototxt = args.net_prototxt
     settings.caffevis_network_weights = args.net_weights
+    settings.max_tracker_patches_format = args.patches_format
 
     net, data_mean = load_network(settings)
 
@@ -67,31 +69,36 @@ def main():
 
     siamese_helper = SiameseHelper(settings.layers_list)
 
-    nmt = load_max_tracker_from_file(args.nmt_pkl)
+    nmt = load_max_tracker_results(args.nmt_pkl)
 
+    # gather the work of all layers and directions, so each image is loaded and forwarded only once
+    jobs = []
     for layer_name in settings.layers_to_output_in_offline_scripts:
 
-        print 'Started work on layer %s' % (layer_name)
-
         normalized_layer_name = siamese_helper.normalize_layer_name_for_max_tracker(layer_name)
 
+        # in siamese networks, both layers of a pair share the same normalized layer
+        if normalized_layer_name in [job.layer_name for job in jobs]:
+            continue
+
         mt = nmt.max_trackers[normalized_layer_name]
 
-        if args.idx_begin is None:
-            idx_begin = 0
-        if args.idx_end is None:
-            idx_end = mt.max_vals.shape[0]
+        idx_begin = args.idx_begin if args.idx_begin is not None else 0
+        idx_end = args.idx_end if args.idx_end is not None else mt.max_vals.shape[0]
+
+        print 'Planning work on layer %s units %d:%d' % (normalized_layer_name, idx_begin, idx_end)
+
+        jobs.append(MaxTrackerCropLayerJob(layer_name = normalized_layer_name, max_tracker = mt,
+                                           idx_begin = idx_begin, idx_end = idx_end, search_min = False))
 
-        with WithTimer('Saved %d images per unit for %s units %d:%d.' % (args.N, normalized_layer_name, idx_begin, idx_end)):
+        if args.search_min:
+            jobs.append(MaxTrackerCropLayerJob(layer_name = normalized_layer_name, max_tracker = mt,
+                                               idx_begin = idx_begin, idx_end = idx_end, search_min = True))
 
-            output_max_patches(settings, mt, net, normalized_layer_name, idx_begin, idx_end,
-                               args.N, args.datadir, args.filelist, args.outdir, False,
-                               (args.do_maxes, args.do_deconv, args.do_deconv_norm, args.do_backprop, args.do_backprop_norm, args.do_info))
+    with WithTimer('Saved %d images per unit for %d layer/direction(s).' % (args.N, len(jobs))):
 
-            if args.search_min:
-                output_max_patches(settings, mt, net, normalized_layer_name, idx_begin, idx_end,
-                                   args.N, args.datadir, args.filelist, args.outdir, True,
-                                   (args.do_maxes, args.do_deconv, args.do_deconv_norm, args.do_backprop, args.do_backprop_norm, args.do_info))
+        output_max_patches_of_layers(settings, net, jobs, args.N, args.datadir, args.outdir,
+                                     (args.do_maxes, args.do_deconv, args.do_deconv_norm, args.do_backprop, args.do_backprop_norm, args.do_info))
 
 if __name__ == '__main__':
     main()
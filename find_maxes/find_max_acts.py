@@ -18,10 +18,11 @@ import settings
 
 from caffevis.caffevis_helper import set_mean
 from jby_misc import WithTimer
-from max_tracker import scan_images_for_maxes, scan_pairs_for_maxes
+from max_tracker import scan_images_for_maxes, scan_pairs_for_maxes, ScanCheckpoint, get_shard_range
+from max_tracker_store import save_max_tracker_store, get_store_dirname
 from settings_misc import load_network
 
-from misc import mkdir_p
+from misc import mkdir_p, get_files_list
 
 def pickle_to_text(pickle_filename):
 
@@ -48,6 +49,16 @@ def main():
     parser.add_argument('--do-histograms', action = 'store_true', default = settings.max_tracker_do_histograms, help = 'Output histogram image file containing histogrma of max values per channel')
     parser.add_argument('--do-correlation', action = 'store_true', default = settings.max_tracker_do_correlation, help = 'Output correlation image file containing correlation of channels per layer')
     parser.add_argument('--search-min', action='store_true', default=False, help='Should we also search for minimal activations?')
+    parser.add_argument('--checkpoint-file', type = str, default = None, help = 'checkpoint filename, default is outfile with .checkpoint suffix')
+    parser.add_argument('--checkpoint-every-images', type = int, default = settings.max_tracker_checkpoint_every_images, help = 'save a checkpoint every this many images, 0 disables')
+    parser.add_argument('--checkpoint-every-minutes', type = float, default = settings.max_tracker_checkpoint_every_minutes, help = 'save a checkpoint every this many minutes, 0 disables')
+    parser.add_argument('--resume', action = 'store_true', default = False, help = 'resume scan from the last checkpoint')
+    parser.add_argument('--incremental', action = 'store_true', default = False, help = 'update an existing tracker, scanning only files it has not seen yet, e.g. files appended to the file list')
+    parser.add_argument('--infile', type = str, default = None, help = 'existing tracker to update in incremental mode, default is outfile')
+    parser.add_argument('--shard-index', type = int, default = None, help = 'index of the shard of the file list to scan, in range [0, shard-count)')
+    parser.add_argument('--shard-count', type = int, default = None, help = 'number of shards the file list is split into')
+    parser.add_argument('--idx-begin', type = int, default = None, help = 'scan only files starting at this index in the file list (default: first file)')
+    parser.add_argument('--idx-end', type = int, default = None, help = 'scan only files up to this index in the file list, exclusive (default: last file)')
 
     args = parser.parse_args()
 
@@ -68,14 +79,50 @@ def main():
     net.blobs[net.inputs[0]].reshape(*current_input_shape)
     net.reshape()
 
+    checkpoint_filename = args.checkpoint_file if args.checkpoint_file else args.outfile + '.checkpoint'
+    checkpoint = ScanCheckpoint(checkpoint_filename, args.checkpoint_every_images, args.checkpoint_every_minutes)
+
+    # select the range of the file list to scan, image indices are kept global so shards can be merged afterwards
+    n_files = len(get_files_list(settings)[0])
+    if args.shard_count is not None:
+        assert args.shard_index is not None, 'shard-count requires shard-index'
+        assert args.idx_begin is None and args.idx_end is None, 'specify either shard-index/shard-count or idx-begin/idx-end'
+        idx_begin, idx_end = get_shard_range(n_files, args.shard_index, args.shard_count)
+    else:
+        idx_begin = args.idx_begin if args.idx_begin is not None else 0
+        idx_end = args.idx_end if args.idx_end is not None else n_files
+    assert 0 <= idx_begin <= idx_end <= n_files, 'invalid scan range [%d, %d) for %d files' % (idx_begin, idx_end, n_files)
+    print 'Scanning range [%d, %d) of %d files' % (idx_begin, idx_end, n_files)
+
+    net_max_tracker, first_image_idx = None, idx_begin
+    if args.resume:
+        net_max_tracker, resume_image_idx = checkpoint.load(settings)
+        if net_max_tracker is not None:
+            first_image_idx = resume_image_idx
+
+    if args.incremental and net_max_tracker is None:
+        assert args.shard_count is None, 'incremental mode cannot be combined with shards, each shard would include the existing tracker'
+        infile = args.infile if args.infile else args.outfile
+        with WithTimer('Loading existing tracker %s' % infile):
+            net_max_tracker = load_max_tracker_from_file(infile)
+        assert net_max_tracker.seen_inputs is not None, 'tracker in %s was saved without its seen inputs, it must be rescanned' % infile
+        assert net_max_tracker.search_min == args.search_min, 'search-min must match the existing tracker'
+        net_max_tracker.restore_settings(settings)
+        print 'Existing tracker has seen %d inputs' % len(net_max_tracker.seen_inputs)
+
     with WithTimer('Scanning images'):
         if settings.is_siamese:
-            net_max_tracker = scan_pairs_for_maxes(settings, net, args.datadir, args.N, args.outdir, args.search_min)
+            net_max_tracker = scan_pairs_for_maxes(settings, net, args.datadir, args.N, args.outdir, args.search_min,
+                                                   net_max_tracker, first_image_idx, checkpoint, idx_end)
         else: # normal operation
-            net_max_tracker = scan_images_for_maxes(settings, net, args.datadir, args.N, args.outdir, args.search_min)
+            net_max_tracker = scan_images_for_maxes(settings, net, args.datadir, args.N, args.outdir, args.search_min,
+                                                    net_max_tracker, first_image_idx, checkpoint, idx_end)
 
     save_max_tracker_to_file(args.outfile, net_max_tracker)
 
+    # scan is complete, checkpoint is no longer needed
+    checkpoint.remove()
+
     if args.do_correlation:
         net_max_tracker.calculate_correlation(args.outdir)
 
@@ -92,7 +139,12 @@ def save_max_tracker_to_file(filename, net_max_tracker):
         with open(filename, 'wb') as ff:
             pickle.dump(net_max_tracker, ff, -1)
         # save text version of pickle file for easier debugging
-        pickle_to_text(filename)
+        if settings.max_tracker_save_text_dump:
+            pickle_to_text(filename)
+
+    # save columnar version of the results, which readers can load one layer at a time
+    with WithTimer('Saving columnar store'):
+        save_max_tracker_store(get_store_dirname(filename), net_max_tracker)
 
 
 def load_max_tracker_from_file(filename):
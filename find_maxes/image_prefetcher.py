@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+
+import os
+import sys
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from image_misc import resize_without_fit
+
+# caffe module, imported once per process by the first load
+_caffe = None
+
+
+def _import_caffe(caffe_root):
+    '''imports caffe from caffe_root, adding it to sys.path only on the first call in the process'''
+
+    global _caffe
+    if _caffe is None:
+        caffe_python_dir = os.path.join(caffe_root, 'python')
+        if caffe_python_dir not in sys.path:
+            sys.path.insert(0, caffe_python_dir)
+        import caffe
+        _caffe = caffe
+    return _caffe
+
+
+def load_image_for_scan(caffe_root, datadir, filename, color, net_input_dims):
+    '''
+    loads a single image and converts it to the network input dimensions
+    :return: float32 image, or None if the input is bad/missing
+    '''
+
+    caffe = _import_caffe(caffe_root)
+
+    try:
+        im = caffe.io.load_image(os.path.join(datadir, filename), color=color)
+        im = resize_without_fit(im, net_input_dims)
+        im = im.astype(np.float32)
+    except:
+        return None
+
+    return im
+
+
+def load_image_pair_for_scan(caffe_root, datadir, images_pair, color, net_input_dims, siamese_input_mode):
+    '''
+    loads a pair of images and combines them according to the siamese input mode
+    :return: combined image, or None if one of the inputs is bad/missing
+    '''
+
+    caffe = _import_caffe(caffe_root)
+
+    im = None
+    try:
+        im1 = caffe.io.load_image(os.path.join(datadir, images_pair[0]), color=color)
+        im2 = caffe.io.load_image(os.path.join(datadir, images_pair[1]), color=color)
+
+        if siamese_input_mode == 'concat_channelwise':
+            im1 = resize_without_fit(im1, net_input_dims)
+            im2 = resize_without_fit(im2, net_input_dims)
+            im = np.concatenate((im1, im2), axis=2)
+
+        elif siamese_input_mode == 'concat_along_width':
+            half_input_dims = (net_input_dims[0], net_input_dims[1] / 2)
+            im1 = resize_without_fit(im1, half_input_dims)
+            im2 = resize_without_fit(im2, half_input_dims)
+            im = np.concatenate((im1, im2), axis=1)
+
+    except:
+        return None
+
+    return im
+
+
+def get_max_pending(n_workers, batch_size, n_batches):
+    '''
+    returns how many inputs to load ahead of the consumer, enough to keep every worker busy while a whole batch is
+    taken, and at least n_batches batches
+    '''
+
+    return max(n_workers, n_batches * batch_size) + batch_size
+
+
+def prefetch_images(load_function, args_list, n_workers, use_processes, max_pending):
+    '''
+    generator which loads inputs ahead of the consumer using a pool of workers
+    results are yielded in the same order as args_list, so the caller can keep counting indices as before
+    :param load_function: module level function which loads a single input, returns None for a bad/missing input
+    :param args_list: list of argument tuples, one for each input
+    :param n_workers: number of workers, 0 loads on the calling thread without prefetching
+    :param use_processes: use worker processes instead of threads, load_function and its arguments must be picklable
+    :param max_pending: maximal number of inputs loaded ahead of the consumer, bounds memory usage
+    :return: generator of loaded inputs
+    '''
+
+    if n_workers <= 0:
+        for args in args_list:
+            yield load_function(*args)
+        return
+
+    pool = Pool(n_workers) if use_processes else ThreadPool(n_workers)
+    pending = deque()
+
+    try:
+        for args in args_list:
+            pending.append(pool.apply_async(load_function, args))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    finally:
+        pool.terminate()
+        pool.join()
@@ -3,17 +3,28 @@
 import errno
 import os
 import sys
+import time
+from functools import partial
+from multiprocessing import Pool
+import cPickle as pickle
 from datetime import datetime
 import cv2
 
 import numpy as np
-from misc import mkdir_p, get_files_list
-from image_misc import resize_without_fit
-from caffe_misc import RegionComputer, save_caffe_image, get_max_data_extent, extract_patch_from_image, \
-    compute_data_layer_focus_area, layer_name_to_top_name
+import hashlib
+from misc import mkdir_p, get_files_list, save_pickle_atomically
+from image_misc import resize_without_fit, rasterize_histogram
+from caffe_misc import RegionComputer, caffe_image_to_rgb, get_max_data_extent, extract_patch_from_image, \
+    compute_data_layer_focus_areas, layer_name_to_top_name, get_one_hot_backward
 from siamese_helper import SiameseHelper
 
 from jby_misc import WithTimer
+from image_prefetcher import prefetch_images, get_max_pending, load_image_for_scan, load_image_pair_for_scan
+from image_writer import get_image_writer
+from patch_atlas import PatchAtlas, get_patch_atlas_dirname
+from crop_manifest import CropManifest, get_crop_manifest_filename, get_crop_manifest_header
+from activation_stats import ChannelHistogramSketch, CoMomentAccumulator
+from seen_inputs import SeenInputsIndex, hash_inputs
 
 # define records
 
@@ -34,7 +45,9 @@ class MaxTrackerCropBatchRecord(object):
                  selected_input_index = None, ii = None, jj = None, recorded_val = None,
                  out_ii_start = None, out_ii_end = None, out_jj_start = None, out_jj_end = None, data_ii_start = None,
                  data_ii_end = None, data_jj_start = None, data_jj_end = None, im = None,
-                 denormalized_layer_name = None, denormalized_top_name = None, layer_format = None):
+                 denormalized_layer_name = None, denormalized_top_name = None, layer_format = None,
+                 layer_name = None, is_spatial = None, size_ii = None, size_jj = None, filename = None,
+                 patch_atlas = None, kind_prefix = None, crop_manifest = None):
         self.cc = cc
         self.channel_idx = channel_idx
         self.info_filename = info_filename
@@ -63,60 +76,67 @@ class MaxTrackerCropBatchRecord(object):
         self.denormalized_layer_name = denormalized_layer_name
         self.denormalized_top_name = denormalized_top_name
         self.layer_format = layer_format
+        self.layer_name = layer_name
+        self.is_spatial = is_spatial
+        self.size_ii = size_ii
+        self.size_jj = size_jj
+        self.filename = filename
+        self.patch_atlas = patch_atlas
+        self.kind_prefix = kind_prefix
+        self.crop_manifest = crop_manifest
 
 
-class InfoFileMetadata(object):
-
-    def __init__(self, info_file = None, ref_count = None):
-        self.info_file = info_file
-        self.ref_count = ref_count
-
+class MaxTrackerLayerPlan(object):
 
-def prepare_max_histogram(layer_name, n_channels, channel_to_histogram_values, process_channel_figure, process_layer_figure):
-
-    import matplotlib.pyplot as plt
+    def __init__(self, layer_name = None, top_name = None, normalized_layer_name = None, layer_format = None,
+                 selected_input_index = None):
+        self.layer_name = layer_name
+        self.top_name = top_name
+        self.normalized_layer_name = normalized_layer_name
+        self.layer_format = layer_format
+        self.selected_input_index = selected_input_index
 
-    fig = plt.figure(figsize=(10, 10))
-    ax = fig.add_subplot(111)
 
-    # for each channel
-    percent_dead = np.zeros((n_channels), dtype=np.float32)
-    for channel_idx in xrange(n_channels):
+class MaxTrackerCropLayerJob(object):
 
-        if channel_idx % 100 == 0:
-            print "calculating histogram for channel %d out of %d" % (channel_idx, n_channels)
+    def __init__(self, layer_name = None, max_tracker = None, idx_begin = None, idx_end = None, search_min = None):
+        self.layer_name = layer_name
+        self.max_tracker = max_tracker
+        self.idx_begin = idx_begin
+        self.idx_end = idx_end
+        self.search_min = search_min
 
-        hist, bin_edges = channel_to_histogram_values(channel_idx)
 
-        # generate histogram image file
-        width = 0.7 * (bin_edges[1] - bin_edges[0])
-        center = (bin_edges[:-1] + bin_edges[1:]) / 2
+class MaxTrackerCropImageRecord(object):
 
-        barlist = ax.bar(center, hist, align='center', width=width, color='g')
+    def __init__(self, image_idx = None, filename = None, im = None, work_items = None):
+        self.image_idx = image_idx
+        self.filename = filename
+        self.im = im
+        self.work_items = work_items
 
-        for i in range(len(hist)):
-            if 0 >= bin_edges[i] and 0 < bin_edges[i+1]:
-                # mark dead bar in red
-                barlist[i].set_color('r')
 
-                # save percent dead
-                percent_dead[channel_idx] = 100.0 * hist[i] / sum(hist)
+def get_dead_bin(hist, bin_edges):
+    '''
+    finds the histogram bin of the dead inputs, the one which holds 0
+    :return: (index of the dead bin or None, percent of the inputs on which the channel is dead)
+    '''
 
-                break
+    for i in range(len(hist)):
+        if 0 >= bin_edges[i] and 0 < bin_edges[i+1]:
+            return i, 100.0 * hist[i] / sum(hist)
 
-        fig.suptitle('max activations histgoram of layer %s channel %d' % (layer_name,channel_idx))
-        ax.xaxis.label.set_text('max activation value')
-        ax.yaxis.label.set_text('inputs count')
+    return None, 0
 
-        process_channel_figure(channel_idx, fig)
 
-        ax.cla()
+def get_layer_inactivity_histogram(percent_dead):
+    '''
+    :param percent_dead: array of the percent dead of every channel of a layer
+    :return: hist, bin_edges and bar_colors of the histogram of the activity of the channels, from red to green
+    '''
 
-    # generate histogram for layer
     num_bins = 20
     hist, bin_edges = np.histogram(100 - percent_dead, bins=num_bins, range=(0, 100))
-    width = 0.7 * (bin_edges[1] - bin_edges[0])
-    center = (bin_edges[:-1] + bin_edges[1:]) / 2
 
     bar_colors = [None] * num_bins
     begin_color = np.array([1.0, 0, 0])
@@ -127,12 +147,104 @@ def prepare_max_histogram(layer_name, n_channels, channel_to_histogram_values, p
         bar_colors[i] = tuple(current_color)
         current_color += color_step
 
+    return hist, bin_edges, bar_colors
+
+
+def draw_channel_histogram(fig, ax, layer_name, channel_idx, hist, bin_edges):
+    '''
+    draws the max activations histogram of a single channel on an empty axes
+    :return: percent of the inputs on which the channel is dead
+    '''
+
+    width = 0.7 * (bin_edges[1] - bin_edges[0])
+    center = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    barlist = ax.bar(center, hist, align='center', width=width, color='g')
+
+    # mark dead bar in red
+    dead_bin, percent_dead = get_dead_bin(hist, bin_edges)
+    if dead_bin is not None:
+        barlist[dead_bin].set_color('r')
+
+    fig.suptitle('max activations histgoram of layer %s channel %d' % (layer_name,channel_idx))
+    ax.xaxis.label.set_text('max activation value')
+    ax.yaxis.label.set_text('inputs count')
+
+    return percent_dead
+
+
+def draw_layer_inactivity(fig, ax, layer_name, percent_dead):
+    '''draws the histogram of the activity of the channels of a layer on an empty axes'''
+
+    hist, bin_edges, bar_colors = get_layer_inactivity_histogram(percent_dead)
+    width = 0.7 * (bin_edges[1] - bin_edges[0])
+    center = (bin_edges[:-1] + bin_edges[1:]) / 2
+
     ax.bar(center, hist, align='center', width=width, color=bar_colors)
 
     fig.suptitle('activity of layer %s' % (layer_name))
     ax.xaxis.label.set_text('activity percent')
     ax.yaxis.label.set_text('channels count')
 
+
+def rasterize_max_histograms(layer_name, channel_histograms, channel_shape, layer_shape):
+    '''
+    draws the max activations histograms of the channels of a layer and the activity histogram of the layer, as
+    prepare_max_histogram does, with the fast rasterizer instead of matplotlib
+    :param channel_histograms: list of (hist, bin_edges) tuples, one for each channel
+    :param channel_shape: (height, width) of the histogram image of each channel
+    :param layer_shape: (height, width) of the histogram image of the layer
+    :return: (n_channels, height, width, 3) uint8 array of the channel images, and the (height, width, 3) layer image
+    '''
+
+    n_channels = len(channel_histograms)
+    channel_images = np.empty((n_channels, channel_shape[0], channel_shape[1], 3), dtype=np.uint8)
+
+    percent_dead = np.zeros((n_channels), dtype=np.float32)
+    for channel_idx, (hist, bin_edges) in enumerate(channel_histograms):
+
+        # mark dead bar in red
+        dead_bin, percent_dead[channel_idx] = get_dead_bin(hist, bin_edges)
+        bar_colors = [(0, 0.5, 0)] * len(hist)
+        if dead_bin is not None:
+            bar_colors[dead_bin] = (1.0, 0, 0)
+
+        rasterize_histogram(hist, bin_edges, channel_shape, 'max activations histgoram of layer %s channel %d' % (layer_name, channel_idx),
+                            'max activation value', 'inputs count', bar_colors, out = channel_images[channel_idx])
+
+    hist, bin_edges, bar_colors = get_layer_inactivity_histogram(percent_dead)
+    layer_image = rasterize_histogram(hist, bin_edges, layer_shape, 'activity of layer %s' % (layer_name),
+                                      'activity percent', 'channels count', bar_colors)
+
+    return channel_images, layer_image
+
+
+def prepare_max_histogram(layer_name, n_channels, channel_to_histogram_values, process_channel_figure, process_layer_figure):
+
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(111)
+
+    # for each channel
+    percent_dead = np.zeros((n_channels), dtype=np.float32)
+    for channel_idx in xrange(n_channels):
+
+        if channel_idx % 100 == 0:
+            print "calculating histogram for channel %d out of %d" % (channel_idx, n_channels)
+
+        hist, bin_edges = channel_to_histogram_values(channel_idx)
+
+        # generate histogram image file
+        percent_dead[channel_idx] = draw_channel_histogram(fig, ax, layer_name, channel_idx, hist, bin_edges)
+
+        process_channel_figure(channel_idx, fig)
+
+        ax.cla()
+
+    # generate histogram for layer
+    draw_layer_inactivity(fig, ax, layer_name, percent_dead)
+
     process_layer_figure(fig)
 
     fig.clf()
@@ -141,6 +253,117 @@ def prepare_max_histogram(layer_name, n_channels, channel_to_histogram_values, p
     pass
 
 
+def get_channel_histogram_filename(outdir, layer_name, channel_idx):
+    return os.path.join(outdir, layer_name, 'unit_%04d' % channel_idx, 'max_histogram.png')
+
+
+def save_channel_histograms(layer_name, outdir, channel_idx_begin, channel_histograms):
+    '''
+    renders and saves the max histogram figures of a range of channels, on a figure of its own, so ranges can be
+    rendered in parallel by worker processes
+    :param channel_idx_begin: index of the first channel of the range
+    :param channel_histograms: list of (hist, bin_edges) tuples of the channels of the range
+    :return: array of the percent dead of the channels of the range
+    '''
+
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(111)
+
+    percent_dead = np.zeros((len(channel_histograms)), dtype=np.float32)
+    for cc, (hist, bin_edges) in enumerate(channel_histograms):
+        channel_idx = channel_idx_begin + cc
+
+        percent_dead[cc] = draw_channel_histogram(fig, ax, layer_name, channel_idx, hist, bin_edges)
+
+        filename = get_channel_histogram_filename(outdir, layer_name, channel_idx)
+        mkdir_p(os.path.dirname(filename))
+        fig.savefig(filename)
+
+        ax.cla()
+
+    fig.clf()
+    plt.close(fig)
+
+    return percent_dead
+
+
+def _save_channel_histograms_from_args(args):
+    return save_channel_histograms(*args)
+
+
+def save_max_histograms(layer_name, outdir, channel_histograms, pool = None, n_ranges = 1):
+    '''
+    saves the max histogram figure of every channel of a layer, and the activity figure of the layer
+    :param channel_histograms: list of (hist, bin_edges) tuples, one for each channel
+    :param pool: multiprocessing pool which renders ranges of channels in parallel, None renders them serially
+    :param n_ranges: number of ranges of channels to split the layer into, usually a few per worker of the pool, so
+                     workers which finish early take more work
+    '''
+
+    import matplotlib.pyplot as plt
+
+    n_channels = len(channel_histograms)
+
+    range_size = max(1, int(np.ceil(n_channels / float(max(n_ranges, 1)))))
+    ranges_begin = range(0, n_channels, range_size) if n_channels > 0 else [0]
+    ranges_end = ranges_begin[1:] + [n_channels]
+    args_list = [(layer_name, outdir, begin, channel_histograms[begin:end]) for begin, end in zip(ranges_begin, ranges_end)]
+
+    print "calculating histograms for %d channels in %d range(s)" % (n_channels, len(args_list))
+    if pool is None:
+        percent_dead_list = map(_save_channel_histograms_from_args, args_list)
+    else:
+        percent_dead_list = pool.map(_save_channel_histograms_from_args, args_list)
+
+    # generate histogram for layer, from the percent dead collected from all the ranges
+    percent_dead = np.concatenate(percent_dead_list)
+
+    fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(111)
+    draw_layer_inactivity(fig, ax, layer_name, percent_dead)
+    fig.savefig(os.path.join(outdir, layer_name, 'layer_inactivity.png'))
+    fig.clf()
+    plt.close(fig)
+
+
+def merge_top_values(vals, locs, cand_vals, cand_locs, cand_valid, keep_largest):
+    '''
+    merges candidate values into per-channel top tables, in place, for all channels at once
+    the result is identical to inserting the candidates one by one (in column order) using np.searchsorted, which means
+    that a newer value is placed below older equal values, in both the max table and the min table
+    :param vals: (n_channels, n_top) array of values, sorted in ascending order per channel
+    :param locs: (n_channels, n_top, loc_size) array of locations matching vals
+    :param cand_vals: (n_channels, n_cand) array of candidate values, columns ordered from oldest to newest
+    :param cand_locs: (n_channels, n_cand, loc_size) array of candidate locations
+    :param cand_valid: (n_channels, n_cand) boolean array, invalid candidates (e.g. NaN) are ignored
+    :param keep_largest: True to keep the n_top largest values (max table), False to keep the n_top smallest (min table)
+    :return: none
+    '''
+
+    n_channels, n_top = vals.shape
+    n_cand = cand_vals.shape[1]
+
+    all_vals = np.concatenate((vals, cand_vals.astype(vals.dtype)), axis=1)
+    all_locs = np.concatenate((locs, cand_locs.astype(locs.dtype)), axis=1)
+
+    # existing entries are the oldest, then candidates by column order. sorting by value and then by newness (newest first) places newer values
+    # below older equal values, which is exactly where np.searchsorted would have inserted them
+    newness = np.tile(np.arange(n_top + n_cand) - n_top + 1, (n_channels, 1)).clip(0)
+    valid = np.concatenate((np.ones((n_channels, n_top), dtype=bool), cand_valid), axis=1)
+
+    # invalid candidates are ordered to the side that gets discarded
+    if keep_largest:
+        order = np.lexsort((-newness, all_vals, valid), axis=1)[:, -n_top:]
+    else:
+        order = np.lexsort((-newness, all_vals, ~valid), axis=1)[:, :n_top]
+
+    rows = np.arange(n_channels)[:, np.newaxis]
+    vals[:] = all_vals[rows, order]
+    locs[:] = all_locs[rows, order]
+
+
 class MaxTracker(object):
 
     def __init__(self, is_spatial, n_channels, n_top = 10, initial_val = -1e99, dtype = 'float32', search_min = False):
@@ -161,146 +384,183 @@ class MaxTracker(object):
             else:
                 self.min_locs = -np.ones((n_channels, n_top, 2), dtype='int')  # image_idx, selected_input_index
 
-        # set of seen inputs, used to avoid updating on the same input twice
-        self.seen_inputs = set()
+        # index of seen inputs, used to avoid updating on the same input twice
+        self.seen_inputs = SeenInputsIndex()
 
-        # will hold a list of np array, each containing the max values of all the channels for one input
-        self.all_max_vals = list()
+        # streaming histogram of the max values of each channel, covers all the inputs
+        self.histogram_sketch = ChannelHistogramSketch(n_channels)
+
+        # streaming co-moments of the max values of all channels, used for the correlation of channels over all the inputs
+        self.correlation_accumulator = CoMomentAccumulator(n_channels)
 
         # keeps a map between channel index and histogram values
         self.channel_to_histogram = [None] * n_channels
 
-    def __getstate__(self):
-        # Copy the object's state from self.__dict__ which contains
-        # all our instance attributes. Always use the dict.copy()
-        # method to avoid modifying the original state.
-        state = self.__dict__.copy()
-        # Remove the unpicklable entries.
-        del state['seen_inputs']
-        del state['all_max_vals']
-        return state
-
     def __setstate__(self, state):
         # Restore instance attributes (i.e., filename and lineno).
         self.__dict__.update(state)
 
-        self.seen_inputs = None
-        self.all_max_vals = None
+        # trackers saved by older versions did not keep their seen inputs
+        if 'seen_inputs' not in state:
+            self.seen_inputs = None
 
     def __repr__(self):
-        return str(self.__dict__.copy())
+        state = self.__dict__.copy()
+        # skip the per input and per channel pair entries, which are too big to be useful in a text dump
+        for key in ['seen_inputs', 'all_max_vals', 'histogram_sketch', 'correlation_accumulator']:
+            state.pop(key, None)
+        return str(state)
 
     def update(self, data, image_idx, selected_input_index, layer_unique_input_source, layer_name):
 
-        # if unique_input_source already exist, we can skip the update since we've already seen it
-        if layer_unique_input_source in self.seen_inputs:
+        self.update_batch(data[np.newaxis], [image_idx], [selected_input_index], [layer_unique_input_source], layer_name)
+
+    def update_batch(self, data, image_indices, selected_input_indices, layer_unique_input_sources, layer_name):
+        '''
+        updates the tracker with a batch of inputs at once
+        :param data: layer output for the whole batch, shape (N, n_channels) or (N, n_channels, H, W)
+        :param image_indices: list of N image indices
+        :param selected_input_indices: list of N selected input indices
+        :param layer_unique_input_sources: list of N input identifiers, used to avoid updating on the same input twice
+        :param layer_name: layer name
+        :return: none
+        '''
+
+        # if unique_input_source already exist, we can skip the update since we've already seen it, this also covers
+        # repeated inputs inside the batch
+        keep = np.flatnonzero(self.seen_inputs.add(hash_inputs(layer_unique_input_sources)))
+
+        if len(keep) == 0:
             return
 
-        # add input identifier to seen inputs set
-        self.seen_inputs.add(layer_unique_input_source)
+        if len(keep) != data.shape[0]:
+            data = data[keep]
+        n_inputs = data.shape[0]
+        n_channels = data.shape[1]
+        data_unroll = data.reshape((n_inputs, n_channels, -1))   # Note: no copy eg (64,96,3025). Does nothing if not is_spatial
 
-        n_channels = data.shape[0]
-        data_unroll = data.reshape((n_channels, -1))          # Note: no copy eg (96,3025). Does nothing if not is_spatial
+        max_indexes = data_unroll.argmax(2)   # maxes for each input and channel, eg. (64,96)
+        maxes = data_unroll[np.arange(n_inputs)[:, np.newaxis], np.arange(n_channels), max_indexes]
 
-        max_indexes = data_unroll.argmax(1)   # maxes for each channel, eg. (96,)
+        # add maxes for all channels to the histogram and correlation statistics
+        self.histogram_sketch.update(maxes)
+        self.correlation_accumulator.update(maxes)
 
-        # add maxes for all channels to a list, bounded to avoid consuming too much memory
-        maxes = data_unroll[range(n_channels), max_indexes]
-        MAX_LIST_SIZE = 10000
-        if len(self.all_max_vals) < MAX_LIST_SIZE:
-            self.all_max_vals.append(maxes)
+        # skip nan, only warn once per input
+        is_nan = np.isnan(maxes)
+        for input_index in np.flatnonzero(is_nan.any(1)):
+            print 'WARNING: got NAN activation on input', str(layer_unique_input_sources[keep[input_index]])
 
-        produced_warning = False
+        # build candidate locations for all inputs and channels at once
+        loc_size = self.max_locs.shape[2]
+        cand_locs = np.empty((n_channels, n_inputs, loc_size), dtype=self.max_locs.dtype)
+        cand_locs[:, :, 0] = np.array(image_indices)[keep]
+        cand_locs[:, :, 1] = np.array(selected_input_indices)[keep]
+        if self.is_spatial:
+            cand_locs[:, :, 2], cand_locs[:, :, 3] = np.unravel_index(max_indexes.T, data.shape[2:])
 
-        #insertion_idx = zeros((n_channels,))
-        #pdb.set_trace()
-        for ii in xrange(n_channels):
+        cand_vals = maxes.T
+        cand_valid = ~is_nan.T
 
-            max_value = data_unroll[ii, max_indexes[ii]]
+        merge_top_values(self.max_vals, self.max_locs, cand_vals, cand_locs, cand_valid, keep_largest=True)
 
-            # skip nan
-            if np.isnan(max_value):
-                # only warn once
-                if not produced_warning:
-                    print 'WARNING: got NAN activation on input', str(layer_unique_input_source)
-                    produced_warning = True
-                continue
+        if self.search_min:
+            merge_top_values(self.min_vals, self.min_locs, cand_vals, cand_locs, cand_valid, keep_largest=False)
+
+    def merge(self, other):
+        '''
+        merges the results of another tracker, which scanned inputs that come after the inputs of this tracker
+        the result is identical to a single tracker which scanned the inputs of both, except for inputs which appear
+        in both, which are counted twice
+        :param other: MaxTracker to merge into this one
+        :return: none
+        '''
+
+        assert self.max_vals.shape == other.max_vals.shape, 'cannot merge trackers with different shapes %s and %s' % (self.max_vals.shape, other.max_vals.shape)
+        assert self.is_spatial == other.is_spatial
+        assert self.search_min == other.search_min, 'cannot merge trackers with different search_min'
+
+        # in each table newer values are placed below older equal values, so reversing the columns of the other table
+        # feeds its values in the same order they were originally inserted
+        n_channels = self.max_vals.shape[0]
+        all_valid = np.ones((n_channels, self.n_top), dtype=bool)
+        merge_top_values(self.max_vals, self.max_locs, other.max_vals[:, ::-1], other.max_locs[:, ::-1], all_valid, keep_largest=True)
 
-            idx = np.searchsorted(self.max_vals[ii], max_value)
-            # if not smaller than all elements
-            if idx != 0:
-                # Store new value in the proper order. Update both arrays:
-                # self.max_vals:
-                self.max_vals[ii,:idx-1] = self.max_vals[ii,1:idx]       # shift lower values
-                self.max_vals[ii,idx-1] = max_value                      # store new max value
-                # self.max_locs
-                self.max_locs[ii,:idx-1] = self.max_locs[ii,1:idx]       # shift lower location data
-                # store new location
-                if self.is_spatial:
-                    self.max_locs[ii,idx-1] = (image_idx, selected_input_index) + np.unravel_index(max_indexes[ii], data.shape[1:])
-                else:
-                    self.max_locs[ii,idx-1] = (image_idx, selected_input_index)
-
-            if self.search_min:
-                idx = np.searchsorted(self.min_vals[ii], max_value)
-                # if not bigger than all elements
-                if idx != self.n_top:
-                    # Store new value in the proper order. Update both arrays:
-                    # self.min_vals:
-                    self.min_vals[ii, (idx+1):(self.n_top)] = self.min_vals[ii, idx:(self.n_top-1)]  # shift upper values
-                    self.min_vals[ii, idx] = max_value  # store new value
-                    # self.min_locs
-                    self.min_locs[ii, (idx+1):(self.n_top)] = self.min_locs[ii, idx:(self.n_top-1)]  # shift upper location data
-                    # store new location
-                    if self.is_spatial:
-                        self.min_locs[ii, idx] = (image_idx, selected_input_index) + np.unravel_index(max_indexes[ii], data.shape[1:])
-                    else:
-                        self.min_locs[ii, idx] = (image_idx, selected_input_index)
-
-    def calculate_histogram(self, layer_name, outdir):
-
-        # convert list of arrays to numpy array
-        all_max_array = np.vstack(self.all_max_vals)
-
-        def channel_to_histogram_values(channel_idx):
-            # get values
-            max_for_single_channel = all_max_array[:, channel_idx]
-
-            # create histogram
-            hist, bin_edges = np.histogram(max_for_single_channel, bins=50)
-
-            # save histogram values
-            self.channel_to_histogram[channel_idx] = (hist, bin_edges)
+        if self.search_min:
+            merge_top_values(self.min_vals, self.min_locs, other.min_vals[:, ::-1], other.min_locs[:, ::-1], all_valid, keep_largest=False)
 
-            return hist, bin_edges
+        if self.seen_inputs is not None and other.seen_inputs is not None:
+            self.seen_inputs.merge(other.seen_inputs)
 
-        def process_channel_figure(channel_idx, fig):
-            unit_dir = os.path.join(outdir, layer_name, 'unit_%04d' % channel_idx)
-            mkdir_p(unit_dir)
-            filename = os.path.join(unit_dir, 'max_histogram.png')
-            fig.savefig(filename)
-            pass
+        self.histogram_sketch.merge(other.histogram_sketch)
+        self.correlation_accumulator.merge(other.correlation_accumulator)
 
-        def process_layer_figure(fig):
-            filename = os.path.join(outdir, layer_name, 'layer_inactivity.png')
-            fig.savefig(filename)
-            pass
+        # histograms must be recalculated on the merged values
+        self.channel_to_histogram = [None] * n_channels
+
+    def get_channel_histograms(self):
+        '''
+        returns the histogram of max values of each channel, derived from the histogram sketch
+        :return: list of (hist, bin_edges) tuples, one for each channel, or None if the tracker has no histogram data
+        '''
+
+        sketch = getattr(self, 'histogram_sketch', None)
+
+        # trackers saved before the histogram sketch was introduced
+        if sketch is None:
+            if all(histogram is not None for histogram in self.channel_to_histogram):
+                return self.channel_to_histogram
+            if not getattr(self, 'all_max_vals', None):
+                return None
+            sketch = ChannelHistogramSketch(self.max_vals.shape[0])
+            sketch.update(np.vstack(self.all_max_vals))
+
+        hists, bin_edges = sketch.get_histograms()
+        return [(hists[channel_idx], bin_edges[channel_idx]) for channel_idx in xrange(hists.shape[0])]
+
+    def calculate_histogram(self, layer_name, outdir, pool = None, n_ranges = 1):
+        '''
+        saves the max histogram figures of the channels of the layer, and the activity figure of the layer
+        :param pool: multiprocessing pool which renders the figures in parallel, None renders them serially
+        :param n_ranges: number of ranges of channels rendered by the pool
+        '''
+
+        channel_histograms = self.get_channel_histograms()
+
+        # save histogram values
+        for channel_idx, (hist, bin_edges) in enumerate(channel_histograms):
+            self.channel_to_histogram[channel_idx] = (hist, bin_edges)
 
-        n_channels = all_max_array.shape[1]
-        prepare_max_histogram(layer_name, n_channels, channel_to_histogram_values, process_channel_figure, process_layer_figure)
+        save_max_histograms(layer_name, outdir, channel_histograms, pool, n_ranges)
 
         pass
 
-    def calculate_correlation(self, layer_name, outdir):
+    def get_correlation(self):
+        '''
+        returns the correlation matrix of the max values of the channels over all inputs
+        :return: (n_channels, n_channels) array, or None if the tracker has no correlation data
+        '''
+
+        accumulator = getattr(self, 'correlation_accumulator', None)
+
+        # trackers saved before the correlation accumulator was introduced
+        if accumulator is None:
+            if not getattr(self, 'all_max_vals', None):
+                return None
+            return np.corrcoef(np.vstack(self.all_max_vals).transpose())
 
-        # convert list of arrays to numpy array
-        all_max_array = np.vstack(self.all_max_vals)
+        return accumulator.get_correlation()
+
+    def calculate_correlation(self, layer_name, outdir):
 
         # skip layers with only one channel
-        if all_max_array.shape[1] == 1:
+        if self.max_vals.shape[0] == 1:
             return
 
-        corr = np.corrcoef(all_max_array.transpose())
+        corr = self.get_correlation()
+        if corr is None:
+            print "WARNING: no correlation data for layer %s" % layer_name
+            return
 
         # fix possible NANs
         corr = np.nan_to_num(corr)
@@ -348,6 +608,16 @@ class NetMaxTracker(object):
         self.settings = settings
         self.siamese_helper = SiameseHelper(self.settings.layers_list)
 
+        # range of image indices [begin, end) scanned into this tracker, used to order shards when merging
+        self.scanned_range = None
+
+        # index of all the inputs scanned into this tracker, used by incremental scans to skip inputs seen before
+        self.seen_inputs = SeenInputsIndex()
+
+        # digest and length of the file list which the image indices of this tracker refer to
+        self.file_list_digest = None
+        self.file_list_length = None
+
     def _init_with_net(self, net):
         self.max_trackers = {}
 
@@ -371,79 +641,114 @@ class NetMaxTracker(object):
 
         self.init_done = True
 
+    def _init_layer_plans(self, net):
+        '''precomputes, once, everything needed to route each layer blob to its MaxTracker'''
+
+        self._layer_plans = []
+
+        for layer_name in self.layers:
+
+            # normalize layer name, this is used for siamese networks where we want layers "conv_1" and "conv_1_p" to
+            # count as the same layer in terms of activations
+            normalized_layer_name = self.siamese_helper.normalize_layer_name_for_max_tracker(layer_name)
+
+            layer_format = self.siamese_helper.get_layer_format_by_layer_name(layer_name)
+            if not self.settings.is_siamese:
+                layer_format = 'normal'
+
+            self._layer_plans.append(MaxTrackerLayerPlan(layer_name = layer_name,
+                                                         top_name = layer_name_to_top_name(net, layer_name),
+                                                         normalized_layer_name = normalized_layer_name,
+                                                         layer_format = layer_format,
+                                                         selected_input_index = self.siamese_helper.get_index_of_saved_image_by_layer_name(layer_name)))
+
     def update(self, net, image_idx, net_unique_input_source, batch_index):
         '''Updates the maxes found so far with the state of the given net. If a new max is found, it is stored together with the image_idx.'''
 
+        self.update_batch(net, [image_idx], [net_unique_input_source], batch_indices=[batch_index])
+
+    def update_batch(self, net, image_indices, net_unique_input_sources, batch_indices = None):
+        '''
+        Updates the maxes found so far with the state of the given net, for a whole batch at once
+        :param net: network after forward pass on the batch
+        :param image_indices: list of image indices, one for each batch item
+        :param net_unique_input_sources: list of input identifiers, one for each batch item
+        :param batch_indices: list of batch items to use, default is the first len(image_indices) items in the batch
+        :return: none
+        '''
+
         if not self.init_done:
             self._init_with_net(net)
 
-        for layer_name in self.layers:
+        if getattr(self, '_layer_plans', None) is None:
+            self._init_layer_plans(net)
 
-            # print "processing layer %s" % layer_name
+        if self.seen_inputs is not None:
+            self.seen_inputs.add(hash_inputs(net_unique_input_sources))
 
-            top_name = layer_name_to_top_name(net, layer_name)
-            blob = net.blobs[top_name].data
+        n_inputs = len(image_indices)
 
-            normalized_layer_name = self.siamese_helper.normalize_layer_name_for_max_tracker(layer_name)
+        for plan in self._layer_plans:
 
-            layer_format = self.siamese_helper.get_layer_format_by_layer_name(layer_name)
+            blob = net.blobs[plan.top_name].data
+            max_tracker = self.max_trackers[plan.normalized_layer_name]
 
             # in siamese network, implemented as pairs of layers, we might need to select one of the images from the siamese pair
-            if self.settings.is_siamese and layer_format == 'siamese_layer_pair':
-                selected_input_index = self.siamese_helper.get_index_of_saved_image_by_layer_name(layer_name)
+            if plan.layer_format == 'siamese_layer_pair':
+                data = blob[:n_inputs] if batch_indices is None else blob[batch_indices]
 
-                if selected_input_index == 0:
-                    # first image identifier is selected
-                    self.max_trackers[normalized_layer_name].update(blob[batch_index], image_idx, selected_input_index,
-                                                                    net_unique_input_source[0], layer_name)
-
-                elif selected_input_index == 1:
-                    # second image identifier is selected
-                    self.max_trackers[normalized_layer_name].update(blob[batch_index], image_idx, selected_input_index,
-                                                                    net_unique_input_source[1], layer_name)
-
-                elif selected_input_index == -1:
+                if plan.selected_input_index in (0, 1):
+                    # first or second image identifier is selected
+                    sources = [source[plan.selected_input_index] for source in net_unique_input_sources]
+                else:
                     # both images are selected
-                    self.max_trackers[normalized_layer_name].update(blob[batch_index], image_idx, selected_input_index,
-                                                                    net_unique_input_source, layer_name)
+                    sources = net_unique_input_sources
+
+                max_tracker.update_batch(data, image_indices, [plan.selected_input_index] * n_inputs, sources, plan.layer_name)
 
             # in siamese network, implemented as single layer with batch 2, we might need to select one of the images from the siamese pair
-            elif self.settings.is_siamese and layer_format == 'siamese_batch_pair':
+            elif plan.layer_format == 'siamese_batch_pair':
 
                 assert (self.settings.max_tracker_batch_size == 1)
+                image_idx = image_indices[0]
+                net_unique_input_source = net_unique_input_sources[0]
 
                 # if batch size is 2, then we have two outputs in this layer, so we update both of them
                 if blob.shape[0] == 2:
-
-                    # update first output
-                    self.max_trackers[normalized_layer_name].update(blob[0], image_idx, 0,
-                                                                    net_unique_input_source[0], layer_name)
-
-                    # update second output
-                    self.max_trackers[normalized_layer_name].update(blob[1], image_idx, 1,
-                                                                    net_unique_input_source[1], layer_name)
+                    max_tracker.update_batch(blob, [image_idx, image_idx], [0, 1], list(net_unique_input_source), plan.layer_name)
 
                 # we have single output
                 elif blob.shape[0] == 1:
-                    self.max_trackers[normalized_layer_name].update(blob[0], image_idx, -1,
-                                                                    net_unique_input_source, layer_name)
+                    max_tracker.update_batch(blob, [image_idx], [-1], [net_unique_input_source], plan.layer_name)
 
             else:   # normal, non-siamese network
-                self.max_trackers[normalized_layer_name].update(blob[batch_index], image_idx, -1, net_unique_input_source, layer_name)
+                data = blob[:n_inputs] if batch_indices is None else blob[batch_indices]
+                max_tracker.update_batch(data, image_indices, [-1] * n_inputs, net_unique_input_sources, plan.layer_name)
 
         pass
 
     def calculate_histograms(self, outdir):
 
         print "calculate_histograms on network"
-        for layer_name in self.layers:
-            print "calculate_histogram on layer %s" % layer_name
 
-            # normalize layer name, this is used for siamese networks where we want layers "conv_1" and "conv_1_p" to
-            # count as the same layer in terms of activations
-            normalized_layer_name = self.siamese_helper.normalize_layer_name_for_max_tracker(layer_name)
+        # histogram figures are rendered by worker processes, each with a figure of its own
+        n_workers = self.settings.max_tracker_histogram_workers
+        pool = Pool(n_workers) if n_workers > 0 else None
 
-            self.max_trackers[normalized_layer_name].calculate_histogram(layer_name, outdir)
+        try:
+            for layer_name in self.layers:
+                print "calculate_histogram on layer %s" % layer_name
+
+                # normalize layer name, this is used for siamese networks where we want layers "conv_1" and "conv_1_p" to
+                # count as the same layer in terms of activations
+                normalized_layer_name = self.siamese_helper.normalize_layer_name_for_max_tracker(layer_name)
+
+                self.max_trackers[normalized_layer_name].calculate_histogram(layer_name, outdir, pool, n_workers * 4)
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         pass
 
@@ -461,6 +766,59 @@ class NetMaxTracker(object):
 
         pass
 
+    def merge(self, other):
+        '''merges the results of another tracker, which scanned inputs that come after the inputs of this tracker'''
+
+        assert self.n_top == other.n_top, 'cannot merge trackers with different n_top (%d and %d)' % (self.n_top, other.n_top)
+        assert sorted(self.max_trackers.keys()) == sorted(other.max_trackers.keys()), 'cannot merge trackers of different layers'
+
+        if self.file_list_digest is not None and other.file_list_digest is not None:
+            assert (self.file_list_digest, self.file_list_length) == (other.file_list_digest, other.file_list_length), \
+                'cannot merge trackers which scanned different file lists'
+
+        for normalized_layer_name, max_tracker in self.max_trackers.iteritems():
+            max_tracker.merge(other.max_trackers[normalized_layer_name])
+
+        if self.seen_inputs is not None and other.seen_inputs is not None:
+            self.seen_inputs.merge(other.seen_inputs)
+        else:
+            self.seen_inputs = None
+
+        if self.scanned_range is not None and other.scanned_range is not None:
+            self.scanned_range = (min(self.scanned_range[0], other.scanned_range[0]), max(self.scanned_range[1], other.scanned_range[1]))
+        else:
+            self.scanned_range = None
+
+    def set_file_list(self, image_filenames):
+        '''
+        records the file list which is scanned into this tracker. an existing tracker can only be updated with a file
+        list that starts with the file list it was scanned with, otherwise the image indices it holds would be wrong
+        :param image_filenames: the whole file list, including files outside of the scanned range
+        :return: none
+        '''
+
+        if self.file_list_length is not None:
+            assert len(image_filenames) >= self.file_list_length and \
+                   get_file_list_digest(image_filenames[:self.file_list_length]) == self.file_list_digest, \
+                'file list changed since this tracker was scanned, new files must be appended to the end of the list'
+
+        self.file_list_digest = get_file_list_digest(image_filenames)
+        self.file_list_length = len(image_filenames)
+
+    def get_unseen_image_indices(self, image_filenames, image_idx_begin, image_idx_end):
+        '''returns the indices in range [image_idx_begin, image_idx_end) of the inputs not scanned into this tracker yet'''
+
+        if self.seen_inputs is None:
+            return range(image_idx_begin, image_idx_end)
+
+        is_seen = self.seen_inputs.contains(hash_inputs(image_filenames[image_idx_begin:image_idx_end]))
+        return [image_idx_begin + int(offset) for offset in np.flatnonzero(~is_seen)]
+
+    def restore_settings(self, settings):
+        '''restores the members which are not pickled, needed before updating an unpickled tracker'''
+        self.settings = settings
+        self.siamese_helper = SiameseHelper(self.settings.layers_list)
+
     def __getstate__(self):
         # Copy the object's state from self.__dict__ which contains
         # all our instance attributes. Always use the dict.copy()
@@ -469,6 +827,8 @@ class NetMaxTracker(object):
         # Remove the unpicklable entries.
         del state['settings']
         del state['siamese_helper']
+        # layer plans are derived from the net, and rebuilt on the next update
+        state.pop('_layer_plans', None)
         return state
 
 
@@ -478,8 +838,111 @@ class NetMaxTracker(object):
 
         self.settings = None
         self.siamese_helper = None
+        self._layer_plans = None
+
+        # trackers saved by older versions did not keep their seen inputs and file list
+        if 'seen_inputs' not in state:
+            self.seen_inputs = None
+            self.file_list_digest = None
+            self.file_list_length = None
+
+
+class ScanCheckpoint(object):
+    '''periodically saves the state of a scan, so a long scan can be resumed after the process dies'''
+
+    def __init__(self, filename, every_images = None, every_minutes = None):
+        self.filename = filename
+        self.every_images = every_images
+        self.every_minutes = every_minutes
+        self._images_since_save = 0
+        self._last_save_time = time.time()
+
+    def load(self, settings):
+        '''
+        loads the last checkpoint
+        :param settings: settings to attach to the loaded tracker
+        :return: tracker and index of next image to scan, or (None, 0) if there is no checkpoint
+        '''
+
+        if not os.path.isfile(self.filename):
+            print 'No checkpoint found in %s, starting a new scan' % self.filename
+            return None, 0
+
+        with open(self.filename, 'rb') as checkpoint_file:
+            state = pickle.load(checkpoint_file)
+
+        tracker = state['net_max_tracker']
+        tracker.restore_settings(settings)
+
+        print 'Resuming scan from checkpoint %s at image %d' % (self.filename, state['next_image_idx'])
+        return tracker, state['next_image_idx']
+
+    def save(self, tracker, next_image_idx):
+
+        state = {'net_max_tracker': tracker,
+                 'next_image_idx': next_image_idx}
+
+        with WithTimer('Saving checkpoint'):
+            mkdir_p(os.path.dirname(os.path.abspath(self.filename)))
+            save_pickle_atomically(state, self.filename)
+
+        self._images_since_save = 0
+        self._last_save_time = time.time()
+
+    def update(self, tracker, next_image_idx, n_images):
+        '''called after each batch, saves a checkpoint when one is due'''
+
+        self._images_since_save += n_images
+
+        due_by_images = self.every_images and self._images_since_save >= self.every_images
+        due_by_time = self.every_minutes and (time.time() - self._last_save_time) >= self.every_minutes * 60
+        if due_by_images or due_by_time:
+            self.save(tracker, next_image_idx)
+
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+def merge_max_trackers(net_max_trackers):
+    '''
+    merges trackers of several shards of the same file list into one tracker
+    trackers are merged in the order of their scanned ranges when available, otherwise in the given order
+    :param net_max_trackers: list of NetMaxTracker
+    :return: merged NetMaxTracker, the first tracker in merge order is updated in place
+    '''
+
+    assert len(net_max_trackers) > 0, 'nothing to merge'
+
+    if all(getattr(tracker, 'scanned_range', None) is not None for tracker in net_max_trackers):
+        net_max_trackers = sorted(net_max_trackers, key=lambda tracker: tracker.scanned_range)
+
+    merged = net_max_trackers[0]
+    for tracker in net_max_trackers[1:]:
+        merged.merge(tracker)
+
+    return merged
 
-def scan_images_for_maxes(settings, net, datadir, n_top, outdir, search_min):
+
+def get_file_list_digest(image_filenames):
+    '''returns a digest of the file list, used to verify that image indices of a saved tracker still refer to the same files'''
+
+    digest = hashlib.md5()
+    for filename in image_filenames:
+        digest.update(repr(filename))
+        digest.update('\n')
+    return digest.hexdigest()
+
+
+def get_shard_range(n_files, shard_index, shard_count):
+    '''returns the range of image indices [begin, end) handled by a shard, shards are contiguous and balanced'''
+
+    assert 0 <= shard_index < shard_count, 'invalid shard index %d for %d shards' % (shard_index, shard_count)
+    return (n_files * shard_index) // shard_count, (n_files * (shard_index + 1)) // shard_count
+
+
+def scan_images_for_maxes(settings, net, datadir, n_top, outdir, search_min, tracker = None, first_image_idx = 0, checkpoint = None,
+                          image_idx_end = None):
     image_filenames, image_labels = get_files_list(settings)
     print 'Scanning %d files' % len(image_filenames)
     print '  First file', os.path.join(datadir, image_filenames[0])
@@ -487,7 +950,23 @@ def scan_images_for_maxes(settings, net, datadir, n_top, outdir, search_min):
     sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
     import caffe
 
-    tracker = NetMaxTracker(settings, n_top = n_top, layers=settings.layers_to_output_in_offline_scripts, search_min=search_min)
+    # a shard scans only part of the file list, but keeps the global image indices
+    if image_idx_end is None:
+        image_idx_end = len(image_filenames)
+
+    # a resumed scan continues updating the tracker loaded from the checkpoint
+    if tracker is None:
+        tracker = NetMaxTracker(settings, n_top = n_top, layers=settings.layers_to_output_in_offline_scripts, search_min=search_min)
+
+    # a resumed tracker keeps the beginning of its range
+    if getattr(tracker, 'scanned_range', None) is None:
+        tracker.scanned_range = (first_image_idx, first_image_idx)
+
+    # an existing tracker only scans the inputs it has not seen yet
+    tracker.set_file_list(image_filenames)
+    image_indices = tracker.get_unseen_image_indices(image_filenames, first_image_idx, image_idx_end)
+    if len(image_indices) < image_idx_end - first_image_idx:
+        print 'Skipping %d inputs already scanned into the tracker' % (image_idx_end - first_image_idx - len(image_indices))
 
     net_input_dims = net.blobs['data'].data.shape[2:4]
 
@@ -498,7 +977,15 @@ def scan_images_for_maxes(settings, net, datadir, n_top, outdir, search_min):
 
     batch_index = 0
 
-    for image_idx in xrange(len(image_filenames)):
+    # decode and resize the next inputs in the background while the net works on the current batch
+    loaded_images = prefetch_images(load_image_for_scan,
+                                    [(settings.caffevis_caffe_root, datadir, image_filenames[image_idx], not settings._calculated_is_gray_model, net_input_dims)
+                                     for image_idx in image_indices],
+                                    settings.max_tracker_prefetch_workers, settings.max_tracker_prefetch_use_processes,
+                                    get_max_pending(settings.max_tracker_prefetch_workers, settings.max_tracker_batch_size,
+                                                    settings.max_tracker_prefetch_batches))
+
+    for position, image_idx in enumerate(image_indices):
 
         batch[batch_index].image_idx = image_idx
         batch[batch_index].filename = image_filenames[image_idx]
@@ -508,39 +995,41 @@ def scan_images_for_maxes(settings, net, datadir, n_top, outdir, search_min):
             print '%s   Image %d/%d' % (datetime.now().ctime(), batch[batch_index].image_idx, len(image_filenames))
 
         with WithTimer('Load image', quiet = not do_print):
-            try:
-                batch[batch_index].im = caffe.io.load_image(os.path.join(datadir, batch[batch_index].filename), color=not settings._calculated_is_gray_model)
-                batch[batch_index].im = resize_without_fit(batch[batch_index].im, net_input_dims)
-                batch[batch_index].im = batch[batch_index].im.astype(np.float32)
-            except:
-                # skip bad/missing inputs
-                print "WARNING: skipping bad/missing input:", batch[batch_index].filename
-                continue
+            im = next(loaded_images)
 
-        batch_index += 1
+        if im is None:
+            # skip bad/missing inputs
+            print "WARNING: skipping bad/missing input:", batch[batch_index].filename
+        else:
+            batch[batch_index].im = im
+            batch_index += 1
 
-        # if current batch is full
-        if batch_index == settings.max_tracker_batch_size \
-            or image_idx == len(image_filenames) - 1:  # or last iteration
+        # if current batch is full, or last iteration. a bad last input must not drop the rest of the batch
+        if batch_index > 0 and (batch_index == settings.max_tracker_batch_size or position == len(image_indices) - 1):
 
             # batch predict
             with WithTimer('Predict on batch  ', quiet = not do_print):
                 im_batch = [record.im for record in batch]
                 net.predict(im_batch, oversample = False)   # Just take center crop
 
-            # go over batch and update statistics
-            for i in range(0,batch_index):
+            # update statistics with the whole batch at once
+            with WithTimer('Update    ', quiet = not do_print):
+                tracker.update_batch(net, [record.image_idx for record in batch[:batch_index]],
+                                     [record.filename for record in batch[:batch_index]])
 
-                with WithTimer('Update    ', quiet = not do_print):
-                    tracker.update(net, batch[i].image_idx, net_unique_input_source=batch[i].filename, batch_index=i)
+            if checkpoint is not None:
+                checkpoint.update(tracker, image_idx + 1, batch_index)
 
             batch_index = 0
 
+    tracker.scanned_range = (tracker.scanned_range[0], image_idx_end)
+
     print 'done!'
     return tracker
 
 
-def scan_pairs_for_maxes(settings, net, datadir, n_top, outdir, search_min):
+def scan_pairs_for_maxes(settings, net, datadir, n_top, outdir, search_min, tracker = None, first_image_idx = 0, checkpoint = None,
+                         image_idx_end = None):
     image_filenames, image_labels = get_files_list(settings)
     print 'Scanning %d pairs' % len(image_filenames)
     print '  First pair', image_filenames[0]
@@ -548,7 +1037,23 @@ def scan_pairs_for_maxes(settings, net, datadir, n_top, outdir, search_min):
     sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
     import caffe
 
-    tracker = NetMaxTracker(settings, n_top=n_top, layers=settings.layers_to_output_in_offline_scripts, search_min=search_min)
+    # a shard scans only part of the file list, but keeps the global image indices
+    if image_idx_end is None:
+        image_idx_end = len(image_filenames)
+
+    # a resumed scan continues updating the tracker loaded from the checkpoint
+    if tracker is None:
+        tracker = NetMaxTracker(settings, n_top=n_top, layers=settings.layers_to_output_in_offline_scripts, search_min=search_min)
+
+    # a resumed tracker keeps the beginning of its range
+    if getattr(tracker, 'scanned_range', None) is None:
+        tracker.scanned_range = (first_image_idx, first_image_idx)
+
+    # an existing tracker only scans the inputs it has not seen yet
+    tracker.set_file_list(image_filenames)
+    image_indices = tracker.get_unseen_image_indices(image_filenames, first_image_idx, image_idx_end)
+    if len(image_indices) < image_idx_end - first_image_idx:
+        print 'Skipping %d inputs already scanned into the tracker' % (image_idx_end - first_image_idx - len(image_indices))
 
     net_input_dims = net.blobs['data'].data.shape[2:4]
 
@@ -559,7 +1064,16 @@ def scan_pairs_for_maxes(settings, net, datadir, n_top, outdir, search_min):
 
     batch_index = 0
 
-    for image_idx in xrange(len(image_filenames)):
+    # decode and resize the next pairs in the background while the net works on the current batch
+    loaded_images = prefetch_images(load_image_pair_for_scan,
+                                    [(settings.caffevis_caffe_root, datadir, image_filenames[image_idx], not settings._calculated_is_gray_model, net_input_dims,
+                                      settings.siamese_input_mode)
+                                     for image_idx in image_indices],
+                                    settings.max_tracker_prefetch_workers, settings.max_tracker_prefetch_use_processes,
+                                    get_max_pending(settings.max_tracker_prefetch_workers, settings.max_tracker_batch_size,
+                                                    settings.max_tracker_prefetch_batches))
+
+    for position, image_idx in enumerate(image_indices):
 
         batch[batch_index].image_idx = image_idx
         batch[batch_index].images_pair = image_filenames[image_idx]
@@ -571,43 +1085,34 @@ def scan_pairs_for_maxes(settings, net, datadir, n_top, outdir, search_min):
             print '%s   Pair %d/%d' % (datetime.now().ctime(), batch[batch_index].image_idx, len(image_filenames))
 
         with WithTimer('Load image', quiet=not do_print):
-            try:
-                im1 = caffe.io.load_image(os.path.join(datadir, filename1), color=not settings._calculated_is_gray_model)
-                im2 = caffe.io.load_image(os.path.join(datadir, filename2), color=not settings._calculated_is_gray_model)
-                
-                if settings.siamese_input_mode == 'concat_channelwise':
-                    im1 = resize_without_fit(im1, net_input_dims)
-                    im2 = resize_without_fit(im2, net_input_dims)
-                    batch[batch_index].im = np.concatenate((im1, im2), axis=2)
-
-                elif settings.siamese_input_mode == 'concat_along_width':
-                    half_input_dims = (net_input_dims[0], net_input_dims[1] / 2)
-                    im1 = resize_without_fit(im1, half_input_dims)
-                    im2 = resize_without_fit(im2, half_input_dims)
-                    batch[batch_index].im = np.concatenate((im1, im2), axis=1)
-                    
-            except:
-                # skip bad/missing inputs
-                print "WARNING: skipping bad/missing inputs:", filename1, filename2
-                continue
+            im = next(loaded_images)
 
-        batch_index += 1
+        if im is None:
+            # skip bad/missing inputs
+            print "WARNING: skipping bad/missing inputs:", filename1, filename2
+        else:
+            batch[batch_index].im = im
+            batch_index += 1
 
-        # if current batch is full
-        if batch_index == settings.max_tracker_batch_size \
-            or image_idx == len(image_filenames) - 1:  # or last iteration
+        # if current batch is full, or last iteration. a bad last input must not drop the rest of the batch
+        if batch_index > 0 and (batch_index == settings.max_tracker_batch_size or position == len(image_indices) - 1):
 
             with WithTimer('Predict   ', quiet=not do_print):
                 im_batch = [record.im for record in batch]
                 net.predict(im_batch, oversample=False)
 
-            # go over batch and update statistics
-            for i in range(0,batch_index):
-                with WithTimer('Update    ', quiet=not do_print):
-                    tracker.update(net, batch[i].image_idx, net_unique_input_source=batch[i].images_pair, batch_index=i)
+            # update statistics with the whole batch at once
+            with WithTimer('Update    ', quiet=not do_print):
+                tracker.update_batch(net, [record.image_idx for record in batch[:batch_index]],
+                                     [record.images_pair for record in batch[:batch_index]])
+
+            if checkpoint is not None:
+                checkpoint.update(tracker, image_idx + 1, batch_index)
 
             batch_index = 0
 
+    tracker.scanned_range = (tracker.scanned_range[0], image_idx_end)
+
     print 'done!'
     return tracker
 
@@ -683,58 +1188,96 @@ def generate_output_names(unit_dir, num_top, do_info, do_maxes, do_deconv, do_de
     return (info_filename, maxim_filenames, deconv_filenames, deconvnorm_filenames, backprop_filenames, backpropnorm_filenames)
 
 
-def output_max_patches(settings, max_tracker, net, layer_name, idx_begin, idx_end, num_top, datadir, filelist, outdir, search_min, do_which):
+def get_patch_kinds(do_which, search_min):
+    '''
+    :return: list of patch atlas image kinds, and list of info kinds, of the requested outputs of a single direction
+    '''
+
     do_maxes, do_deconv, do_deconv_norm, do_backprop, do_backprop_norm, do_info = do_which
-    assert do_maxes or do_deconv or do_deconv_norm or do_backprop or do_backprop_norm or do_info, 'nothing to do'
+    prefix = 'min_' if search_min else ''
 
-    sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
-    import caffe
+    image_kinds = [prefix + kind for kind, do_kind in [('maxim', do_maxes), ('deconv', do_deconv), ('deconvnorm', do_deconv_norm),
+                                                       ('backprop', do_backprop), ('backpropnorm', do_backprop_norm)] if do_kind]
+    info_kinds = [prefix + 'info'] if do_info else []
 
-    mt = max_tracker
+    return image_kinds, info_kinds
 
-    locs = mt.min_locs if search_min else mt.max_locs
-    vals = mt.min_vals if search_min else mt.max_vals
 
-    image_filenames, image_labels = get_files_list(settings)
+def plan_max_patches(settings, net, job, num_top, image_filenames, outdir, do_which, image_writer, patch_atlas = None,
+                     crop_manifest = None):
+    '''
+    lists the work items of all the patches of the requested channels of a single layer and direction
+    info files are written while planning, since they do not depend on the forward pass
+    :param job: MaxTrackerCropLayerJob
+    :param image_writer: AsyncImageWriter used to write the info files
+    :param patch_atlas: PatchAtlas of the layer opened for writing, or None to output png and info files per unit
+    :param crop_manifest: CropManifest of the layer, used to skip and record complete channels when outputting files.
+                          if the layer has no manifest of this num_top and tracker yet, e.g. outputs of an older
+                          version or of a smaller num_top, the files are probed once
+    :return: list of MaxTrackerCropBatchRecord work items
+    '''
 
-    if settings.is_siamese:
-        print 'Loaded filenames and labels for %d pairs' % len(image_filenames)
-        print '  First pair', image_filenames[0]
-    else:
-        print 'Loaded filenames and labels for %d files' % len(image_filenames)
-        print '  First file', os.path.join(datadir, image_filenames[0])
+    do_maxes, do_deconv, do_deconv_norm, do_backprop, do_backprop_norm, do_info = do_which
 
-    siamese_helper = SiameseHelper(settings.layers_list)
+    mt = job.max_tracker
+    layer_name = job.layer_name
+    search_min = job.search_min
+
+    locs = mt.min_locs if search_min else mt.max_locs
+    vals = mt.min_vals if search_min else mt.max_vals
 
     num_top_in_mt = locs.shape[1]
     assert num_top <= num_top_in_mt, 'Requested %d top images but MaxTracker contains only %d' % (num_top, num_top_in_mt)
-    assert idx_end >= idx_begin, 'Range error'
+    assert job.idx_end >= job.idx_begin, 'Range error'
 
     # minor fix for backwards compatability
     if hasattr(mt, 'is_conv'):
         mt.is_spatial = mt.is_conv
 
+    # fix for backward compatability
+    if (mt.is_spatial and locs.shape[2] == 5) or (not mt.is_spatial and locs.shape[2] == 3):
+        # remove second column
+        locs = np.delete(locs, 1, 2)
+
     size_ii, size_jj = get_max_data_extent(net, settings, layer_name, mt.is_spatial)
     data_size_ii, data_size_jj = net.blobs['data'].data.shape[2:4]
 
-    net_input_dims = net.blobs['data'].data.shape[2:4]
+    # focus areas of all the channels and ranks of the job at once
+    job_locs = locs[job.idx_begin:job.idx_end]
+    if mt.is_spatial:
+        focus_ii, focus_jj = job_locs[:, :, 2], job_locs[:, :, 3]
+    else:
+        focus_ii, focus_jj = np.zeros(job_locs.shape[0:2], dtype=int), np.zeros(job_locs.shape[0:2], dtype=int)
+    focus_areas = compute_data_layer_focus_areas(mt.is_spatial, focus_ii, focus_jj, settings, layer_name,
+                                                 size_ii, size_jj, data_size_ii, data_size_jj)
+
+    kind_prefix = 'min_' if search_min else ''
+    image_kinds, info_kinds = get_patch_kinds(do_which, search_min)
+    if patch_atlas is not None:
+        # patches of both siamese inputs are placed side by side
+        if settings.is_siamese and settings.siamese_input_mode == 'concat_channelwise':
+            patch_shape = (size_ii, size_jj * 2)
+        else:
+            patch_shape = (size_ii, size_jj)
+        patch_atlas.add_kinds(locs.shape[0], num_top, patch_shape, image_kinds, info_kinds,
+                              get_crop_manifest_header(num_top, mt))
 
-    # prepare variables used for batches
-    batch = [None] * settings.max_tracker_batch_size
-    for i in range(0, settings.max_tracker_batch_size):
-        batch[i] = MaxTrackerCropBatchRecord()
+    work_items = []
+    probed_complete_entries = []
 
-    batch_index = 0
+    for cc, channel_idx in enumerate(range(job.idx_begin, job.idx_end)):
 
-    channel_to_info_file = dict()
+        if patch_atlas is not None and patch_atlas.is_channel_done(image_kinds + info_kinds, channel_idx):
+            print "skipped generation of channel %d in layer %s since patches already exist" % (channel_idx, layer_name)
+            continue
 
-    n_total_images = (idx_end-idx_begin) * num_top
-    for cc, channel_idx in enumerate(range(idx_begin, idx_end)):
+        if crop_manifest is not None and crop_manifest.exists and crop_manifest.is_complete(channel_idx, image_kinds + info_kinds):
+            print "skipped generation of channel %d in layer %s since files already exist" % (channel_idx, layer_name)
+            continue
 
         unit_dir = os.path.join(outdir, layer_name, 'unit_%04d' % channel_idx)
-        mkdir_p(unit_dir)
 
-        # check if all required outputs exist, in which case skip this iteration
+        # check if all required outputs exist, in which case skip this channel
         [info_filename,
          maxim_filenames,
          deconv_filenames,
@@ -749,269 +1292,425 @@ def output_max_patches(settings, max_tracker, net, layer_name, idx_begin, idx_en
                            backprop_filenames + \
                            backpropnorm_filenames
 
-        # we skip generation if:
-        # 1. all outputs exist, AND
-        # 2.1.   (not last iteration OR
-        # 2.2.    last iteration, but batch is empty)
-        relevant_outputs_exist = [os.path.exists(file_name) for file_name in relevant_outputs]
-        if all(relevant_outputs_exist) and \
-            ((channel_idx != idx_end - 1) or ((channel_idx == idx_end - 1) and (batch_index == 0))):
+        if patch_atlas is None and (crop_manifest is None or not crop_manifest.exists) and \
+                all([os.path.exists(file_name) for file_name in relevant_outputs]):
             print "skipped generation of channel %d in layer %s since files already exist" % (channel_idx, layer_name)
+            probed_complete_entries += [(channel_idx, kind) for kind in image_kinds + info_kinds]
             continue
 
-        if do_info:
-            channel_to_info_file[channel_idx] = InfoFileMetadata()
-            channel_to_info_file[channel_idx].info_file = open(info_filename[0], 'w')
-            channel_to_info_file[channel_idx].ref_count = num_top
+        if patch_atlas is None:
+            mkdir_p(unit_dir)
+
+        n_channel_work_items = 0
 
-            print >> channel_to_info_file[channel_idx].info_file, '# is_spatial val image_idx selected_input_index i(if is_spatial) j(if is_spatial) filename'
+        info_lines = ['# is_spatial val image_idx selected_input_index i(if is_spatial) j(if is_spatial) filename\n']
 
         # iterate through maxes from highest (at end) to lowest
         for max_idx_0 in range(num_top):
-            batch[batch_index].cc = cc
-            batch[batch_index].channel_idx = channel_idx
-            batch[batch_index].info_filename = info_filename
-            batch[batch_index].maxim_filenames = maxim_filenames
-            batch[batch_index].deconv_filenames = deconv_filenames
-            batch[batch_index].deconvnorm_filenames = deconvnorm_filenames
-            batch[batch_index].backprop_filenames = backprop_filenames
-            batch[batch_index].backpropnorm_filenames = backpropnorm_filenames
-            batch[batch_index].info_file = channel_to_info_file[channel_idx].info_file
-
-            batch[batch_index].max_idx_0 = max_idx_0
-            batch[batch_index].max_idx = num_top_in_mt - 1 - batch[batch_index].max_idx_0
 
-            if mt.is_spatial:
-
-                # fix for backward compatability
-                if locs.shape[2] == 5:
-                    # remove second column
-                    locs = np.delete(locs, 1, 2)
+            work_item = MaxTrackerCropBatchRecord(cc = cc, channel_idx = channel_idx, info_filename = info_filename,
+                                                  maxim_filenames = maxim_filenames, deconv_filenames = deconv_filenames,
+                                                  deconvnorm_filenames = deconvnorm_filenames,
+                                                  backprop_filenames = backprop_filenames,
+                                                  backpropnorm_filenames = backpropnorm_filenames,
+                                                  max_idx_0 = max_idx_0, max_idx = num_top_in_mt - 1 - max_idx_0,
+                                                  layer_name = layer_name, is_spatial = mt.is_spatial,
+                                                  size_ii = size_ii, size_jj = size_jj,
+                                                  patch_atlas = patch_atlas, kind_prefix = kind_prefix,
+                                                  crop_manifest = crop_manifest)
 
-                batch[batch_index].im_idx, batch[batch_index].selected_input_index, batch[batch_index].ii, batch[batch_index].jj = locs[batch[batch_index].channel_idx, batch[batch_index].max_idx]
+            if mt.is_spatial:
+                work_item.im_idx, work_item.selected_input_index, work_item.ii, work_item.jj = locs[channel_idx, work_item.max_idx]
             else:
-                # fix for backward compatability
-                if locs.shape[2] == 3:
-                    # remove second column
-                    locs = np.delete(locs, 1, 2)
-
-                batch[batch_index].im_idx, batch[batch_index].selected_input_index = locs[batch[batch_index].channel_idx, batch[batch_index].max_idx]
-                batch[batch_index].ii, batch[batch_index].jj = 0, 0
+                work_item.im_idx, work_item.selected_input_index = locs[channel_idx, work_item.max_idx]
+                work_item.ii, work_item.jj = 0, 0
 
             # if ii and jj are invalid then there is no data for this "top" image, so we can skip it
-            if (batch[batch_index].ii, batch[batch_index].jj) == (-1,-1):
+            if (work_item.ii, work_item.jj) == (-1, -1):
+                if patch_atlas is not None:
+                    patch_atlas.set_missing(image_kinds + info_kinds, channel_idx, max_idx_0)
                 continue
 
-            batch[batch_index].recorded_val = vals[batch[batch_index].channel_idx, batch[batch_index].max_idx]
-            batch[batch_index].filename = image_filenames[batch[batch_index].im_idx]
-            do_print = (batch[batch_index].max_idx_0 == 0)
-            if do_print:
-                print '%s   Output file/image(s) %d/%d   layer %s channel %d' % (datetime.now().ctime(), batch[batch_index].cc * num_top, n_total_images, layer_name, batch[batch_index].channel_idx)
-
-
-            # print "DEBUG: (mt.is_spatial, batch[batch_index].ii, batch[batch_index].jj, layer_name, size_ii, size_jj, data_size_ii, data_size_jj)", str((mt.is_spatial, batch[batch_index].ii, batch[batch_index].jj, rc, layer_name, size_ii, size_jj, data_size_ii, data_size_jj))
-
-            [batch[batch_index].out_ii_start,
-             batch[batch_index].out_ii_end,
-             batch[batch_index].out_jj_start,
-             batch[batch_index].out_jj_end,
-             batch[batch_index].data_ii_start,
-             batch[batch_index].data_ii_end,
-             batch[batch_index].data_jj_start,
-             batch[batch_index].data_jj_end] = \
-                compute_data_layer_focus_area(mt.is_spatial, batch[batch_index].ii, batch[batch_index].jj, settings, layer_name,
-                                              size_ii, size_jj, data_size_ii, data_size_jj)
-
-            # print "DEBUG: channel:%d out_ii_start:%d out_ii_end:%d out_jj_start:%d out_jj_end:%d data_ii_start:%d data_ii_end:%d data_jj_start:%d data_jj_end:%d" % \
-            #       (channel_idx,
-            #        batch[batch_index].out_ii_start, batch[batch_index].out_ii_end,
-            #        batch[batch_index].out_jj_start, batch[batch_index].out_jj_end,
-            #        batch[batch_index].data_ii_start, batch[batch_index].data_ii_end,
-            #        batch[batch_index].data_jj_start, batch[batch_index].data_jj_end)
-
-            if do_info:
-                print >> batch[batch_index].info_file, 1 if mt.is_spatial else 0, '%.6f' % vals[batch[batch_index].channel_idx, batch[batch_index].max_idx],
+            work_item.recorded_val = vals[channel_idx, work_item.max_idx]
+            work_item.filename = image_filenames[work_item.im_idx]
+
+            [work_item.out_ii_start,
+             work_item.out_ii_end,
+             work_item.out_jj_start,
+             work_item.out_jj_end,
+             work_item.data_ii_start,
+             work_item.data_ii_end,
+             work_item.data_jj_start,
+             work_item.data_jj_end] = [int(focus_area[cc, work_item.max_idx]) for focus_area in focus_areas]
+
+            if do_info and patch_atlas is not None:
+                patch_atlas.set_info(kind_prefix + 'info', channel_idx, max_idx_0, vals[channel_idx, work_item.max_idx],
+                                     locs[channel_idx, work_item.max_idx])
+
+            elif do_info:
                 if mt.is_spatial:
-                    print >> batch[batch_index].info_file, '%d %d %d %d' % tuple(locs[batch[batch_index].channel_idx, batch[batch_index].max_idx]),
+                    loc_text = '%d %d %d %d' % tuple(locs[channel_idx, work_item.max_idx])
                 else:
-                    print >> batch[batch_index].info_file, '%d %d' % tuple(locs[batch[batch_index].channel_idx, batch[batch_index].max_idx]),
-                print >> batch[batch_index].info_file, batch[batch_index].filename
+                    loc_text = '%d %d' % tuple(locs[channel_idx, work_item.max_idx])
+                info_lines.append('%d %.6f %s %s\n' % (1 if mt.is_spatial else 0, vals[channel_idx, work_item.max_idx],
+                                                       loc_text, work_item.filename))
+
+            work_items.append(work_item)
+            n_channel_work_items += 1
+
+        if crop_manifest is not None:
+            for kind in image_kinds:
+                crop_manifest.expect(channel_idx, kind, n_channel_work_items)
+            for kind in info_kinds:
+                crop_manifest.expect(channel_idx, kind, 1)
+
+        if do_info and patch_atlas is None:
+            image_writer.write_file(info_filename[0], ''.join(info_lines))
+            if crop_manifest is not None:
+                crop_manifest.output_queued(channel_idx, kind_prefix + 'info')
+
+    # record the channels found complete by probing the files, so later runs can skip them without probing
+    if crop_manifest is not None and probed_complete_entries:
+        crop_manifest.commit(probed_complete_entries)
+
+    return work_items
+
+
+def group_work_items_by_image(work_items):
+    '''
+    inverts a list of work items into a list of images, each holding the work items of all the patches which come from
+    it, so each image is loaded and forwarded only once, however many channels, layers and directions it is top for
+    :return: list of MaxTrackerCropImageRecord, in order of first use
+    '''
+
+    image_records = []
+    image_idx_to_record = dict()
+
+    for work_item in work_items:
+        if work_item.im_idx not in image_idx_to_record:
+            image_idx_to_record[work_item.im_idx] = MaxTrackerCropImageRecord(image_idx = work_item.im_idx,
+                                                                              filename = work_item.filename,
+                                                                              work_items = [])
+            image_records.append(image_idx_to_record[work_item.im_idx])
+        image_idx_to_record[work_item.im_idx].work_items.append(work_item)
+
+    return image_records
+
+
+def split_work_items_to_passes(batch):
+    '''
+    splits the work items of a batch of images into passes which can share a single deconv/backward call. the work
+    items of a pass come from different images of the batch, and have the same layer and selected input index
+    :param batch: list of MaxTrackerCropImageRecord, image i of the list is item i of the net batch
+    :return: list of passes, each a list of (batch index, work item) tuples
+    '''
+
+    # group work items by layer and selected input index, keeping the work items of each image in order
+    groups = dict()
+    group_keys = []
+    for i, image_record in enumerate(batch):
+        for work_item in image_record.work_items:
+            key = (work_item.denormalized_layer_name, work_item.selected_input_index)
+            if key not in groups:
+                groups[key] = [[] for _ in batch]
+                group_keys.append(key)
+            groups[key][i].append(work_item)
+
+    # pass number k of a group takes the k-th work item of each image
+    passes = []
+    for key in group_keys:
+        n_passes = max([len(image_work_items) for image_work_items in groups[key]])
+        for pass_idx in range(n_passes):
+            passes.append([(i, image_work_items[pass_idx]) for i, image_work_items in enumerate(groups[key])
+                           if pass_idx < len(image_work_items)])
+
+    return passes
+
+
+def get_one_hot_batch_index(settings, work_item, i, n_top_rows):
+    '''returns the batch index in the top diffs of the unit of a work item, for image i of the batch'''
+
+    if settings.is_siamese and work_item.layer_format == 'siamese_batch_pair':
+        if n_top_rows == 2:
+            # note: the following will not crash, since we already checked we have 2 outputs, so selected_input_index is either 0 or 1
+            assert work_item.selected_input_index != -1
+            return work_item.selected_input_index
+        elif n_top_rows == 1:
+            return 0
+
+    # normal network, or siamese in siamese_layer_pair format
+    return i
+
+
+def run_one_hot_pass(settings, net, one_hot_pass, deconv_type = None, zero_higher = False):
+    '''
+    runs a single backward pass, or deconv pass if deconv_type is given, from the units of all the work items of a pass
+    :param one_hot_pass: list of (batch index, work item) tuples, as returned by split_work_items_to_passes
+    :return: the input gradients of all the samples
+    '''
+
+    first_work_item = one_hot_pass[0][1]
+    n_top_rows = net.blobs[first_work_item.denormalized_top_name].diff.shape[0]
+
+    return get_one_hot_backward(net).run(first_work_item.denormalized_layer_name,
+                                         [get_one_hot_batch_index(settings, work_item, i, n_top_rows) for i, work_item in one_hot_pass],
+                                         [work_item.channel_idx for i, work_item in one_hot_pass],
+                                         [work_item.ii for i, work_item in one_hot_pass],
+                                         [work_item.jj for i, work_item in one_hot_pass],
+                                         deconv_type = deconv_type, zero_higher = zero_higher)
+
+
+def save_patch(image_writer, work_item, kind, filenames, out_arr, autoscale = True, autoscale_center = None):
+    '''saves a patch of a work item to its patch atlas if it has one, otherwise queues it on the image writer'''
+
+    if work_item.patch_atlas is not None:
+        work_item.patch_atlas.set_patch(work_item.kind_prefix + kind, work_item.channel_idx, work_item.max_idx_0,
+                                        caffe_image_to_rgb(out_arr, autoscale, autoscale_center))
+    else:
+        image_writer.save_caffe_image(out_arr, filenames[work_item.max_idx_0], autoscale, autoscale_center)
 
-            if not (do_maxes or do_deconv or do_deconv_norm or do_backprop or do_backprop_norm):
-                continue
+    if work_item.crop_manifest is not None:
+        work_item.crop_manifest.output_queued(work_item.channel_idx, work_item.kind_prefix + kind)
 
-            with WithTimer('Load image', quiet = not do_print):
 
-                if settings.is_siamese:
-                    # in siamese network, filename is a pair of image file names
-                    filename1 = batch[batch_index].filename[0]
-                    filename2 = batch[batch_index].filename[1]
+def output_max_patches_for_batch(settings, net, batch, siamese_helper, do_which, do_print, image_writer):
+    '''
+    outputs the patches of all the work items of a batch of images, after the forward pass on the batch
+    work items of different layers and directions are all produced from the same forward pass
+    :param batch: list of MaxTrackerCropImageRecord, image i of the list is item i of the net batch
+    :param image_writer: AsyncImageWriter which encodes and writes the patches while the net goes on, for work items
+                         without a patch atlas
+    '''
 
-                    # load both images
-                    im1 = caffe.io.load_image(os.path.join(datadir, filename1), color=not settings._calculated_is_gray_model)
-                    im2 = caffe.io.load_image(os.path.join(datadir, filename2), color=not settings._calculated_is_gray_model)
+    do_maxes, do_deconv, do_deconv_norm, do_backprop, do_backprop_norm, do_info = do_which
 
-                    if settings.siamese_input_mode == 'concat_channelwise':
+    for i, image_record in enumerate(batch):
+        for work_item in image_record.work_items:
 
-                        # resize images according to input dimension
-                        im1 = resize_without_fit(im1, net_input_dims)
-                        im2 = resize_without_fit(im2, net_input_dims)
+            # in siamese network, we wish to return from the normalized layer name and selected input index to the
+            # denormalized layer name, e.g. from "conv1_1" and selected_input_index=1 to "conv1_1_p"
+            work_item.denormalized_layer_name = siamese_helper.denormalize_layer_name_for_max_tracker(work_item.layer_name, work_item.selected_input_index)
+            work_item.denormalized_top_name = layer_name_to_top_name(net, work_item.denormalized_layer_name)
+            work_item.layer_format = siamese_helper.get_layer_format_by_layer_name(work_item.layer_name)
 
-                        # concatenate channelwise
-                        batch[batch_index].im = np.concatenate((im1, im2), axis=2)
+            if len(net.blobs[work_item.denormalized_top_name].data.shape) == 4:
+                if settings.is_siamese and work_item.layer_format == 'siamese_batch_pair':
+                    reproduced_val = net.blobs[work_item.denormalized_top_name].data[work_item.selected_input_index, work_item.channel_idx, work_item.ii, work_item.jj]
 
-                        # convert to float to avoid caffe destroying the image in the scaling phase
-                        batch[batch_index].im = batch[batch_index].im.astype(np.float32)
+                else: # normal network, or siamese in siamese_layer_pair format
+                    reproduced_val = net.blobs[work_item.denormalized_top_name].data[i, work_item.channel_idx, work_item.ii, work_item.jj]
 
-                    elif settings.siamese_input_mode == 'concat_along_width':
-                        half_input_dims = (net_input_dims[0], net_input_dims[1] / 2)
-                        im1 = resize_without_fit(im1, half_input_dims)
-                        im2 = resize_without_fit(im2, half_input_dims)
-                        batch[batch_index].im = np.concatenate((im1, im2), axis=1)
+            else:
+                if settings.is_siamese and work_item.layer_format == 'siamese_batch_pair':
+                    reproduced_val = net.blobs[work_item.denormalized_top_name].data[work_item.selected_input_index, work_item.channel_idx]
 
-                        # convert to float to avoid caffe destroying the image in the scaling phase
-                        batch[batch_index].im = batch[batch_index].im.astype(np.float32)
+                else:  # normal network, or siamese in siamese_layer_pair format
+                    reproduced_val = net.blobs[work_item.denormalized_top_name].data[i, work_item.channel_idx]
 
-                else:
-                    # load image
-                    batch[batch_index].im = caffe.io.load_image(os.path.join(datadir, batch[batch_index].filename), color=not settings._calculated_is_gray_model)
+            if abs(reproduced_val - work_item.recorded_val) > .1:
+                print 'Warning: recorded value %s is suspiciously different from reproduced value %s. Is the filelist the same?' % (work_item.recorded_val, reproduced_val)
+
+            if do_maxes:
+                #grab image from data layer, not from im (to ensure preprocessing / center crop details match between image and deconv/backprop)
+
+                out_arr = extract_patch_from_image(net.blobs['data'].data[i], net, work_item.selected_input_index, settings,
+                                                   work_item.data_ii_end, work_item.data_ii_start, work_item.data_jj_end, work_item.data_jj_start,
+                                                   work_item.out_ii_end, work_item.out_ii_start, work_item.out_jj_end, work_item.out_jj_start, work_item.size_ii, work_item.size_jj)
+
+                with WithTimer('Save patch', quiet = not do_print):
+                    save_patch(image_writer, work_item, 'maxim', work_item.maxim_filenames, out_arr,
+                               autoscale = False, autoscale_center = 0)
+
+    if do_deconv or do_deconv_norm:
+
+        # deconv the whole batch at once, each pass holds one work item of each image, of a single layer and
+        # selected input index, so in siamese networks every pass starts from a single layer of the pair
+        for deconv_pass in split_work_items_to_passes(batch):
+
+            with WithTimer('Deconv    ', quiet = not do_print):
+                input_diffs = run_one_hot_pass(settings, net, deconv_pass, deconv_type='Guided Backprop', zero_higher=True)
+
+            for i, work_item in deconv_pass:
+
+                out_arr = extract_patch_from_image(input_diffs[i], net, work_item.selected_input_index, settings,
+                                                   work_item.data_ii_end, work_item.data_ii_start, work_item.data_jj_end, work_item.data_jj_start,
+                                                   work_item.out_ii_end, work_item.out_ii_start, work_item.out_jj_end, work_item.out_jj_start, work_item.size_ii, work_item.size_jj)
+
+                if out_arr.max() == 0:
+                    print 'Warning: Deconv out_arr in range', out_arr.min(), 'to', out_arr.max(), 'ensure force_backward: true in prototxt'
+
+                if do_deconv:
+                    with WithTimer('Save patch', quiet = not do_print):
+                        save_patch(image_writer, work_item, 'deconv', work_item.deconv_filenames, out_arr,
+                                   autoscale=False, autoscale_center=0)
+                if do_deconv_norm:
+                    out_arr = np.linalg.norm(out_arr, axis=0)
+                    with WithTimer('Save patch', quiet = not do_print):
+                        save_patch(image_writer, work_item, 'deconvnorm', work_item.deconvnorm_filenames, out_arr)
+
+    if do_backprop or do_backprop_norm:
+
+        # backprop the whole batch at once, in the same passes as deconv
+        for backprop_pass in split_work_items_to_passes(batch):
+
+            with WithTimer('Backward  ', quiet = not do_print):
+                input_diffs = run_one_hot_pass(settings, net, backprop_pass)
+
+            for i, work_item in backprop_pass:
+
+                out_arr = extract_patch_from_image(input_diffs[i], net, work_item.selected_input_index, settings,
+                                                   work_item.data_ii_end, work_item.data_ii_start, work_item.data_jj_end, work_item.data_jj_start,
+                                                   work_item.out_ii_end, work_item.out_ii_start, work_item.out_jj_end, work_item.out_jj_start, work_item.size_ii, work_item.size_jj)
 
-                    # resize images according to input dimension
-                    batch[batch_index].im = resize_without_fit(batch[batch_index].im, net_input_dims)
+                if out_arr.max() == 0:
+                    print 'Warning: Deconv out_arr in range', out_arr.min(), 'to', out_arr.max(), 'ensure force_backward: true in prototxt'
+                if do_backprop:
+                    with WithTimer('Save patch', quiet = not do_print):
+                        save_patch(image_writer, work_item, 'backprop', work_item.backprop_filenames, out_arr,
+                                   autoscale = False, autoscale_center = 0)
+                if do_backprop_norm:
+                    out_arr = np.linalg.norm(out_arr, axis=0)
+                    with WithTimer('Save patch', quiet = not do_print):
+                        save_patch(image_writer, work_item, 'backpropnorm', work_item.backpropnorm_filenames, out_arr)
+
+
+def output_max_patches(settings, max_tracker, net, layer_name, idx_begin, idx_end, num_top, datadir, filelist, outdir, search_min, do_which):
+    '''outputs the patches of a single layer and direction, see output_max_patches_of_layers'''
+
+    output_max_patches_of_layers(settings, net, [MaxTrackerCropLayerJob(layer_name = layer_name, max_tracker = max_tracker,
+                                                                        idx_begin = idx_begin, idx_end = idx_end,
+                                                                        search_min = search_min)],
+                                 num_top, datadir, outdir, do_which)
+
+
+def output_max_patches_of_layers(settings, net, jobs, num_top, datadir, outdir, do_which):
+    '''
+    outputs the patches of several layers and directions in a single pass, each distinct image is loaded and forwarded
+    once, and the outputs of all the layers and directions it is top for are produced from that forward pass
+    :param jobs: list of MaxTrackerCropLayerJob
+    :return: none
+    '''
+
+    do_maxes, do_deconv, do_deconv_norm, do_backprop, do_backprop_norm, do_info = do_which
+    assert do_maxes or do_deconv or do_deconv_norm or do_backprop or do_backprop_norm or do_info, 'nothing to do'
+
+    sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
+    import caffe
+
+    image_filenames, image_labels = get_files_list(settings)
+
+    if settings.is_siamese:
+        print 'Loaded filenames and labels for %d pairs' % len(image_filenames)
+        print '  First pair', image_filenames[0]
+    else:
+        print 'Loaded filenames and labels for %d files' % len(image_filenames)
+        print '  First file', os.path.join(datadir, image_filenames[0])
+
+    siamese_helper = SiameseHelper(settings.layers_list)
+
+    net_input_dims = net.blobs['data'].data.shape[2:4]
+
+    # in the atlas format, all the patches of a layer are packed into a single patch atlas
+    patch_atlases = dict()
+    if settings.max_tracker_patches_format == 'atlas':
+        for job in jobs:
+            if job.layer_name not in patch_atlases:
+                patch_atlases[job.layer_name] = PatchAtlas(get_patch_atlas_dirname(outdir, job.layer_name), writable = True)
+
+    # in the files format, complete channels are recorded in a manifest of each layer
+    crop_manifests = dict()
+    if settings.max_tracker_patches_format == 'files':
+        for job in jobs:
+            if job.layer_name not in crop_manifests:
+                crop_manifests[job.layer_name] = CropManifest(get_crop_manifest_filename(outdir, job.layer_name),
+                                                              get_crop_manifest_header(num_top, job.max_tracker))
+
+    # patches are encoded and written in the background while the net works on the next batches, leaving the with block
+    # waits for all the writes
+    with get_image_writer(settings) as image_writer:
+
+        work_items = []
+        with WithTimer('Plan patches'):
+            for job in jobs:
+                work_items += plan_max_patches(settings, net, job, num_top, image_filenames, outdir, do_which, image_writer,
+                                               patch_atlases.get(job.layer_name), crop_manifests.get(job.layer_name))
+            image_records = group_work_items_by_image(work_items)
+
+        commit_crop_manifests(image_writer, crop_manifests)
+
+        if not (do_maxes or do_deconv or do_deconv_norm or do_backprop or do_backprop_norm):
+            flush_patch_atlases(patch_atlases)
+            return
+
+        n_work_items = len(work_items)
+        print 'Output %d file/image(s) of %d layer/direction(s) from %d distinct images' % (n_work_items, len(jobs), len(image_records))
+        # decode and resize the next images in the background while the net works on the current batch
+        if settings.is_siamese:
+            loaded_images = prefetch_images(load_image_pair_for_scan,
+                                            [(settings.caffevis_caffe_root, datadir, image_record.filename, not settings._calculated_is_gray_model,
+                                              net_input_dims, settings.siamese_input_mode)
+                                             for image_record in image_records],
+                                            settings.max_tracker_prefetch_workers, settings.max_tracker_prefetch_use_processes,
+                                            get_max_pending(settings.max_tracker_prefetch_workers, settings.max_tracker_batch_size,
+                                                            settings.max_tracker_prefetch_batches))
+        else:
+            loaded_images = prefetch_images(load_image_for_scan,
+                                            [(settings.caffevis_caffe_root, datadir, image_record.filename, not settings._calculated_is_gray_model,
+                                              net_input_dims)
+                                             for image_record in image_records],
+                                            settings.max_tracker_prefetch_workers, settings.max_tracker_prefetch_use_processes,
+                                            get_max_pending(settings.max_tracker_prefetch_workers, settings.max_tracker_batch_size,
+                                                            settings.max_tracker_prefetch_batches))
+
+        n_work_items_done = 0
+        for batch_begin in xrange(0, len(image_records), settings.max_tracker_batch_size):
+
+            do_print = ((batch_begin / settings.max_tracker_batch_size) % 10 == 0)
+            if do_print:
+                print '%s   Output file/image(s) %d/%d   image %d/%d' % (datetime.now().ctime(), n_work_items_done, n_work_items,
+                                                                       batch_begin, len(image_records))
+
+            batch = []
+            with WithTimer('Load image', quiet = not do_print):
+                for image_record in image_records[batch_begin:batch_begin + settings.max_tracker_batch_size]:
+                    im = next(loaded_images)
+                    if im is None:
+                        print "WARNING: skipping bad/missing input:", image_record.filename
+                        continue
 
                     # convert to float to avoid caffe destroying the image in the scaling phase
-                    batch[batch_index].im = batch[batch_index].im.astype(np.float32)
+                    image_record.im = im.astype(np.float32)
+                    batch.append(image_record)
 
-            batch_index += 1
+            if len(batch) == 0:
+                continue
+
+            with WithTimer('Predict on batch  ', quiet = not do_print):
+                im_batch = [image_record.im for image_record in batch]
+                net.predict(im_batch, oversample = False)
+
+            output_max_patches_for_batch(settings, net, batch, siamese_helper, do_which, do_print, image_writer)
+
+            # record the channels completed by this batch once their files are written
+            commit_crop_manifests(image_writer, crop_manifests)
+
+            # release the images of the batch
+            for image_record in batch:
+                n_work_items_done += len(image_record.work_items)
+                image_record.im = None
+
+        flush_patch_atlases(patch_atlases)
+
+
+def commit_crop_manifests(image_writer, crop_manifests):
+    '''commits the manifest entries whose outputs were all queued, once the image writer has written them'''
+
+    for crop_manifest in crop_manifests.itervalues():
+        entries = crop_manifest.take_queued()
+        if entries:
+            image_writer.call_when_done(partial(crop_manifest.commit, entries))
 
-            # if current batch is full
-            if batch_index == settings.max_tracker_batch_size \
-                    or ((channel_idx == idx_end - 1) and (max_idx_0 == num_top - 1)):  # or last iteration
-
-                with WithTimer('Predict on batch  ', quiet = not do_print):
-                    im_batch = [record.im for record in batch]
-                    net.predict(im_batch, oversample = False)
 
-                # go over batch and update statistics
-                for i in range(0, batch_index):
-
-                    # in siamese network, we wish to return from the normalized layer name and selected input index to the
-                    # denormalized layer name, e.g. from "conv1_1" and selected_input_index=1 to "conv1_1_p"
-                    batch[i].denormalized_layer_name = siamese_helper.denormalize_layer_name_for_max_tracker(layer_name, batch[i].selected_input_index)
-                    batch[i].denormalized_top_name = layer_name_to_top_name(net, batch[i].denormalized_layer_name)
-                    batch[i].layer_format = siamese_helper.get_layer_format_by_layer_name(layer_name)
-
-                    if len(net.blobs[batch[i].denormalized_top_name].data.shape) == 4:
-                        if settings.is_siamese and batch[i].layer_format == 'siamese_batch_pair':
-                            reproduced_val = net.blobs[batch[i].denormalized_top_name].data[batch[i].selected_input_index, batch[i].channel_idx, batch[i].ii, batch[i].jj]
-
-                        else: # normal network, or siamese in siamese_layer_pair format
-                            reproduced_val = net.blobs[batch[i].denormalized_top_name].data[i, batch[i].channel_idx, batch[i].ii, batch[i].jj]
-
-                    else:
-                        if settings.is_siamese and batch[i].layer_format == 'siamese_batch_pair':
-                            reproduced_val = net.blobs[batch[i].denormalized_top_name].data[batch[i].selected_input_index, batch[i].channel_idx]
-
-                        else:  # normal network, or siamese in siamese_layer_pair format
-                            reproduced_val = net.blobs[batch[i].denormalized_top_name].data[i, batch[i].channel_idx]
-
-                    if abs(reproduced_val - batch[i].recorded_val) > .1:
-                        print 'Warning: recorded value %s is suspiciously different from reproduced value %s. Is the filelist the same?' % (batch[i].recorded_val, reproduced_val)
-
-                    if do_maxes:
-                        #grab image from data layer, not from im (to ensure preprocessing / center crop details match between image and deconv/backprop)
-
-                        out_arr = extract_patch_from_image(net.blobs['data'].data[i], net, batch[i].selected_input_index, settings,
-                                                           batch[i].data_ii_end, batch[i].data_ii_start, batch[i].data_jj_end, batch[i].data_jj_start,
-                                                           batch[i].out_ii_end, batch[i].out_ii_start, batch[i].out_jj_end, batch[i].out_jj_start, size_ii, size_jj)
-
-                        with WithTimer('Save img  ', quiet = not do_print):
-                            save_caffe_image(out_arr, batch[i].maxim_filenames[batch[i].max_idx_0],
-                                             autoscale = False, autoscale_center = 0)
-
-                if do_deconv or do_deconv_norm:
-
-                    # TODO: we can improve performance by doing batch of deconv_from_layer, but only if we group
-                    # together instances which have the same selected_input_index, this can be done by holding two
-                    # separate batches
-
-                    for i in range(0, batch_index):
-                        diffs = net.blobs[batch[i].denormalized_top_name].diff * 0
-
-                        if settings.is_siamese and batch[i].layer_format == 'siamese_batch_pair':
-                            if diffs.shape[0] == 2:
-                                if len(diffs.shape) == 4:
-                                    diffs[batch[i].selected_input_index, batch[i].channel_idx, batch[i].ii, batch[i].jj] = 1.0
-                                else:
-                                    # note: the following will not crash, since we already checked we have 2 outputs, so selected_input_index is either 0 or 1
-                                    assert batch[i].selected_input_index != -1
-                                    diffs[batch[i].selected_input_index, batch[i].channel_idx] = 1.0
-                            elif diffs.shape[0] == 1:
-                                if len(diffs.shape) == 4:
-                                    diffs[0, batch[i].channel_idx, batch[i].ii, batch[i].jj] = 1.0
-                                else:
-                                    diffs[0, batch[i].channel_idx] = 1.0
-
-                        else: # normal network, or siamese in siamese_layer_pair format
-                            if len(diffs.shape) == 4:
-                                diffs[i, batch[i].channel_idx, batch[i].ii, batch[i].jj] = 1.0
-                            else:
-                                diffs[i, batch[i].channel_idx] = 1.0
-
-                        with WithTimer('Deconv    ', quiet = not do_print):
-                            net.deconv_from_layer(batch[i].denormalized_layer_name, diffs, zero_higher=True, deconv_type='Guided Backprop')
-
-                        out_arr = extract_patch_from_image(net.blobs['data'].diff[i], net, batch[i].selected_input_index, settings,
-                                                           batch[i].data_ii_end, batch[i].data_ii_start, batch[i].data_jj_end, batch[i].data_jj_start,
-                                                           batch[i].out_ii_end, batch[i].out_ii_start, batch[i].out_jj_end, batch[i].out_jj_start, size_ii, size_jj)
-
-                        if out_arr.max() == 0:
-                            print 'Warning: Deconv out_arr in range', out_arr.min(), 'to', out_arr.max(), 'ensure force_backward: true in prototxt'
-
-                        if do_deconv:
-                            with WithTimer('Save img  ', quiet=not do_print):
-                                save_caffe_image(out_arr, batch[i].deconv_filenames[batch[i].max_idx_0],
-                                                 autoscale=False, autoscale_center=0)
-                        if do_deconv_norm:
-                            out_arr = np.linalg.norm(out_arr, axis=0)
-                            with WithTimer('Save img  ', quiet=not do_print):
-                                save_caffe_image(out_arr, batch[i].deconvnorm_filenames[batch[i].max_idx_0])
-
-                if do_backprop or do_backprop_norm:
-
-                    for i in range(0, batch_index):
-                        diffs = net.blobs[batch[i].denormalized_top_name].diff * 0
-
-                        if len(diffs.shape) == 4:
-                            diffs[i, batch[i].channel_idx, batch[i].ii, batch[i].jj] = 1.0
-                        else:
-                            diffs[i, batch[i].channel_idx] = 1.0
-
-                    with WithTimer('Backward batch  ', quiet = not do_print):
-                        net.backward_from_layer(batch[i].denormalized_layer_name, diffs)
-
-                    for i in range(0, batch_index):
-
-                        out_arr = extract_patch_from_image(net.blobs['data'].diff[i], net, batch[i].selected_input_index, settings,
-                                                           batch[i].data_ii_end, batch[i].data_ii_start, batch[i].data_jj_end, batch[i].data_jj_start,
-                                                           batch[i].out_ii_end, batch[i].out_ii_start, batch[i].out_jj_end, batch[i].out_jj_start, size_ii, size_jj)
-
-                        if out_arr.max() == 0:
-                            print 'Warning: Deconv out_arr in range', out_arr.min(), 'to', out_arr.max(), 'ensure force_backward: true in prototxt'
-                        if do_backprop:
-                            with WithTimer('Save img  ', quiet = not do_print):
-                                save_caffe_image(out_arr, batch[i].backprop_filenames[batch[i].max_idx_0],
-                                                 autoscale = False, autoscale_center = 0)
-                        if do_backprop_norm:
-                            out_arr = np.linalg.norm(out_arr, axis=0)
-                            with WithTimer('Save img  ', quiet = not do_print):
-                                save_caffe_image(out_arr, batch[i].backpropnorm_filenames[batch[i].max_idx_0])
-
-                # close info files
-                for i in range(0, batch_index):
-                    channel_to_info_file[batch[i].channel_idx].ref_count -= 1
-                    if channel_to_info_file[batch[i].channel_idx].ref_count == 0:
-                        if do_info:
-                            channel_to_info_file[batch[i].channel_idx].info_file.close()
-
-                batch_index = 0
+def flush_patch_atlases(patch_atlases):
+    for patch_atlas in patch_atlases.itervalues():
+        patch_atlas.flush()
@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+
+import json
+import os
+import shutil
+import cPickle as pickle
+
+import numpy as np
+
+from misc import mkdir_p
+
+# columnar store of NetMaxTracker results: a directory holding a small json manifest, and one .npy file per array of
+# each layer. arrays are memory mapped when read, so readers which need a single layer, or a few channels, only touch
+# the parts of the files they use
+
+STORE_MANIFEST_FILENAME = 'manifest.json'
+STORE_FORMAT_VERSION = 1
+
+
+def get_store_dirname(pickle_filename):
+    '''returns the directory of the columnar store which is saved next to a pickled NetMaxTracker'''
+
+    base_filename, extension = os.path.splitext(pickle_filename)
+    return base_filename if extension else pickle_filename + '.store'
+
+
+def is_store_dirname(dirname):
+    return os.path.isfile(os.path.join(dirname, STORE_MANIFEST_FILENAME))
+
+
+def save_max_tracker_store(dirname, net_max_tracker):
+    '''
+    saves the results of a NetMaxTracker as a columnar store
+    the store is written to a temporary directory which then replaces the old store, so readers never see a partial store
+    :param dirname: store directory
+    :param net_max_tracker: NetMaxTracker to save, either scanned or loaded from a pickle file
+    :return: none
+    '''
+
+    temp_dirname = dirname + '.tmp'
+    if os.path.isdir(temp_dirname):
+        shutil.rmtree(temp_dirname)
+
+    manifest = {'format_version': STORE_FORMAT_VERSION,
+                'n_top': net_max_tracker.n_top,
+                'search_min': getattr(net_max_tracker, 'search_min', False),
+                'scanned_range': getattr(net_max_tracker, 'scanned_range', None),
+                'file_list_digest': getattr(net_max_tracker, 'file_list_digest', None),
+                'file_list_length': getattr(net_max_tracker, 'file_list_length', None),
+                'layers': {}}
+
+    for normalized_layer_name, max_tracker in sorted(net_max_tracker.max_trackers.iteritems()):
+
+        # minor fix for backwards compatability
+        is_spatial = max_tracker.is_conv if hasattr(max_tracker, 'is_conv') else max_tracker.is_spatial
+
+        arrays = {'max_vals': max_tracker.max_vals,
+                  'max_locs': max_tracker.max_locs}
+
+        if getattr(max_tracker, 'search_min', False):
+            arrays['min_vals'] = max_tracker.min_vals
+            arrays['min_locs'] = max_tracker.min_locs
+
+        channel_histograms = max_tracker.get_channel_histograms()
+        if channel_histograms is not None:
+            arrays['histogram_counts'] = np.array([hist for hist, bin_edges in channel_histograms])
+            arrays['histogram_bin_edges'] = np.array([bin_edges for hist, bin_edges in channel_histograms])
+
+        correlation = max_tracker.get_correlation()
+        if correlation is not None:
+            arrays['correlation'] = correlation
+
+        layer_manifest = {'is_spatial': bool(is_spatial),
+                          'n_channels': int(max_tracker.max_vals.shape[0]),
+                          'arrays': {}}
+
+        mkdir_p(os.path.join(temp_dirname, normalized_layer_name))
+        for array_name, array in sorted(arrays.iteritems()):
+            relative_filename = os.path.join(normalized_layer_name, array_name + '.npy')
+            np.save(os.path.join(temp_dirname, relative_filename), np.ascontiguousarray(array))
+            layer_manifest['arrays'][array_name] = relative_filename
+
+        manifest['layers'][normalized_layer_name] = layer_manifest
+
+    with open(os.path.join(temp_dirname, STORE_MANIFEST_FILENAME), 'wt') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    # swap the new store in place of the old one
+    old_dirname = dirname + '.old'
+    if os.path.isdir(dirname):
+        os.rename(dirname, old_dirname)
+    os.rename(temp_dirname, dirname)
+    if os.path.isdir(old_dirname):
+        shutil.rmtree(old_dirname)
+
+
+class StoredMaxTracker(object):
+    '''
+    read only view of a single layer of a columnar store, with the same result members and accessors as MaxTracker
+    arrays are memory mapped on first access
+    '''
+
+    def __init__(self, dirname, layer_manifest):
+        self.dirname = dirname
+        self.is_spatial = layer_manifest['is_spatial']
+        self.n_channels = layer_manifest['n_channels']
+        self.array_filenames = layer_manifest['arrays']
+        self._arrays = {}
+
+    def get_array(self, array_name):
+        '''returns the memory mapped array, or None if the store does not hold it'''
+
+        if array_name not in self._arrays:
+            if array_name not in self.array_filenames:
+                return None
+            self._arrays[array_name] = np.load(os.path.join(self.dirname, self.array_filenames[array_name]), mmap_mode='r')
+
+        return self._arrays[array_name]
+
+    @property
+    def max_vals(self):
+        return self.get_array('max_vals')
+
+    @property
+    def max_locs(self):
+        return self.get_array('max_locs')
+
+    @property
+    def min_vals(self):
+        return self.get_array('min_vals')
+
+    @property
+    def min_locs(self):
+        return self.get_array('min_locs')
+
+    def get_channel_histograms(self):
+        '''
+        :return: list of (hist, bin_edges) tuples, one for each channel, or None if the store has no histogram data
+        '''
+
+        hists = self.get_array('histogram_counts')
+        bin_edges = self.get_array('histogram_bin_edges')
+        if hists is None or bin_edges is None:
+            return None
+
+        return [(hists[channel_idx], bin_edges[channel_idx]) for channel_idx in xrange(self.n_channels)]
+
+    def get_correlation(self):
+        '''
+        :return: (n_channels, n_channels) array, or None if the store has no correlation data
+        '''
+        return self.get_array('correlation')
+
+
+class MaxTrackerStore(object):
+    '''read only view of a columnar store, with the same max_trackers dictionary as NetMaxTracker'''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+        with open(os.path.join(dirname, STORE_MANIFEST_FILENAME), 'rt') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        assert manifest['format_version'] == STORE_FORMAT_VERSION, 'unsupported store format version %s in %s' % (manifest['format_version'], dirname)
+
+        self.n_top = manifest['n_top']
+        self.search_min = manifest['search_min']
+        self.scanned_range = tuple(manifest['scanned_range']) if manifest['scanned_range'] is not None else None
+        self.file_list_digest = manifest['file_list_digest']
+        self.file_list_length = manifest['file_list_length']
+
+        self.max_trackers = dict([(str(normalized_layer_name), StoredMaxTracker(dirname, layer_manifest))
+                                  for normalized_layer_name, layer_manifest in manifest['layers'].iteritems()])
+
+
+def load_max_tracker_results(filename):
+    '''
+    loads NetMaxTracker results for reading
+    :param filename: store directory, or pickled NetMaxTracker. the store saved next to the pickle file is preferred
+    :return: MaxTrackerStore, or unpickled NetMaxTracker if there is no store
+    '''
+
+    if is_store_dirname(filename):
+        return MaxTrackerStore(filename)
+
+    if is_store_dirname(get_store_dirname(filename)):
+        return MaxTrackerStore(get_store_dirname(filename))
+
+    import max_tracker
+    with open(filename, 'rb') as tracker_file:
+        return pickle.load(tracker_file)
@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+
+# this import must comes first to make sure we use the non-display backend
+import matplotlib
+matplotlib.use('Agg')
+
+# add parent folder to search path, to enable import of core modules like settings
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import argparse
+
+import settings
+
+from jby_misc import WithTimer
+from max_tracker import merge_max_trackers
+from find_max_acts import save_max_tracker_to_file, load_max_tracker_from_file
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Merges pickled NetMaxTrackers, produced by find_max_acts.py on shards of the same file list, into a single NetMaxTracker.')
+    parser.add_argument('infiles', type = str, nargs = '+', help = 'pickled NetMaxTrackers to merge')
+    parser.add_argument('--outfile', type = str, default = os.path.join(settings.caffevis_outputs_dir, 'find_max_acts_output.pickled'), help = 'output filename for merged pkl')
+    parser.add_argument('--outdir', type = str, default = settings.caffevis_outputs_dir, help = 'Which output directory to use. Files are output into outdir/layer/unit_%%04d/{max_histogram}.png')
+    parser.add_argument('--do-histograms', action = 'store_true', default = settings.max_tracker_do_histograms, help = 'Output histogram image file containing histogrma of max values per channel')
+    parser.add_argument('--do-correlation', action = 'store_true', default = settings.max_tracker_do_correlation, help = 'Output correlation image file containing correlation of channels per layer')
+
+    args = parser.parse_args()
+
+    net_max_trackers = []
+    for filename in args.infiles:
+        with WithTimer('Loading %s' % filename):
+            net_max_trackers.append(load_max_tracker_from_file(filename))
+
+    with WithTimer('Merging %d trackers' % len(net_max_trackers)):
+        net_max_tracker = merge_max_trackers(net_max_trackers)
+
+    print 'Merged tracker covers image range', net_max_tracker.scanned_range
+
+    save_max_tracker_to_file(args.outfile, net_max_tracker)
+
+    # settings are not pickled, restore them before calculating per layer outputs
+    net_max_tracker.restore_settings(settings)
+
+    if args.do_correlation:
+        net_max_tracker.calculate_correlation(args.outdir)
+
+    if args.do_histograms:
+        net_max_tracker.calculate_histograms(args.outdir)
+
+
+if __name__ == '__main__':
+    main()
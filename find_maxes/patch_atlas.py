@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+
+import json
+import os
+
+import numpy as np
+
+from misc import mkdir_p
+
+# packed patch outputs of crop_max_patches: instead of one png file per patch, every layer has a single directory,
+# outdir/layer/patch_atlas, holding a small json manifest and a few arrays for each kind of output (e.g. maxim, deconv,
+# min_maxim, info). image kinds hold a uint8 array of shape (n_channels, n_top, height, width, 3) with the RGB patch of
+# every channel and rank, the actual (height, width) of each patch, and the state of each patch. info kinds hold the
+# max value and location of each channel and rank. readers memory map the arrays, so all the patches of a layer are
+# read from a few files
+
+PATCH_ATLAS_DIRNAME = 'patch_atlas'
+PATCH_ATLAS_MANIFEST_FILENAME = 'manifest.json'
+PATCH_ATLAS_FORMAT_VERSION = 1
+
+# states of a single patch
+PATCH_PENDING = 0
+PATCH_WRITTEN = 1
+PATCH_MISSING = -1  # the max tracker has no data for this rank
+
+
+def get_patch_atlas_dirname(outdir, layer_name):
+    return os.path.join(outdir, layer_name, PATCH_ATLAS_DIRNAME)
+
+
+def is_patch_atlas_dirname(dirname):
+    return os.path.isfile(os.path.join(dirname, PATCH_ATLAS_MANIFEST_FILENAME))
+
+
+class PatchAtlas(object):
+    '''
+    packed patches of a single layer, see above
+    the arrays of each kind are created once, with zero states, and then filled in any order, so a crop run which was
+    stopped can be continued by skipping the channels which are already done
+    '''
+
+    def __init__(self, dirname, writable = False):
+        self.dirname = dirname
+        self.writable = writable
+        self._arrays = {}
+
+        if is_patch_atlas_dirname(dirname):
+            with open(os.path.join(dirname, PATCH_ATLAS_MANIFEST_FILENAME), 'rt') as manifest_file:
+                self.manifest = json.load(manifest_file)
+            assert self.manifest['format_version'] == PATCH_ATLAS_FORMAT_VERSION, 'unsupported patch atlas format version %s in %s' % (self.manifest['format_version'], dirname)
+        else:
+            assert writable, 'no patch atlas in %s' % dirname
+            self.manifest = {'format_version': PATCH_ATLAS_FORMAT_VERSION,
+                             'n_channels': None,
+                             'n_top': None,
+                             'patch_shape': None,
+                             'tracker': None,
+                             'kinds': {}}
+
+    def _save_manifest(self):
+        '''writes the manifest to a temporary file which then replaces the old one, so readers never see a partial manifest'''
+
+        temp_filename = os.path.join(self.dirname, PATCH_ATLAS_MANIFEST_FILENAME + '.tmp')
+        with open(temp_filename, 'wt') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.rename(temp_filename, os.path.join(self.dirname, PATCH_ATLAS_MANIFEST_FILENAME))
+
+    def _create_array(self, kind, array_name, dtype, shape):
+        relative_filename = '%s_%s.npy' % (kind, array_name)
+        array = np.lib.format.open_memmap(os.path.join(self.dirname, relative_filename), mode='w+', dtype=dtype, shape=shape)
+        self._arrays[(kind, array_name)] = array
+        return relative_filename
+
+    def add_kinds(self, n_channels, n_top, patch_shape, image_kinds, info_kinds, tracker):
+        '''
+        creates the arrays of the kinds which are not in the atlas yet
+        :param n_channels: number of channels of the layer
+        :param n_top: number of patches kept for each channel
+        :param patch_shape: (height, width) of the largest patch of the layer
+        :param image_kinds: list of image kinds, e.g. ['maxim', 'min_maxim']
+        :param info_kinds: list of info kinds, e.g. ['info']
+        :param tracker: identifies the max tracker the patches are cropped for, e.g. from get_crop_manifest_header().
+                        patches of another tracker are marked pending again, so they are cropped again
+        :return: none
+        '''
+
+        assert self.writable, 'patch atlas %s was not opened for writing' % self.dirname
+
+        if self.manifest['n_channels'] is None:
+            self.manifest['n_channels'] = n_channels
+            self.manifest['n_top'] = n_top
+            self.manifest['patch_shape'] = list(patch_shape)
+
+        assert (self.manifest['n_channels'], self.manifest['n_top'], tuple(self.manifest['patch_shape'])) == (n_channels, n_top, tuple(patch_shape)), \
+            'patch atlas in %s holds %d channels, top %d, patches of %s, use another output directory' % (self.dirname, self.manifest['n_channels'], self.manifest['n_top'], self.manifest['patch_shape'])
+
+        # atlases written before the tracker was recorded have no tracker, and are cropped again too
+        if self.manifest.get('tracker') != tracker:
+            for kind in self.manifest['kinds']:
+                self.get_array(kind, 'states')[...] = PATCH_PENDING
+            self.manifest['tracker'] = tracker
+
+            # states are reset before the manifest refers to the new tracker
+            if self.manifest['kinds']:
+                self.flush()
+                self._save_manifest()
+
+        new_kinds = [kind for kind in image_kinds + info_kinds if kind not in self.manifest['kinds']]
+        if not new_kinds:
+            return
+
+        mkdir_p(self.dirname)
+        for kind in new_kinds:
+            if kind in image_kinds:
+                arrays = {'patches': self._create_array(kind, 'patches', np.uint8, (n_channels, n_top, patch_shape[0], patch_shape[1], 3)),
+                          'shapes': self._create_array(kind, 'shapes', np.int32, (n_channels, n_top, 2))}
+            else:
+                arrays = {'values': self._create_array(kind, 'values', np.float64, (n_channels, n_top)),
+                          'locs': self._create_array(kind, 'locs', np.int64, (n_channels, n_top, 4))}
+            arrays['states'] = self._create_array(kind, 'states', np.int8, (n_channels, n_top))
+            self.manifest['kinds'][kind] = {'type': 'image' if kind in image_kinds else 'info', 'arrays': arrays}
+
+        # arrays are created before the manifest refers to them
+        self.flush()
+        self._save_manifest()
+
+    def has_kind(self, kind):
+        return kind in self.manifest['kinds']
+
+    def get_array(self, kind, array_name):
+        '''returns the memory mapped array'''
+
+        if (kind, array_name) not in self._arrays:
+            filename = os.path.join(self.dirname, self.manifest['kinds'][kind]['arrays'][array_name])
+            self._arrays[(kind, array_name)] = np.load(filename, mmap_mode='r+' if self.writable else 'r')
+
+        return self._arrays[(kind, array_name)]
+
+    def is_channel_done(self, kinds, channel_idx):
+        '''returns True if all the patches of the channel, in all the given kinds, are written or missing'''
+
+        return all([self.has_kind(kind) and (self.get_array(kind, 'states')[channel_idx] != PATCH_PENDING).all() for kind in kinds])
+
+    def set_missing(self, kinds, channel_idx, rank):
+        for kind in kinds:
+            self.get_array(kind, 'states')[channel_idx, rank] = PATCH_MISSING
+
+    def set_patch(self, kind, channel_idx, rank, image):
+        '''
+        :param image: (01c, RGB) image with values in [0,1], e.g. as returned by caffe_image_to_rgb
+        '''
+
+        height, width = image.shape[0:2]
+        self.get_array(kind, 'patches')[channel_idx, rank, :height, :width] = np.clip(np.round(image * 255), 0, 255).astype(np.uint8)
+        self.get_array(kind, 'shapes')[channel_idx, rank] = (height, width)
+        self.get_array(kind, 'states')[channel_idx, rank] = PATCH_WRITTEN
+
+    def set_info(self, kind, channel_idx, rank, value, loc):
+        '''
+        :param loc: max tracker location, (image_idx, selected_input_index, ii, jj) or (image_idx, selected_input_index)
+        '''
+
+        self.get_array(kind, 'values')[channel_idx, rank] = value
+        self.get_array(kind, 'locs')[channel_idx, rank] = tuple(loc) + (0,) * (4 - len(loc))
+        self.get_array(kind, 'states')[channel_idx, rank] = PATCH_WRITTEN
+
+    def get_patches(self, kind, channel_idx):
+        '''
+        :return: list of the written (01c, RGB) uint8 patches of the channel, from the highest rank, as copies
+        '''
+
+        states = self.get_array(kind, 'states')[channel_idx]
+        patches = self.get_array(kind, 'patches')[channel_idx]
+        shapes = self.get_array(kind, 'shapes')[channel_idx]
+
+        return [np.array(patches[rank, :shapes[rank, 0], :shapes[rank, 1]]) for rank in np.flatnonzero(states == PATCH_WRITTEN)]
+
+    def get_values(self, kind, channel_idx):
+        '''
+        :return: list of the written values of the channel, from the highest rank
+        '''
+
+        states = self.get_array(kind, 'states')[channel_idx]
+        return list(self.get_array(kind, 'values')[channel_idx][states == PATCH_WRITTEN])
+
+    def flush(self):
+        for array in self._arrays.itervalues():
+            if isinstance(array, np.memmap) and array.mode != 'r':
+                array.flush()
+
+
+# patch atlases opened for reading, see load_patch_atlas
+_patch_atlas_cache = dict()
+
+
+def load_patch_atlas(outdir, layer_name):
+    '''
+    returns the patch atlas of the layer opened for reading, or None if the layer has none
+    atlases are cached, and opened again when their manifest changes
+    '''
+
+    dirname = get_patch_atlas_dirname(outdir, layer_name)
+    try:
+        manifest_mtime = os.path.getmtime(os.path.join(dirname, PATCH_ATLAS_MANIFEST_FILENAME))
+    except OSError:
+        return None
+
+    cached = _patch_atlas_cache.get(dirname)
+    if cached is None or cached[0] != manifest_mtime:
+        cached = (manifest_mtime, PatchAtlas(dirname))
+        _patch_atlas_cache[dirname] = cached
+
+    return cached[1]
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+import hashlib
+
+import numpy as np
+
+
+def hash_inputs(input_sources):
+    '''
+    hashes input identifiers, e.g. filenames or pairs of filenames, to 64 bit values
+    :param input_sources: list of input identifiers
+    :return: uint64 array with one hash per identifier
+    '''
+
+    digests = ''.join(hashlib.md5(repr(input_source)).digest()[:8] for input_source in input_sources)
+    return np.frombuffer(digests, dtype='<u8').astype(np.uint64)
+
+
+class SeenInputsIndex(object):
+    '''
+    compact set of input identifiers, used to avoid updating on the same input twice
+
+    identifiers are kept as sorted 64 bit hashes, 8 bytes per input, so the index of a scan over millions of inputs is
+    cheap to keep in memory and to pickle with the tracker. recently added hashes are kept in a small python set, and are
+    merged into the sorted array once it grows
+    '''
+
+    # number of recently added hashes kept outside the sorted array
+    MAX_PENDING = 65536
+
+    def __init__(self):
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self._pending = set()
+
+    def __len__(self):
+        return len(self.hashes) + len(self._pending)
+
+    def __getstate__(self):
+        self._compact()
+        return {'hashes': self.hashes}
+
+    def __setstate__(self, state):
+        self.hashes = state['hashes']
+        self._pending = set()
+
+    def _compact(self):
+        '''merges the recently added hashes into the sorted array'''
+
+        if self._pending:
+            pending = np.fromiter(self._pending, dtype=np.uint64, count=len(self._pending))
+            self.hashes = np.union1d(self.hashes, pending)
+            self._pending = set()
+
+    def contains(self, hashes):
+        '''
+        :param hashes: uint64 array of input hashes
+        :return: boolean array, True for hashes already in the index
+        '''
+
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        positions = np.searchsorted(self.hashes, hashes).clip(0, max(len(self.hashes) - 1, 0))
+        if len(self.hashes) > 0:
+            found = (self.hashes[positions] == hashes)
+        else:
+            found = np.zeros(len(hashes), dtype=bool)
+
+        if self._pending:
+            found |= np.array([long(value) in self._pending for value in hashes], dtype=bool)
+
+        return found
+
+    def add(self, hashes):
+        '''
+        adds hashes to the index, in order
+        :param hashes: uint64 array of input hashes
+        :return: boolean array, True for hashes which were not in the index before, including repeats inside hashes
+        '''
+
+        is_new = ~self.contains(hashes)
+        for position in np.flatnonzero(is_new):
+            value = long(hashes[position])
+            if value in self._pending:
+                is_new[position] = False
+            else:
+                self._pending.add(value)
+
+        if len(self._pending) >= self.MAX_PENDING:
+            self._compact()
+
+        return is_new
+
+    def merge(self, other):
+        '''adds all the hashes of another index'''
+
+        self._compact()
+        other._compact()
+        self.hashes = np.union1d(self.hashes, other.hashes)
@@ -10,7 +10,6 @@ cv2.destroyWindow('test')
 
 import skimage
 import skimage.io
-import matplotlib.pyplot as plt
 
 
 from misc import WithTimer
@@ -40,14 +39,119 @@ def fig2data(fig):
     
 
 
-def array_histogram(arr, histogram_pane_shape, title, xlabel, ylabel):
-    fig = plt.figure(figsize=(10, 10), facecolor='white')
-    ax = fig.add_subplot(111)
+def rasterize_histogram(hist, bin_edges, out_shape, title, xlabel, ylabel, bar_colors = None, out = None):
+    '''
+    draws a bar chart of a histogram, with axes, ticks and labels, straight into an image at the requested resolution.
+    a fast replacement for drawing a matplotlib figure and reading it with fig2data
+    :param hist: counts of the bins
+    :param bin_edges: edges of the bins, one more than the counts
+    :param out_shape: (height, width) of the image, more dimensions are ignored
+    :param bar_colors: list of RGB colors in [0,1], one per bin, None draws all the bars in green
+    :param out: preallocated (height, width, 3) uint8 image to draw into, None allocates a new image
+    :return: (height, width, 3) uint8 RGB image
+    '''
+
+    height, width = out_shape[0:2]
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    out[:] = 255
+
+    hist = np.asarray(hist, dtype=np.float64)
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    if bar_colors is None:
+        bar_colors = [(0, 0.5, 0)] * len(hist)
+
+    face = cv2.FONT_HERSHEY_SIMPLEX
+    fsize = min(max(min(height, width) / 700.0, 0.3), 1.0)
+    thick = 1
+    black = (0, 0, 0)
+    text_height = cv2.getTextSize('0', face, fsize, thick)[0][1]
+
+    def text_width(string):
+        return cv2.getTextSize(string, face, fsize, thick)[0][0]
+
+    # data ranges, with a margin around the bars like matplotlib
+    x_min, x_max = bin_edges[0], bin_edges[-1]
+    if not x_max > x_min:
+        x_min, x_max = x_min - 0.5, x_min + 0.5
+    x_margin = 0.05 * (x_max - x_min)
+    y_max = hist.max() if len(hist) > 0 and hist.max() > 0 else 1.0
+    x_ticks = np.linspace(bin_edges[0], bin_edges[-1], 5)
+    y_ticks = np.linspace(0, y_max, 5)
+    x_tick_labels = ['%.3g' % tick for tick in x_ticks]
+    y_tick_labels = ['%.3g' % tick for tick in y_ticks]
+
+    # plot area
+    left = max([text_width(label) for label in y_tick_labels]) + 3 * text_height
+    right = width - 2 * text_height
+    top = 3 * text_height
+    bottom = height - 4 * text_height
+    if right - left < 2 or bottom - top < 2:
+        return out
+
+    def to_col(values):
+        return np.round(left + (np.asarray(values) - (x_min - x_margin)) / (x_max - x_min + 2 * x_margin) * (right - left)).astype(int)
+
+    def to_row(values):
+        return np.round(bottom - np.asarray(values) / (y_max * 1.05) * (bottom - top)).astype(int)
+
+    # bars
+    if len(hist) > 0:
+        bar_width = 0.7 * (bin_edges[1] - bin_edges[0])
+        center = (bin_edges[:-1] + bin_edges[1:]) / 2
+        bar_lefts = to_col(center - bar_width / 2)
+        bar_rights = np.maximum(to_col(center + bar_width / 2), bar_lefts + 1)
+        bar_tops = to_row(hist)
+        for i in range(len(hist)):
+            if hist[i] > 0:
+                out[bar_tops[i]:bottom, bar_lefts[i]:bar_rights[i]] = to_255(tuple(bar_colors[i]))
+
+    # axes and ticks
+    tick_length = max(text_height / 3, 2)
+    cv2.rectangle(out, (left, top), (right, bottom), black, thick)
+    for col, label in zip(to_col(x_ticks), x_tick_labels):
+        col = int(col)
+        cv2.line(out, (col, bottom), (col, bottom + tick_length), black, thick)
+        cv2.putText(out, label, (col - text_width(label) / 2, bottom + tick_length + text_height * 3 / 2), face, fsize, black, thick)
+    for row, label in zip(to_row(y_ticks), y_tick_labels):
+        row = int(row)
+        cv2.line(out, (left - tick_length, row), (left, row), black, thick)
+        cv2.putText(out, label, (left - tick_length - text_width(label) - 2, row + text_height / 2), face, fsize, black, thick)
+
+    # title and labels
+    cv2.putText(out, title, ((width - text_width(title)) / 2, text_height * 2), face, fsize, black, thick)
+    cv2.putText(out, xlabel, ((left + right - text_width(xlabel)) / 2, height - text_height / 2), face, fsize, black, thick)
+
+    # the y label is drawn horizontally, and rotated to read from bottom to top
+    label_image = np.empty((text_height * 2, text_width(ylabel) + 2, 3), dtype=np.uint8)
+    label_image[:] = 255
+    cv2.putText(label_image, ylabel, (1, text_height * 3 / 2), face, fsize, black, thick)
+    label_image = np.rot90(label_image)[:bottom - top]
+    label_row = top + (bottom - top - label_image.shape[0]) / 2
+    out[label_row:label_row + label_image.shape[0], 0:label_image.shape[1]] = label_image
+
+    return out
+
+
+def array_histogram(arr, histogram_pane_shape, title, xlabel, ylabel, use_matplotlib = False):
+    '''
+    draws the histogram of the values of an array
+    :param use_matplotlib: draw with matplotlib, which is slower, otherwise the histogram is rasterized directly at
+                           histogram_pane_shape
+    '''
 
     # generate histogram
     values = arr.flatten()
     hist, bin_edges = np.histogram(values, bins=50)
 
+    if not use_matplotlib:
+        return rasterize_histogram(hist, bin_edges, histogram_pane_shape, title, xlabel, ylabel)
+
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10, 10), facecolor='white')
+    ax = fig.add_subplot(111)
+
     width = 0.7 * (bin_edges[1] - bin_edges[0])
     center = (bin_edges[:-1] + bin_edges[1:]) / 2
     ax.bar(center, hist, align='center', width=width, color='g')
@@ -610,26 +714,31 @@ def cv2_typeset_text(data, lines, loc, between = ' ', string_spacing = 0, line_s
     return locy, boxes
 
 
-def saveimage(filename, im):
-    '''Saves an image with pixel values in [0,1]'''
+def saveimage(filename, im, png_compression = None):
+    '''Saves an image with pixel values in [0,1], png_compression is the PNG compression level (0-9), None for the default'''
     #matplotlib.image.imsave(filename, im)
+    params = []
+    if png_compression is not None:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
     if len(im.shape) == 3:
         # Reverse RGB to OpenCV BGR order for color images
-        cv2.imwrite(filename, 255*im[:,:,::-1])
+        cv2.imwrite(filename, 255*im[:,:,::-1], params)
     else:
-        cv2.imwrite(filename, 255*im)
+        cv2.imwrite(filename, 255*im, params)
 
 
-def saveimagesc(filename, im):
-    saveimage(filename, norm01(im))
+def saveimagesc(filename, im, png_compression = None):
+    saveimage(filename, norm01(im), png_compression)
 
 
-def saveimagescc(filename, im, center):
-    saveimage(filename, norm01c(im, center))
+def saveimagescc(filename, im, center, png_compression = None):
+    saveimage(filename, norm01c(im, center), png_compression)
 
 
 def gray_to_colormap(map_name, gray_image):
 
+    import matplotlib.pyplot as plt
+
     cmap = plt.get_cmap(map_name)
     rgba_image = cmap(gray_image)
     rgb_image = np.delete(rgba_image, 3, 2)
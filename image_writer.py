@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from caffe_misc import save_caffe_image
+from image_misc import saveimagesc, saveimagescc
+
+
+def write_file(filename, contents):
+    '''writes a string, e.g. text or pickled data, to a file'''
+
+    with open(filename, 'wb') as output_file:
+        output_file.write(contents)
+
+
+class _WriterCallback(object):
+    '''callback queued in order with the writes, it is called on the calling thread once all the writes before it are done'''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def ready(self):
+        return True
+
+    def get(self):
+        self.callback()
+
+
+class AsyncImageWriter(object):
+    '''
+    encodes and writes output images and files on a pool of workers, so the thread which owns the net can go on with
+    the next forward/backward pass while the previous outputs are written
+
+    writes are queued in order, and at most max_pending writes wait at any time, the caller blocks when the queue is full.
+    an error of a write is raised again on the calling thread, by a later call or by flush(). use as a context manager
+    to make sure all the writes are done before the outputs are used:
+
+        with AsyncImageWriter(4, 64) as image_writer:
+            image_writer.save_caffe_image(img, filename)
+
+    the arrays and strings given to the writer are not copied, and must not be changed by the caller after the call
+    '''
+
+    def __init__(self, n_workers, max_pending, use_processes = False, png_compression = None):
+        '''
+        :param n_workers: number of workers, 0 writes on the calling thread
+        :param max_pending: maximal number of writes waiting in the queue, bounds the memory used
+        :param use_processes: use worker processes instead of threads
+        :param png_compression: PNG compression level (0-9) of the images, None keeps the default of the image library
+        '''
+
+        self.max_pending = max(max_pending, 1)
+        self.png_compression = png_compression
+        self.pending = deque()
+        self.pool = None
+        if n_workers > 0:
+            self.pool = Pool(n_workers) if use_processes else ThreadPool(n_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep what was already produced, but let the original error through
+            try:
+                self.close()
+            except Exception as write_error:
+                print 'WARNING: failed writing outputs:', write_error
+        return False
+
+    def submit(self, function, *args, **kwargs):
+        '''queues a call to a module level function which writes an output'''
+
+        if self.pool is None:
+            function(*args, **kwargs)
+            return
+
+        self.pending.append(self.pool.apply_async(function, args, kwargs))
+        self._collect()
+
+    def call_when_done(self, callback):
+        '''calls callback, on the calling thread, once all the writes queued so far are done, e.g. to record them'''
+
+        if self.pool is None:
+            callback()
+            return
+
+        self.pending.append(_WriterCallback(callback))
+        self._collect()
+
+    def _collect(self):
+        '''blocks while the queue is full, and collects finished writes in order, raising their errors'''
+
+        while len(self.pending) >= self.max_pending or (self.pending and self.pending[0].ready()):
+            self.pending.popleft().get()
+
+    def save_caffe_image(self, img, filename, autoscale = True, autoscale_center = None):
+        '''queues caffe_misc.save_caffe_image'''
+
+        self.submit(save_caffe_image, img, filename, autoscale, autoscale_center, self.png_compression)
+
+    def saveimagesc(self, filename, im):
+        '''queues image_misc.saveimagesc'''
+
+        self.submit(saveimagesc, filename, im, self.png_compression)
+
+    def saveimagescc(self, filename, im, center):
+        '''queues image_misc.saveimagescc'''
+
+        self.submit(saveimagescc, filename, im, center, self.png_compression)
+
+    def write_file(self, filename, contents):
+        '''queues writing a string to a file'''
+
+        self.submit(write_file, filename, contents)
+
+    def flush(self):
+        '''waits until all the queued writes are done, raises the first error of a write'''
+
+        while self.pending:
+            self.pending.popleft().get()
+
+    def close(self):
+        '''flushes the queued writes and stops the workers'''
+
+        if self.pool is None:
+            return
+
+        try:
+            self.flush()
+        finally:
+            self.pending.clear()
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def get_image_writer(settings):
+    '''returns an AsyncImageWriter configured by the output image writer settings'''
+
+    return AsyncImageWriter(settings.output_image_writer_workers, settings.output_image_writer_max_pending,
+                            settings.output_image_writer_use_processes, settings.output_image_png_compression)
@@ -2,7 +2,7 @@ import os
 import cv2
 import re
 import time
-from threading import RLock
+from threading import RLock, Condition
 import numpy as np
 
 from codependent_thread import CodependentThread
@@ -11,16 +11,46 @@ from misc import tsplit, get_files_list
 
 import caffe
 
+
+def get_static_frame_key(settings, filename, stretch_mode):
+    '''Returns the key of a static input image in the static input cache. The model is part of the key, as the
+    cached activations depend on it'''
+    return (filename, stretch_mode, settings.model_to_load)
+
+
+def load_static_frame(settings, filename, stretch_mode):
+    '''Loads a static input image, or a pair of them for siamese networks, cropped to square unless stretch_mode'''
+
+    if settings.is_siamese:
+        # loading two images for siamese network
+        im1 = caffe.io.load_image(os.path.join(settings.static_files_dir, filename[0]), color=not settings._calculated_is_gray_model)
+        im2 = caffe.io.load_image(os.path.join(settings.static_files_dir, filename[1]), color=not settings._calculated_is_gray_model)
+        if not stretch_mode:
+            im1 = crop_to_square(im1)
+            im2 = crop_to_square(im2)
+
+        return (im1,im2)
+
+    else:
+        im = caffe.io.load_image(os.path.join(settings.static_files_dir, filename), color=not settings._calculated_is_gray_model)
+        if not stretch_mode:
+            im = crop_to_square(im)
+        return im
+
+
 class InputImageFetcher(CodependentThread):
     '''Fetches images from a webcam or loads from a directory.'''
     
-    def __init__(self, settings):
+    def __init__(self, settings, on_new_frame = None, static_input_cache = None):
         CodependentThread.__init__(self, settings.input_updater_heartbeat_required)
         self.daemon = True
         self.lock = RLock()
+        self.input_changed = Condition(self.lock)  # Notified when there may be a new frame to read
+        self.on_new_frame = on_new_frame            # Called whenever the frame changes, e.g. to wake the main loop
         self.quit = False
         self.latest_frame_idx = -1
         self.latest_frame_data = None
+        self.latest_frame_key = None       # identifies static frames in static_input_cache, None for cam frames
         self.latest_frame_is_from_cam = False
 
         # True for loading from file, False for loading from camera
@@ -46,6 +76,12 @@ class InputImageFetcher(CodependentThread):
         # latest loaded image frame, holds the pixels and used to force reloading
         self.latest_static_frame = None
 
+        # key of latest loaded image frame in static_input_cache
+        self.latest_static_frame_key = None
+
+        # LRU cache of decoded static images, also used by the apps for their results on each image
+        self.static_input_cache = static_input_cache
+
         # latest label for loaded image
         self.latest_label = None
 
@@ -55,6 +91,9 @@ class InputImageFetcher(CodependentThread):
         # contains the requested number of increaments for file index
         self.static_file_idx_increment = 0
 
+        # direction of the last increment, 1 or -1, followed by the look-ahead prefetch of static files
+        self.static_file_direction = 1
+
         self.available_files, self.labels = get_files_list(self.settings)
 
     def bind_camera(self):
@@ -85,6 +124,7 @@ class InputImageFetcher(CodependentThread):
     def set_mode_static(self):
         with self.lock:
             self.static_file_mode = True
+            self.input_changed.notify_all()
         
     def set_mode_cam(self):
         with self.lock:
@@ -93,6 +133,7 @@ class InputImageFetcher(CodependentThread):
             else:
                 self.static_file_mode = False
                 assert self.bound_cap_device != None, 'Call bind_camera first'
+                self.input_changed.notify_all()
         
     def toggle_input_mode(self):
         with self.lock:
@@ -108,6 +149,7 @@ class InputImageFetcher(CodependentThread):
                 self.latest_static_frame = None   # Force reload
                 self.latest_label = None
                 #self.latest_frame_is_from_cam = True  # Force reload
+                self.input_changed.notify_all()
         
     def set_mode_stretch_off(self):
         with self.lock:
@@ -116,6 +158,7 @@ class InputImageFetcher(CodependentThread):
                 self.latest_static_frame = None   # Force reload
                 self.latest_label = None
                 #self.latest_frame_is_from_cam = True  # Force reload
+                self.input_changed.notify_all()
         
     def toggle_stretch_mode(self):
         with self.lock:
@@ -124,6 +167,29 @@ class InputImageFetcher(CodependentThread):
             else:
                 self.set_mode_stretch_on()
         
+    def toggle_freeze_cam(self):
+        with self.lock:
+            self.freeze_cam = not self.freeze_cam
+            self.input_changed.notify_all()
+
+    def set_quit_flag(self):
+        with self.lock:
+            self.quit = True
+            self.input_changed.notify_all()
+
+    def _is_static_frame_current(self):
+        return (self.static_file_idx_increment == 0 and
+                self.static_file_idx is not None and
+                not self.latest_frame_is_from_cam and
+                self.latest_static_frame is not None)
+
+    def _is_frame_current(self):
+        '''Whether the latest frame is up to date, so there is nothing to read until the input changes'''
+        if self.static_file_mode:
+            return self._is_static_frame_current()
+        else:
+            return self.freeze_cam and self.latest_cam_frame is not None and self.latest_frame_is_from_cam
+
     def run(self):
         while not self.quit and not self.is_timed_out():
             #start_time = time.time()
@@ -153,8 +219,15 @@ class InputImageFetcher(CodependentThread):
                         else:
                             im = self.latest_cam_frame
                         self._increment_and_set_frame(im, True)
-            
-            time.sleep(self.sleep_after_read_frame)
+
+            with self.lock:
+                if self._is_frame_current():
+                    # Static file or frozen cam: wait until the file index, mode or freeze changes
+                    while not self.quit and self._is_frame_current():
+                        self.input_changed.wait()
+                elif not self.static_file_mode and self.sleep_after_read_frame > 0:
+                    # Live cam: throttle reading, but wake up on mode changes
+                    self.input_changed.wait(self.sleep_after_read_frame)
             #print 'Reading one frame took', time.time() - start_time
 
         print 'InputImageFetcher: exiting run method'
@@ -163,40 +236,50 @@ class InputImageFetcher(CodependentThread):
     def get_frame(self):
         '''Fetch the latest frame_idx and frame. The idx increments
         any time the frame data changes. If the idx is < 0, the frame
-        is not valid.
+        is not valid. The frame key identifies static frames in the
+        static_input_cache, and is None for cam frames.
         '''
         with self.lock:
-            return (self.latest_frame_idx, self.latest_frame_data, self.latest_label, self.latest_static_filename)
+            return (self.latest_frame_idx, self.latest_frame_data, self.latest_label, self.latest_static_filename, self.latest_frame_key)
 
     def increment_static_file_idx(self, amount = 1):
         with self.lock:
             self.static_file_idx_increment += amount
+            if amount != 0:
+                self.static_file_direction = 1 if amount > 0 else -1
+            self.input_changed.notify_all()
+
+    def get_static_position(self):
+        '''Returns whether in static file mode, the current file index (None before the first file is loaded), the
+        direction of the last increment, and the stretch mode'''
+        with self.lock:
+            return (self.static_file_mode, self.static_file_idx, self.static_file_direction, self.static_file_stretch_mode)
 
     def next_image(self):
         if self.static_file_mode:
             self.increment_static_file_idx(1)
         else:
-            self.static_file_mode = True
+            self.set_mode_static()
 
     def prev_image(self):
         if self.static_file_mode:
             self.increment_static_file_idx(-1)
         else:
-            self.static_file_mode = True
+            self.set_mode_static()
 
-    def _increment_and_set_frame(self, frame, from_cam):
+    def _increment_and_set_frame(self, frame, from_cam, frame_key = None):
         assert frame is not None
         with self.lock:
             self.latest_frame_idx += 1
             self.latest_frame_data = frame
+            self.latest_frame_key = frame_key
             self.latest_frame_is_from_cam = from_cam
+        if self.on_new_frame is not None:
+            self.on_new_frame()
 
     def check_increment_and_load_image(self):
         with self.lock:
-            if (self.static_file_idx_increment == 0 and
-                self.static_file_idx is not None and
-                not self.latest_frame_is_from_cam and
-                self.latest_static_frame is not None):
+            if self._is_static_frame_current():
                 # Skip if a static frame is already loaded and there is no increment
                 return
 
@@ -209,31 +292,29 @@ class InputImageFetcher(CodependentThread):
             if self.latest_static_filename != self.available_files[self.static_file_idx] or self.latest_static_frame is None:
                 self.latest_static_filename = self.available_files[self.static_file_idx]
 
+                frame_key = get_static_frame_key(self.settings, self.latest_static_filename, self.static_file_stretch_mode)
+                cached_im = None
+                if self.static_input_cache is not None:
+                    cached_im = self.static_input_cache.get(('frame', frame_key))
+
                 failed = False
                 try:
-                    if self.settings.is_siamese:
-                        # loading two images for siamese network
-                        im1 = caffe.io.load_image(os.path.join(self.settings.static_files_dir, self.latest_static_filename[0]), color=not self.settings._calculated_is_gray_model)
-                        im2 = caffe.io.load_image(os.path.join(self.settings.static_files_dir, self.latest_static_filename[1]), color=not self.settings._calculated_is_gray_model)
-                        if not self.static_file_stretch_mode:
-                            im1 = crop_to_square(im1)
-                            im2 = crop_to_square(im2)
-
-                        im = (im1,im2)
-
+                    if cached_im is not None:
+                        im = cached_im
                     else:
-                        im = caffe.io.load_image(os.path.join(self.settings.static_files_dir, self.latest_static_filename), color=not self.settings._calculated_is_gray_model)
-                        if not self.static_file_stretch_mode:
-                            im = crop_to_square(im)
+                        im = load_static_frame(self.settings, self.latest_static_filename, self.static_file_stretch_mode)
                 except Exception as e:
                     failed = True
                     print 'Failed loading data'
 
                 if not failed:
                     self.latest_static_frame = im
+                    self.latest_static_frame_key = frame_key
+                    if self.static_input_cache is not None and cached_im is None:
+                        self.static_input_cache.set(('frame', frame_key), im)
 
                     # if we have labels, keep it
                     if self.labels:
                         self.latest_label = self.labels[self.static_file_idx]
 
-            self._increment_and_set_frame(self.latest_static_frame, False)
+            self._increment_and_set_frame(self.latest_static_frame, False, self.latest_static_frame_key)
@@ -4,7 +4,7 @@ import sys
 import importlib
 from collections import OrderedDict
 import numpy as np
-from threading import Lock, RLock, Thread
+from threading import Lock, RLock, Thread, Event
 import time
 import glob
 
@@ -15,6 +15,7 @@ except ImportError:
     raise
 
 from misc import WithTimer
+from numpy_cache import LRULimitedArrayCache
 from image_misc import cv2_imshow_rgb, FormattedString, cv2_typeset_text, to_255, gray_to_color, ensure_uint255_and_resize_without_fit
 from bindings import bindings
 
@@ -64,6 +65,12 @@ class LiveVis(object):
         self.window_name = 'Deep Visualization Toolbox    |    Model: %s' % (settings.model_to_load)
         self.quit = False
         self.debug_level = 0
+        self.main_loop_wakeup = Event()   # Set by other threads when they have a new frame or something to draw
+
+        # Decoded static input images, and the results of the apps on them, e.g. activations
+        self.static_input_cache = None
+        if settings.static_input_cache_size > 0:
+            self.static_input_cache = LRULimitedArrayCache(settings.static_input_cache_size)
 
         self.debug_pane_defaults = {
             'face': getattr(cv2, self.settings.help_face),
@@ -161,7 +168,7 @@ class LiveVis(object):
         #cap = cv2.VideoCapture(self.settings.capture_device)
         from input_fetcher import InputImageFetcher
 
-        self.input_updater = InputImageFetcher(self.settings)
+        self.input_updater = InputImageFetcher(self.settings, self.wake_main_loop, self.static_input_cache)
         self.input_updater.bind_camera()
         self.input_updater.start()
 
@@ -181,7 +188,14 @@ class LiveVis(object):
         frame_for_apps = None
         redraw_needed = True    # Force redraw the first time
         imshow_needed = True
+        idle = False
         while not self.quit:
+            if idle:
+                # Nothing to do, sleep until another thread wakes us with a new frame or something to draw. Wake up
+                # at least every main_loop_idle_wait_ms anyway, to handle key presses and window events.
+                self.main_loop_wakeup.wait(self.settings.main_loop_idle_wait_ms / 1000.0)
+            self.main_loop_wakeup.clear()
+
             # Call any heartbeats
             for heartbeat in heartbeat_functions:
                 #print 'Heartbeat: calling', heartbeat
@@ -231,13 +245,14 @@ class LiveVis(object):
             redraw_needed |= self.check_for_control_height_update()
 
             # Grab latest frame from input_updater thread
-            fr_idx,fr_data,fr_label,fr_filename = self.input_updater.get_frame()
+            fr_idx,fr_data,fr_label,fr_filename,fr_key = self.input_updater.get_frame()
             is_new_frame = (fr_idx != latest_frame_idx and fr_data is not None)
             if is_new_frame:
                 latest_frame_idx = fr_idx
                 latest_frame_data = fr_data
                 latest_label = fr_label
                 latest_filename = fr_filename
+                latest_key = fr_key
                 frame_for_apps = fr_data
 
             if is_new_frame:
@@ -251,7 +266,7 @@ class LiveVis(object):
                 # Pass frame to apps for processing
                 for app_name, app in self.apps.iteritems():
                     with WithTimer('%s:handle_input' % app_name, quiet = self.debug_level < 1):
-                        app.handle_input(latest_frame_data, latest_label, latest_filename, self.panes)
+                        app.handle_input(latest_frame_data, latest_label, latest_filename, self.panes, latest_key)
                 frame_for_apps = None
 
             # Tell each app to draw
@@ -291,6 +306,8 @@ class LiveVis(object):
                         cv2_imshow_rgb(self.window_name, self.window_buffer)
                     imshow_needed = False
 
+            idle = not (keys or is_new_frame or frame_for_apps is not None or redraw_needed or imshow_needed)
+
             ii += 1
             since_keypress += 1
             since_redraw += 1
@@ -301,7 +318,7 @@ class LiveVis(object):
             #time.sleep(2)
 
         print '\n\nTrying to exit run_loop...'
-        self.input_updater.quit = True
+        self.input_updater.set_quit_flag()
         self.input_updater.join(.01 + float(self.settings.input_updater_sleep_after_read_frame) * 5)
         if self.input_updater.is_alive():
             raise Exception('Could not join self.input_updater thread')
@@ -312,12 +329,14 @@ class LiveVis(object):
             print 'Quitting app:', app_name
             app.quit()
 
+        if self.static_input_cache is not None:
+            print 'Static input cache:', self.static_input_cache
         print 'Input thread joined and apps quit; exiting run_loop.'
 
     def handle_key_pre_apps(self, key):
         tag = self.bindings.get_tag(key)
         if tag == 'freeze_cam':
-            self.input_updater.freeze_cam = not self.input_updater.freeze_cam
+            self.input_updater.toggle_freeze_cam()
         elif tag == 'toggle_input_mode':
             self.input_updater.toggle_input_mode()
         elif tag == 'static_file_increment':
@@ -394,5 +413,9 @@ class LiveVis(object):
     def set_quit_flag(self):
         self.quit = True
 
+    def wake_main_loop(self):
+        '''Wakes the main loop if it is idle, may be called from any thread'''
+        self.main_loop_wakeup.set()
+
 if __name__ == '__main__':
     print 'You probably want to run ./run_toolbox.py instead.'
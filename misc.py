@@ -4,6 +4,7 @@ import os
 import time
 import errno
 import re
+import cPickle as pickle
 
 
 class WithTimer:
@@ -42,6 +43,18 @@ def mkdir_p(path):
 
 
 
+def save_pickle_atomically(obj, filename):
+    '''Pickles obj into filename so that readers see either the old file or the complete new one, never a partial file'''
+
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as temp_file:
+        pickle.dump(obj, temp_file, -1)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.rename(temp_filename, filename)
+
+
+
 def combine_dicts(dicts_tuple):
     '''Combines multiple dictionaries into one by adding a prefix to keys'''
     ret = {}
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+
+import cPickle as pickle
+import hashlib
+import os
+
+from misc import mkdir_p
+
+# cache of the metadata derived from the network files: the processed prototxt, the parsed network definition, the
+# compiled receptive field maps, the blob info with its tile arrangements and the receptive fields of the layers.
+# every network has its own pickled dictionary in the cache directory, named by a hash of the contents of the prototxt
+# and weights files, so a changed network gets a new entry, and never sees the metadata of the old one
+
+NETWORK_METADATA_FORMAT_VERSION = 1
+WEIGHTS_HASHES_FILENAME = 'weights_hashes.pickled'
+
+
+def _hash_file(filename, hash_object):
+    with open(filename, 'rb') as input_file:
+        while True:
+            chunk = input_file.read(1 << 20)
+            if not chunk:
+                break
+            hash_object.update(chunk)
+
+
+def _load_pickle(filename, default):
+    try:
+        with open(filename, 'rb') as input_file:
+            return pickle.load(input_file)
+    except Exception:
+        # missing or broken cache files are computed again
+        return default
+
+
+def _save_pickle(filename, value):
+    '''writes to a temporary file which then replaces the old one, so readers, possibly in other processes, never see a partial file'''
+
+    try:
+        mkdir_p(os.path.dirname(filename))
+        temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temp_filename, 'wb') as output_file:
+            pickle.dump(value, output_file, -1)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        # ignore problems in cache saving
+        pass
+
+
+def get_weights_hash(cache_dir, weights_filename):
+    '''
+    returns the sha1 of the contents of the weights file
+    the hashes are kept in the cache directory by the file name, size and modification time, so the weights, which are
+    usually large, are read again only when they change
+    '''
+
+    if not os.path.isfile(weights_filename):
+        return 'missing'
+
+    weights_filename = os.path.abspath(weights_filename)
+    weights_stat = os.stat(weights_filename)
+    file_id = (weights_stat.st_size, weights_stat.st_mtime)
+
+    weights_hashes_filename = os.path.join(cache_dir, WEIGHTS_HASHES_FILENAME)
+    weights_hashes = _load_pickle(weights_hashes_filename, dict())
+    if weights_filename in weights_hashes and weights_hashes[weights_filename][0] == file_id:
+        return weights_hashes[weights_filename][1]
+
+    print 'Hashing network weights %s' % weights_filename
+    hash_object = hashlib.sha1()
+    _hash_file(weights_filename, hash_object)
+    weights_hashes[weights_filename] = (file_id, hash_object.hexdigest())
+    _save_pickle(weights_hashes_filename, weights_hashes)
+
+    return weights_hashes[weights_filename][1]
+
+
+def get_network_metadata_key(settings):
+    '''returns the hash which names the metadata of the network in the cache'''
+
+    hash_object = hashlib.sha1()
+    hash_object.update('format %d\n' % NETWORK_METADATA_FORMAT_VERSION)
+
+    # the prototxt is processed by the upgrade tool of this caffe
+    hash_object.update('caffe %s\n' % os.path.abspath(settings.caffevis_caffe_root))
+
+    _hash_file(settings.caffevis_deploy_prototxt, hash_object)
+    hash_object.update('\nweights %s\n' % get_weights_hash(settings.network_metadata_cache_dir, settings.caffevis_network_weights))
+
+    return hash_object.hexdigest()
+
+
+class NetworkMetadata(object):
+    '''
+    metadata of a single network, a dictionary of named entries which is read from the cache and saved back to it
+    when entries are added. without a filename, the entries are only kept in memory
+    '''
+
+    def __init__(self, filename = None):
+        self.filename = filename
+        self.entries = dict()
+        self._dirty = False
+
+        if filename is not None and os.path.isfile(filename):
+            cached = _load_pickle(filename, None)
+            if isinstance(cached, dict) and cached.get('format_version') == NETWORK_METADATA_FORMAT_VERSION:
+                self.entries = cached['entries']
+
+    def has(self, name):
+        return name in self.entries
+
+    def get(self, name, default = None):
+        return self.entries.get(name, default)
+
+    def set(self, name, value):
+        '''sets an entry, entries which are changed in place should be set again, so they are saved'''
+
+        self.entries[name] = value
+        self._dirty = True
+
+    def save(self):
+        '''saves the entries to the cache, if any was set since they were read'''
+
+        if self.filename is None or not self._dirty:
+            return
+
+        _save_pickle(self.filename, {'format_version': NETWORK_METADATA_FORMAT_VERSION, 'entries': self.entries})
+        self._dirty = False
+
+
+def load_network_metadata(settings):
+    '''returns the NetworkMetadata of the network in the settings, read from the cache when it was seen before'''
+
+    if settings.network_metadata_cache_dir is None:
+        return NetworkMetadata()
+
+    key = get_network_metadata_key(settings)
+    return NetworkMetadata(os.path.join(settings.network_metadata_cache_dir, key + '.pickled'))
+
+
+def get_network_metadata(settings):
+    '''returns the metadata of the network loaded by load_network, or an empty one kept in memory if there is none'''
+
+    if not hasattr(settings, '_network_metadata'):
+        settings._network_metadata = NetworkMetadata()
+
+    return settings._network_metadata
@@ -45,6 +45,76 @@ class FIFOLimitedArrayCache(object):
     def get_size(self):
         return self._store_bytes
 
+    def get_max_size(self):
+        return self._max_bytes
+
     def __str__(self):
         with self._lock:
             return 'FIFOLimitedArrayCache<%d items, bytes used/max %g/%g >' % (len(self._store), self._store_bytes, self._max_bytes)
+
+
+class LRULimitedArrayCache(FIFOLimitedArrayCache):
+    '''Threadsafe cache that stores numpy arrays (or any other object that
+    defines obj.nbytes, or tuples of them) and limits total memory. Items
+    are ejected, if necessary, starting from the least recently used.
+    Counts the hits and misses of get().
+    '''
+
+    def __init__(self, max_bytes = 1e7):
+        super(LRULimitedArrayCache, self).__init__(max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _nbytes(val):
+        if isinstance(val, tuple):
+            return sum([vv.nbytes for vv in val])
+        return val.nbytes
+
+    def get(self, key, default = None):
+        with self._lock:
+            if key in self._store:
+                self.hits += 1
+                val = self._store.pop(key)
+                self._store[key] = val    # Move to the most recently used end
+                return val
+            else:
+                self.misses += 1
+                return default
+
+    def has(self, key):
+        '''Whether key is in the cache, without counting a hit or miss or marking it as used'''
+        with self._lock:
+            return key in self._store
+
+    def get_nbytes(self, key):
+        '''Size of the entry of key, 0 if it is not in the cache, without counting a hit or miss or marking it as used'''
+        with self._lock:
+            if key in self._store:
+                return self._nbytes(self._store[key])
+            return 0
+
+    def set(self, key, val):
+        with self._lock:
+            if key in self._store:
+                self._store_bytes -= self._nbytes(self._store.pop(key))
+            self._store[key] = val
+            self._store_bytes += self._nbytes(val)
+            self._trim()
+
+    def _trim(self):
+        while len(self._store) > 0 and self._store_bytes > self._max_bytes:
+            key,val = self._store.popitem(last = False)
+            self._store_bytes -= self._nbytes(val)
+
+    def delete(self, key, raise_if_missing = False):
+        with self._lock:
+            if key in self._store:
+                self._store_bytes -= self._nbytes(self._store.pop(key))
+            elif raise_if_missing:
+                raise Exception('key %s not found in cache' % repr(key))
+
+    def __str__(self):
+        with self._lock:
+            return 'LRULimitedArrayCache<%d items, bytes used/max %g/%g, hits/misses %d/%d >' % (
+                len(self._store), self._store_bytes, self._max_bytes, self.hits, self.misses)
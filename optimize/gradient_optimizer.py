@@ -12,10 +12,10 @@ plt.rcParams['image.interpolation'] = 'nearest'
 plt.rcParams['image.cmap'] = 'gray'
 
 from misc import mkdir_p, combine_dicts
-from image_misc import saveimagesc, saveimagescc
+from image_writer import AsyncImageWriter
 
 from caffe_misc import RegionComputer, get_max_data_extent, compute_data_layer_focus_area, extract_patch_from_image, \
-    layer_name_to_top_name
+    layer_name_to_top_name, get_one_hot_backward
 
 from siamese_helper import SiameseHelper
 
@@ -162,9 +162,12 @@ class FindResults(object):
 class GradientOptimizer(object):
     '''Finds images by gradient.'''
     
-    def __init__(self, settings, net, batched_data_mean, labels = None, label_layers = [], channel_swap_to_rgb = None):
+    def __init__(self, settings, net, batched_data_mean, labels = None, label_layers = [], channel_swap_to_rgb = None,
+                 image_writer = None):
         self.settings = settings
         self.net = net
+        # results are written by image_writer if given, so the next optimization can start while they are encoded
+        self.image_writer = image_writer if image_writer is not None else AsyncImageWriter(0, 1)
         self.batched_data_mean = batched_data_mean
         self.labels = labels if labels else ['labels not provided' for ii in range(1000)]
         self.label_layers = label_layers if label_layers else list()
@@ -336,21 +339,19 @@ class GradientOptimizer(object):
 
 
             # 4. Do backward pass to get gradient
-            top_name = layer_name_to_top_name(self.net, params.push_layer)
-            diffs = self.net.blobs[top_name].diff * 0
-            if not is_spatial:
-                # Promote bc -> bc01
-                diffs = diffs[:,:,np.newaxis,np.newaxis]
-
-            if self.settings.is_siamese and layer_format == 'siamese_batch_pair' and acts.shape[0] == 2:
-                diffs[0, params.push_unit[0], params.push_unit[1], params.push_unit[2]] = params.push_dir
-            elif self.settings.is_siamese and layer_format == 'siamese_batch_pair' and acts.shape[0] == 1:
-                diffs[0, params.push_unit[0], params.push_unit[1], params.push_unit[2]] = params.push_dir
+            if self.settings.is_siamese and layer_format == 'siamese_batch_pair':
+                push_batch_indices = np.zeros(1, dtype=int)
             else:
-                diffs[np.arange(params.batch_size), params.push_unit[0], params.push_unit[1], params.push_unit[2]] = params.push_dir
-            backout = self.net.backward_from_layer(params.push_layer, diffs if is_spatial else diffs[:,:,0,0])
+                push_batch_indices = np.arange(params.batch_size)
+            n_push = len(push_batch_indices)
+
+            input_diffs = get_one_hot_backward(self.net).run(params.push_layer, push_batch_indices,
+                                                             np.repeat(params.push_unit[0], n_push),
+                                                             np.repeat(params.push_unit[1], n_push),
+                                                             np.repeat(params.push_unit[2], n_push),
+                                                             values = params.push_dir)
 
-            grad = backout['data'].copy()
+            grad = input_diffs.copy()
             reshaped_grad = np.reshape(grad, (params.batch_size, -1))
             norm_grad = np.linalg.norm(reshaped_grad, axis=1)
             min_grad = np.amin(reshaped_grad, axis=1)
@@ -502,8 +503,8 @@ class GradientOptimizer(object):
                 # NOTE: this section wasn't tested after changes to code, so some minor index tweaking are in order
                 if results[batch_index].majority_xx is not None:
                     asimg = results[batch_index].majority_xx[self.channel_swap_to_rgb].transpose((1,2,0))
-                    saveimagescc(majority_X_name, asimg, 0)
-                    saveimagesc(majority_Xpm_name, asimg + self._data_mean_rgb_img)  # PlusMean
+                    self.image_writer.saveimagescc(majority_X_name, asimg, 0)
+                    self.image_writer.saveimagesc(majority_Xpm_name, asimg + self._data_mean_rgb_img)  # PlusMean
 
             if results[batch_index].best_xx is not None:
                 # results[batch_index].best_xx.shape is (6,224,224)
@@ -511,7 +512,7 @@ class GradientOptimizer(object):
                 def save_output(data, channel_swap_to_rgb, best_X_image_name):
                                 # , best_Xpm_image_name, data_mean_rgb_img):
                     asimg = data[channel_swap_to_rgb].transpose((1, 2, 0))
-                    saveimagescc(best_X_image_name, asimg, 0)
+                    self.image_writer.saveimagescc(best_X_image_name, asimg, 0)
 
                 # get center position, relative to layer, of best maximum
                 [temp_ii, temp_jj] = results[batch_index].idxmax[results[batch_index].best_ii][1:3]
@@ -553,15 +554,11 @@ class GradientOptimizer(object):
                                     channel_swap_to_rgb=self.channel_swap_to_rgb,
                                     best_X_image_name=best_Xpm_name)
 
-            with open(info_name, 'w') as ff:
-                print >>ff, params
-                print >>ff
-                print >>ff, results[batch_index]
+            # results are serialized here, since trim_arrays() changes them
+            self.image_writer.write_file(info_name, '%s\n\n%s\n' % (params, results[batch_index]))
             if not skipbig:
-                with open(info_big_pkl_name, 'w') as ff:
-                    pickle.dump((params, results[batch_index]), ff, protocol=-1)
+                self.image_writer.write_file(info_big_pkl_name, pickle.dumps((params, results[batch_index]), protocol=-1))
             if not skipsmall:
                 results[batch_index].trim_arrays()
-                with open(info_pkl_name, 'w') as ff:
-                    pickle.dump((params, results[batch_index]), ff, protocol=-1)
+                self.image_writer.write_file(info_pkl_name, pickle.dumps((params, results[batch_index]), protocol=-1))
 
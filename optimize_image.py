@@ -14,6 +14,7 @@ from optimize.gradient_optimizer import GradientOptimizer, FindParams
 from caffevis.caffevis_helper import read_label_file, set_mean
 from settings_misc import load_network
 from caffe_misc import layer_name_to_top_name
+from image_writer import get_image_writer
 
 
 LR_POLICY_CHOICES = ('constant', 'progress', 'progress01')
@@ -171,61 +172,63 @@ def main():
     else:
         batched_data_mean = data_mean
 
-    optimizer = GradientOptimizer(settings, net, batched_data_mean, labels = labels,
-                                  label_layers = settings.caffevis_label_layers,
-                                  channel_swap_to_rgb = settings.caffe_net_channel_swap)
-
-    if not args.push_layers:
-        print "ERROR: No layers to work on, please set layers_to_output_in_offline_scripts to list of layers"
-        return
-
-    # go over push layers
-    for count, push_layer in enumerate(args.push_layers):
-
-        top_name = layer_name_to_top_name(net, push_layer)
-        blob = net.blobs[top_name].data
-        is_spatial = (len(blob.shape) == 4)
-        channels = blob.shape[1]
-
-        # get layer definition
-        layer_def = settings._layer_name_to_record[push_layer]
-
-        if is_spatial:
-            push_spatial = (layer_def.filter[0] / 2, layer_def.filter[1] / 2)
-        else:
-            push_spatial = (0, 0)
-
-        # if channels defined in settings file, use them
-        if settings.optimize_image_channels:
-            channels_list = settings.optimize_image_channels
-        else:
-            channels_list = range(channels)
-
-        # go over channels
-        for current_channel in channels_list:
-            params = FindParams(
-                start_at = args.start_at,
-                rand_seed = args.rand_seed,
-                batch_size = args.batch_size,
-                push_layer = push_layer,
-                push_channel = current_channel,
-                push_spatial = push_spatial,
-                push_dir = args.push_dir,
-                decay = args.decay,
-                blur_radius = args.blur_radius,
-                blur_every = args.blur_every,
-                small_val_percentile = args.small_val_percentile,
-                small_norm_percentile = args.small_norm_percentile,
-                px_benefit_percentile = args.px_benefit_percentile,
-                px_abs_benefit_percentile = args.px_abs_benefit_percentile,
-                lr_policy = args.lr_policy,
-                lr_params = lr_params,
-                max_iter = args.max_iters[count % len(args.max_iters)],
-                is_spatial = is_spatial,
-            )
-
-            optimizer.run_optimize(params, prefix_template = args.output_prefix,
-                                   brave = args.brave, skipbig = args.skipbig, skipsmall = args.skipsmall)
+    # results are encoded and written in the background while the next channels are optimized
+    with get_image_writer(settings) as image_writer:
+        optimizer = GradientOptimizer(settings, net, batched_data_mean, labels = labels,
+                                      label_layers = settings.caffevis_label_layers,
+                                      channel_swap_to_rgb = settings.caffe_net_channel_swap, image_writer = image_writer)
+
+        if not args.push_layers:
+            print "ERROR: No layers to work on, please set layers_to_output_in_offline_scripts to list of layers"
+            return
+
+        # go over push layers
+        for count, push_layer in enumerate(args.push_layers):
+
+            top_name = layer_name_to_top_name(net, push_layer)
+            blob = net.blobs[top_name].data
+            is_spatial = (len(blob.shape) == 4)
+            channels = blob.shape[1]
+
+            # get layer definition
+            layer_def = settings._layer_name_to_record[push_layer]
+
+            if is_spatial:
+                push_spatial = (layer_def.filter[0] / 2, layer_def.filter[1] / 2)
+            else:
+                push_spatial = (0, 0)
+
+            # if channels defined in settings file, use them
+            if settings.optimize_image_channels:
+                channels_list = settings.optimize_image_channels
+            else:
+                channels_list = range(channels)
+
+            # go over channels
+            for current_channel in channels_list:
+                params = FindParams(
+                    start_at = args.start_at,
+                    rand_seed = args.rand_seed,
+                    batch_size = args.batch_size,
+                    push_layer = push_layer,
+                    push_channel = current_channel,
+                    push_spatial = push_spatial,
+                    push_dir = args.push_dir,
+                    decay = args.decay,
+                    blur_radius = args.blur_radius,
+                    blur_every = args.blur_every,
+                    small_val_percentile = args.small_val_percentile,
+                    small_norm_percentile = args.small_norm_percentile,
+                    px_benefit_percentile = args.px_benefit_percentile,
+                    px_abs_benefit_percentile = args.px_abs_benefit_percentile,
+                    lr_policy = args.lr_policy,
+                    lr_params = lr_params,
+                    max_iter = args.max_iters[count % len(args.max_iters)],
+                    is_spatial = is_spatial,
+                )
+
+                optimizer.run_optimize(params, prefix_template = args.output_prefix,
+                                       brave = args.brave, skipbig = args.skipbig, skipsmall = args.skipsmall)
 
 
 if __name__ == '__main__':
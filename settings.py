@@ -34,7 +34,8 @@ base_folder = locals().get('base_folder', '')
 # disable webcam input, set to None.
 input_updater_capture_device = locals().get('input_updater_capture_device', 0)
 
-# How long to sleep in the input reading thread after reading a frame from the camera
+# How long to sleep in the input reading thread after reading a frame from the camera. Static files and a frozen
+# camera are not read again until they change, so this only throttles live camera input. 0 reads frames as fast as the camera delivers them
 input_updater_sleep_after_read_frame = locals().get('input_updater_sleep_after_read_frame', 1.0/20)
 
 # Input updater thread die after this many seconds without a heartbeat. Useful during debugging to avoid other threads running after main thread has crashed.
@@ -43,6 +44,10 @@ input_updater_heartbeat_required = locals().get('input_updater_heartbeat_require
 # How long to sleep while waiting for key presses and redraws. Recommendation: 1 (min: 1)
 main_loop_sleep_ms = locals().get('main_loop_sleep_ms', 1)
 
+# How long to sleep at most when the main loop is idle, i.e. there are no new frames and nothing to draw. New
+# frames and finished drawings wake the main loop immediately, this only bounds the delay in handling key presses
+main_loop_idle_wait_ms = locals().get('main_loop_idle_wait_ms', 20)
+
 # Whether or not to print a "." every second time through the main loop to visualize the loop rate
 print_dots = locals().get('print_dots', False)
 
@@ -127,6 +132,11 @@ static_files_input_mode = locals().get('static_files_input_mode', 'directory')
 # contains the file name to read, relevant only when static_files_input_mode is 'image_list'
 static_files_input_file = locals().get('static_files_input_file', 'images_file_list.txt')
 
+# Size in bytes of the LRU cache of static input images. For each recently viewed image it keeps the decoded image,
+# the activations and the diffs computed for each backprop unit, so going back to an image needs no forward pass.
+# 0 disables the cache. Default: 500MB
+static_input_cache_size = locals().get('static_input_cache_size', 500*1024**2)
+
 # set to True if the model expects grayscale inputs, False otherwise.
 # If value is None we set this parameter according to the network structure
 is_gray_model = locals().get('is_gray_model', None)
@@ -255,8 +265,23 @@ if isinstance(static_files_dir, basestring):
 
 # Pause Caffe forward/backward computation for this many seconds after a keypress. This is to keep the processor free for a brief period after a keypress, which allow the interface to feel much more responsive. After this period has passed, Caffe resumes computation, in CPU mode often occupying all cores. Default: .1
 caffevis_pause_after_keys = locals().get('caffevis_pause_after_keys', .10)
-caffevis_frame_wait_sleep = locals().get('caffevis_frame_wait_sleep', .01)
-caffevis_jpg_load_sleep = locals().get('caffevis_jpg_load_sleep', .01)
+
+# Run backward/deconv on a second instance of the net, which shares the weights, in a separate thread from forward.
+# Forward of the next frame then doesn't wait for backward of the previous one, so on multi-core CPUs or a GPU the
+# frame rate doesn't depend on the backprop mode, at the cost of the memory of another set of blobs. Default: False
+caffevis_separate_back_net = locals().get('caffevis_separate_back_net', False)
+
+# Number of static files before and after the current one whose activations are precomputed in the background, on
+# another instance of the net, while the app is idle. They are kept in the static input cache (see
+# static_input_cache_size), so paging through the files needs no decode or forward pass. Fewer files are prefetched
+# if they would take more than half of the cache. 0 disables. Default: 0
+caffevis_static_prefetch_count = locals().get('caffevis_static_prefetch_count', 0)
+
+# Run forward only up to the deepest layer which is needed: the selected layer, the backprop layer when backprop is
+# enabled, and caffevis_prob_layer when label predictions are shown. Forward is extended on the same frame when a
+# deeper layer is selected, so on deep nets browsing the lower layers costs only their part of the net. Default: True
+caffevis_truncate_forward = locals().get('caffevis_truncate_forward', True)
+
 # CaffeProc thread dies after this many seconds without a
 # heartbeat. Useful during debugging to avoid other threads running
 # after main thread has crashed.
@@ -364,12 +389,23 @@ caffevis_score_thick = locals().get('caffevis_score_thick', 1)
 # how should histograms be loaded: 'calculate_in_realtime' or 'load_from_file'
 caffevis_histograms_format = locals().get('caffevis_histograms_format','load_from_file')
 
+# how histograms are drawn in the toolbox: 'raster' draws them quickly with opencv, directly at the resolution they are
+# shown in, 'matplotlib' draws them as matplotlib figures, which is much slower but of higher quality
+caffevis_histograms_renderer = locals().get('caffevis_histograms_renderer', 'raster')
+
+# size in pixels of the square histogram image of each unit drawn by the 'raster' renderer
+caffevis_histograms_unit_size = locals().get('caffevis_histograms_unit_size', 300)
+
 # should we black maximal input images with zero or negative activation score
 caffevis_clear_negative_activations = locals().get('caffevis_clear_negative_activations', False)
 
 # folder for generating and reading deep vis outputs
 caffevis_outputs_dir = locals().get('caffevis_outputs_dir', '.')
 
+# folder of the network metadata cache: the processed prototxt, layer dag, blob shapes, tile arrangements and
+# receptive fields of each network, keyed by a hash of its prototxt and weights. None disables the cache
+network_metadata_cache_dir = locals().get('network_metadata_cache_dir', os.path.join(caffevis_outputs_dir, 'network_metadata_cache'))
+
 # caffe net parameter - channel swap, default is None which will make automatic decision according to other settings
 # the automatic setting is either (2,1,0) or (2,1,0,5,4,3) according to is_siamese value and siamese_input_mode
 caffe_net_channel_swap = locals().get('caffe_net_channel_swap', None)
@@ -408,12 +444,56 @@ max_tracker_do_info = locals().get('max_tracker_do_info', True)
 # default value for do_histograms parameter in max tracker
 max_tracker_do_histograms = locals().get('max_tracker_do_histograms', True)
 
+# number of worker processes which render the max histogram figures of the channels in max_tracker, 0 renders them
+# serially in the main process
+max_tracker_histogram_workers = locals().get('max_tracker_histogram_workers', 4)
+
 # default value for do_correlation parameter in max tracker
 max_tracker_do_correlation = locals().get('max_tracker_do_correlation', True)
 
 # default batch size used in max_tracker
 max_tracker_batch_size = locals().get('max_tracker_batch_size', 1)
 
+# number of workers used to decode and resize input images ahead of the network in max_tracker, 0 loads the images
+# serially on the main thread
+max_tracker_prefetch_workers = locals().get('max_tracker_prefetch_workers', 4)
+
+# use worker processes instead of worker threads for input prefetching in max_tracker
+max_tracker_prefetch_use_processes = locals().get('max_tracker_prefetch_use_processes', False)
+
+# how many batches of inputs can be prefetched ahead of the network in max_tracker, bounds the memory used. at least
+# one input per prefetch worker and one more batch are always allowed, so all the workers are kept busy
+max_tracker_prefetch_batches = locals().get('max_tracker_prefetch_batches', 2)
+
+# save a checkpoint of the max_tracker scan every this many images, so it can be resumed with --resume. 0 disables
+max_tracker_checkpoint_every_images = locals().get('max_tracker_checkpoint_every_images', 0)
+
+# save a checkpoint of the max_tracker scan every this many minutes, so it can be resumed with --resume. 0 disables
+max_tracker_checkpoint_every_minutes = locals().get('max_tracker_checkpoint_every_minutes', 30)
+
+# format of the patches output by crop_max_patches:
+#   "files" - a png file per patch and an info file per unit, in outdir/layer/unit_%04d
+#   "atlas" - all the patches of a layer packed into a few memory mappable arrays, in outdir/layer/patch_atlas
+# the toolbox reads patch atlases when they exist, and loose files otherwise
+max_tracker_patches_format = locals().get('max_tracker_patches_format', 'files')
+
+# also save a text dump of the max_tracker pickle file, for debugging. the dump can be very large for big layers
+max_tracker_save_text_dump = locals().get('max_tracker_save_text_dump', False)
+
+# number of workers which encode and write the output images of the offline scripts while the network keeps working,
+# 0 writes the images serially on the main thread
+output_image_writer_workers = locals().get('output_image_writer_workers', 4)
+
+# use worker processes instead of worker threads for writing the output images of the offline scripts
+output_image_writer_use_processes = locals().get('output_image_writer_use_processes', False)
+
+# how many output images can wait to be written by the offline scripts, bounds the memory used
+output_image_writer_max_pending = locals().get('output_image_writer_max_pending', 256)
+
+# PNG compression level (0-9) of the output images of the offline scripts, lower levels are faster to encode but give
+# larger files. None keeps the default of the image library
+output_image_png_compression = locals().get('output_image_png_compression', None)
+
 # list of layers to output when using offlien scripts
 layers_to_output_in_offline_scripts = locals().get('layers_to_output_in_offline_scripts', [])
 
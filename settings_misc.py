@@ -3,11 +3,9 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
 
-import cPickle as pickle
-
 from caffevis.caffevis_helper import set_mean
-from caffe_misc import layer_name_to_top_name, get_max_data_extent
-from misc import mkdir_p
+from caffe_misc import layer_name_to_top_name, get_max_data_extent, RegionComputer
+from network_metadata_cache import load_network_metadata, get_network_metadata
 
 def deduce_calculated_settings_without_network(settings):
     set_calculated_siamese_network_format(settings)
@@ -73,6 +71,16 @@ def process_network_proto(settings):
 
     settings._processed_deploy_prototxt = settings.caffevis_deploy_prototxt + ".processed_by_deepvis"
 
+    # reuse the processed prototxt of the network from the metadata cache, and skip the upgrade tool
+    network_metadata = get_network_metadata(settings)
+    if network_metadata.has('processed_prototxt'):
+        processed_prototxt = network_metadata.get('processed_prototxt')
+        if not os.path.isfile(settings._processed_deploy_prototxt) or \
+                open(settings._processed_deploy_prototxt, 'r').read() != processed_prototxt:
+            with open(settings._processed_deploy_prototxt, 'w') as new_proto_file:
+                new_proto_file.write(processed_prototxt)
+        return
+
     # check if force_backwards is missing
     found_force_backwards = False
     with open(settings.caffevis_deploy_prototxt, 'r') as proto_file:
@@ -94,6 +102,9 @@ def process_network_proto(settings):
     upgrade_tool_command_line = settings.caffevis_caffe_root + '/build/tools/upgrade_net_proto_text.bin ' + settings._processed_deploy_prototxt + ' ' + settings._processed_deploy_prototxt
     os.system(upgrade_tool_command_line)
 
+    with open(settings._processed_deploy_prototxt, 'r') as new_proto_file:
+        network_metadata.set('processed_prototxt', new_proto_file.read())
+
     return
 
 
@@ -115,6 +126,8 @@ def load_network(settings):
         caffe.set_mode_cpu()
         print 'Loaded caffe in CPU mode'
 
+    settings._network_metadata = load_network_metadata(settings)
+
     process_network_proto(settings)
 
     deduce_calculated_settings_without_network(settings)
@@ -130,6 +143,8 @@ def load_network(settings):
 
     deduce_calculated_settings_with_network(settings, net)
 
+    settings._network_metadata.save()
+
     if settings.caffe_net_transpose:
         net.transformer.set_transpose(net.inputs[0], settings.caffe_net_transpose)
 
@@ -138,6 +153,29 @@ def load_network(settings):
     return net, data_mean
 
 
+def load_shared_network(settings, net):
+    '''
+    loads another instance of the network loaded by load_network, which shares its weights, so the two instances can
+    run forward and backward on separate threads
+    :param settings: the settings used to load net
+    :param net: network returned by load_network
+    :return: the new network instance, with the input transformer of net
+    '''
+
+    import caffe
+
+    shared_net = caffe.Net(settings._processed_deploy_prototxt, caffe.TEST)
+    if hasattr(shared_net, 'share_with'):
+        shared_net.share_with(net)
+    else:
+        # older pycaffe can't share the weights, load another copy of them
+        shared_net.copy_from(settings.caffevis_network_weights)
+
+    shared_net.transformer = net.transformer
+
+    return shared_net
+
+
 class LayerRecord:
 
     def __init__(self, layer_def):
@@ -201,10 +239,16 @@ def read_network_dag(settings):
     from caffe.proto import caffe_pb2
     from google.protobuf import text_format
 
-    # load prototxt file
+    network_metadata = get_network_metadata(settings)
+
+    # load prototxt file, or its binary form from the metadata cache, which is much faster to parse
     network_def = caffe_pb2.NetParameter()
-    with open(settings._processed_deploy_prototxt, 'r') as proto_file:
-        text_format.Merge(str(proto_file.read()), network_def)
+    if network_metadata.has('network_def'):
+        network_def.ParseFromString(network_metadata.get('network_def'))
+    else:
+        with open(settings._processed_deploy_prototxt, 'r') as proto_file:
+            text_format.Merge(str(proto_file.read()), network_def)
+        network_metadata.set('network_def', network_def.SerializeToString())
 
     # map layer name to layer record
     layer_name_to_record = dict()
@@ -249,52 +293,29 @@ def read_network_dag(settings):
     settings._network_def = network_def
     settings._layer_name_to_record = layer_name_to_record
 
-    return
+    # compile the receptive field maps of all layers once, so converting regions to the input is a lookup
+    if not network_metadata.has('region_maps'):
+        network_metadata.set('region_maps', RegionComputer.compile_region_maps(settings, 'input'))
+    settings._region_maps = {'input': network_metadata.get('region_maps')}
 
+    return
 
-def _get_receptive_fields_cache_filename(settings):
-    return os.path.join(settings.caffevis_outputs_dir, 'receptive_fields_cache.pickled')
 
 def get_receptive_field(settings, net, layer_name):
+    '''returns the receptive field of the layer, computed once per network and kept in the network metadata cache'''
 
-    # flag which indicates whether the dictionary was changed hence we need to write it to cache
-    should_save_to_cache = False
-
-    # check if dictionary exists
-    if not hasattr(settings, '_receptive_field_per_layer'):
-
-        # if it doesn't, try load it from file
-        receptive_fields_cache_filename = _get_receptive_fields_cache_filename(settings)
-        if os.path.isfile(receptive_fields_cache_filename):
-            try:
-                with open(receptive_fields_cache_filename, 'rb') as receptive_fields_cache_file:
-                    settings._receptive_field_per_layer = pickle.load(receptive_fields_cache_file)
-            except:
-                settings._receptive_field_per_layer = dict()
-                should_save_to_cache = True
-        else:
-            settings._receptive_field_per_layer = dict()
-            should_save_to_cache = True
+    network_metadata = get_network_metadata(settings)
+    receptive_fields = network_metadata.get('receptive_fields', dict())
 
     # calculate lazy
-    if not settings._receptive_field_per_layer.has_key(layer_name):
+    if not receptive_fields.has_key(layer_name):
         print "Calculating receptive fields for layer %s" % (layer_name)
         top_name = layer_name_to_top_name(net, layer_name)
         if top_name is not None:
             blob = net.blobs[top_name].data
             is_spatial = (len(blob.shape) == 4)
-            layer_receptive_field = get_max_data_extent(net, settings, layer_name, is_spatial)
-            settings._receptive_field_per_layer[layer_name] = layer_receptive_field
-            should_save_to_cache = True
-
-    if should_save_to_cache:
-        try:
-            receptive_fields_cache_filename = _get_receptive_fields_cache_filename(settings)
-            mkdir_p(settings.caffevis_outputs_dir)
-            with open(receptive_fields_cache_filename, 'wb') as receptive_fields_cache_file:
-                pickle.dump(settings._receptive_field_per_layer, receptive_fields_cache_file, -1)
-        except IOError:
-            # ignore problems in cache saving
-            pass
-
-    return settings._receptive_field_per_layer[layer_name]
\ No newline at end of file
+            receptive_fields[layer_name] = get_max_data_extent(net, settings, layer_name, is_spatial)
+            network_metadata.set('receptive_fields', receptive_fields)
+            network_metadata.save()
+
+    return receptive_fields[layer_name]
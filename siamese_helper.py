@@ -1,7 +1,7 @@
 import os
 import numpy as np
-from numpy import expand_dims, concatenate
-from caffe_misc import layer_name_to_top_name
+from numpy import array
+from caffe_misc import layer_name_to_top_name, get_one_hot_backward
 from image_misc import resize_without_fit
 
 class SiameseViewMode:
@@ -368,6 +368,18 @@ class SiameseHelper(object):
 
         return layer_def['format'] in ['siamese_layer_pair', 'siamese_batch_pair']
 
+    @staticmethod
+    def get_layer_names(layer_def):
+        '''
+        helper function which returns the names of the net layers in a layer definition
+        :param layer_def: layer definition from the layers_list setting
+        :return: list of one layer name, or two for a siamese_layer_pair
+        '''
+
+        if layer_def['format'] == 'siamese_layer_pair':
+            return list(layer_def['name/s'])
+        return [layer_def['name/s']]
+
     @staticmethod
     def siamese_view_mode_has_two_images(layer_def, siamese_view_mode):
         '''
@@ -379,85 +391,49 @@ class SiameseHelper(object):
         return siamese_view_mode == SiameseViewMode.BOTH_IMAGES and SiameseHelper.is_pair_of_layers(layer_def)
 
     @staticmethod
-    def backward_from_layer(net, backprop_layer_def, backprop_unit, siamese_view_mode):
+    def _run_from_layer(net, backprop_layer_def, backprop_unit, siamese_view_mode, deconv_type):
+        '''
+        runs backward, or deconv if deconv_type is given, from the selected unit, with the activations of the unit as diffs
+        '''
+
+        one_hot_backward = get_one_hot_backward(net)
 
         # if we are in siamese_batch_pair, we don't care of siamese_view_mode since we must do deconv on the 2-batch
-        # otherwise, if we are in siamese_layer_pair, we do it on both layers only if backprop deconv are requested
+        # otherwise, if we are in siamese_layer_pair, we do it on both layers only if both are requested
         if (backprop_layer_def['format'] == 'siamese_batch_pair') or \
             (backprop_layer_def['format'] == 'siamese_layer_pair' and siamese_view_mode == SiameseViewMode.BOTH_IMAGES):
 
-            diffs0, diffs1 = SiameseHelper.get_siamese_selected_diff_blobs(net, backprop_layer_def, siamese_view_mode)
-            diffs0, diffs1 = diffs0 * 0, diffs1 * 0
             data0, data1 = SiameseHelper.get_siamese_selected_data_blobs(net, backprop_layer_def, siamese_view_mode)
-            diffs0[backprop_unit], diffs1[backprop_unit] = data0[backprop_unit], data1[backprop_unit]
-
-            # add batch dimension
-            diffs0 = expand_dims(diffs0, 0)
-            diffs1 = expand_dims(diffs1, 0)
 
             if backprop_layer_def['format'] == 'siamese_layer_pair':
-                net.backward_from_layer(backprop_layer_def['name/s'][0], diffs0, zero_higher=True)
-                net.backward_from_layer(backprop_layer_def['name/s'][1], diffs1, zero_higher=True)
+                one_hot_backward.run(backprop_layer_def['name/s'][0], [0], [backprop_unit], values = data0[backprop_unit],
+                                     deconv_type = deconv_type, zero_higher = True)
+                one_hot_backward.run(backprop_layer_def['name/s'][1], [0], [backprop_unit], values = data1[backprop_unit],
+                                     deconv_type = deconv_type, zero_higher = True)
 
             elif backprop_layer_def['format'] == 'siamese_batch_pair':
-                # combine them to 2-batch and send once
-                diffs = concatenate((diffs0, diffs1), axis=0)
-                net.backward_from_layer(backprop_layer_def['name/s'], diffs, zero_higher=True)
-        else:
+                # set both items of the 2-batch and send once
+                one_hot_backward.run(backprop_layer_def['name/s'], [0, 1], [backprop_unit, backprop_unit],
+                                     values = array([data0[backprop_unit], data1[backprop_unit]]),
+                                     deconv_type = deconv_type, zero_higher = True)
 
-            diffs = SiameseHelper.get_single_selected_diff_blob(net, backprop_layer_def, siamese_view_mode)
-            diffs = diffs * 0
-            data = SiameseHelper.get_single_selected_data_blob(net, backprop_layer_def, siamese_view_mode)
-            diffs[backprop_unit] = data[backprop_unit]
-
-            # add batch dimension
-            diffs = expand_dims(diffs, 0)
+        else: # normal layer, or siamese layer but siamese input mode is 'first' or 'second'
 
+            data = SiameseHelper.get_single_selected_data_blob(net, backprop_layer_def, siamese_view_mode)
             selected_backprop_layer_name = SiameseHelper.get_single_selected_layer_name(backprop_layer_def, siamese_view_mode)
-            net.backward_from_layer(selected_backprop_layer_name, diffs, zero_higher=True)
 
-        pass
+            one_hot_backward.run(selected_backprop_layer_name, [0], [backprop_unit], values = data[backprop_unit],
+                                 deconv_type = deconv_type, zero_higher = True)
 
     @staticmethod
-    def deconv_from_layer(net, backprop_layer_def, backprop_unit, siamese_view_mode, deconv_type):
-
-        # if we are in siamese_batch_pair, we don't care of siamese_view_mode since we must do deconv on the 2-batch
-        # otherwise, if we are in siamese_layer_pair, we do it on both layers only if both deconv are requested
-        if (backprop_layer_def['format'] == 'siamese_batch_pair') or \
-            (backprop_layer_def['format'] == 'siamese_layer_pair' and siamese_view_mode == SiameseViewMode.BOTH_IMAGES):
-
-            diffs0, diffs1 = SiameseHelper.get_siamese_selected_diff_blobs(net, backprop_layer_def, siamese_view_mode)
-            diffs0, diffs1 = diffs0 * 0, diffs1 * 0
-            data0, data1 = SiameseHelper.get_siamese_selected_data_blobs(net, backprop_layer_def, siamese_view_mode)
-            diffs0[backprop_unit], diffs1[backprop_unit] = data0[backprop_unit], data1[backprop_unit]
-
-            # add batch dimension
-            diffs0 = expand_dims(diffs0, 0)
-            diffs1 = expand_dims(diffs1, 0)
-
-            if backprop_layer_def['format'] == 'siamese_layer_pair':
-                net.deconv_from_layer(backprop_layer_def['name/s'][0], diffs0, zero_higher=True, deconv_type=deconv_type)
-                net.deconv_from_layer(backprop_layer_def['name/s'][1], diffs1, zero_higher=True, deconv_type=deconv_type)
-
-            elif backprop_layer_def['format'] == 'siamese_batch_pair':
-                # combine them to 2-batch and send once
-                diffs = concatenate((diffs0, diffs1), axis=0)
-
-                net.deconv_from_layer(backprop_layer_def['name/s'], diffs, zero_higher=True, deconv_type=deconv_type)
-
-        else: # normal layer, or siamese layer but siamese input mode is 'first' or 'second'
-
-            diffs = SiameseHelper.get_single_selected_diff_blob(net, backprop_layer_def, siamese_view_mode)
-            diffs = diffs * 0
-            data = SiameseHelper.get_single_selected_data_blob(net, backprop_layer_def, siamese_view_mode)
-            diffs[backprop_unit] = data[backprop_unit]
+    def backward_from_layer(net, backprop_layer_def, backprop_unit, siamese_view_mode):
 
-            # add batch dimension
-            diffs = expand_dims(diffs, 0)
+        SiameseHelper._run_from_layer(net, backprop_layer_def, backprop_unit, siamese_view_mode, deconv_type = None)
 
-            selected_backprop_layer_name = SiameseHelper.get_single_selected_layer_name(backprop_layer_def, siamese_view_mode)
+    @staticmethod
+    def deconv_from_layer(net, backprop_layer_def, backprop_unit, siamese_view_mode, deconv_type):
 
-            net.deconv_from_layer(selected_backprop_layer_name, diffs, zero_higher=True, deconv_type=deconv_type)
+        SiameseHelper._run_from_layer(net, backprop_layer_def, backprop_unit, siamese_view_mode, deconv_type = deconv_type)
 
     @staticmethod
     def get_image_from_frame(frame, is_siamese, image_shape, siamese_view_mode):